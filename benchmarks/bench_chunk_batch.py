@@ -0,0 +1,118 @@
+"""chunk_batch と chunk_batch_preallocated のマイクロベンチマーク
+
+デコーダと同じ形式（density / features の dict）を返す関数を、
+チャンクサイズ 1K〜1M で両方の実装に通して処理時間を比較する。
+小さな MLP（デコーダ）を通す場合のほか、実行器自体のオーバーヘッドを見るために
+入力の一部をそのまま返す関数でも計測し、density だけを残す場合（output_keys）も比較する。
+CUDA では出力のために確保されたピークメモリも表示する。
+
+    python benchmarks/bench_chunk_batch.py --num-points 2097152 --device cuda:0
+"""
+import argparse
+import os
+import sys
+import time
+
+import torch
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from tsr.utils import chunk_batch, chunk_batch_preallocated
+
+
+def make_decoder(hidden_dim: int, device: str) -> torch.nn.Module:
+    """TripoSR の NeRF デコーダと同じ形の小さな MLP を作成する"""
+    layers = torch.nn.Sequential(
+        torch.nn.Linear(120, hidden_dim),
+        torch.nn.SiLU(),
+        torch.nn.Linear(hidden_dim, 4),
+    ).to(device)
+
+    def decoder(x):
+        features = layers(x)
+        return {"density": features[..., 0:1], "features": features[..., 1:4]}
+
+    return decoder
+
+
+def measure(func, repeats: int, device: str) -> float:
+    """func を repeats 回実行した平均時間（ミリ秒）を返す"""
+    func()
+    if device.startswith("cuda"):
+        torch.cuda.synchronize()
+    start = time.perf_counter()
+    for _ in range(repeats):
+        func()
+    if device.startswith("cuda"):
+        torch.cuda.synchronize()
+    return (time.perf_counter() - start) / repeats * 1000.0
+
+
+def peak_memory(func, device: str) -> float:
+    """func の実行中に増えたピークメモリ（MiB、CUDA のみ。それ以外は nan）を返す"""
+    if not device.startswith("cuda"):
+        return float("nan")
+    torch.cuda.synchronize()
+    baseline = torch.cuda.memory_allocated(device)
+    torch.cuda.reset_peak_memory_stats(device)
+    func()
+    return (torch.cuda.max_memory_allocated(device) - baseline) / 2**20
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--num-points", type=int, default=2**21)
+    parser.add_argument("--hidden-dim", type=int, default=64)
+    parser.add_argument("--repeats", type=int, default=3)
+    parser.add_argument(
+        "--device", type=str, default="cuda:0" if torch.cuda.is_available() else "cpu"
+    )
+    args = parser.parse_args()
+
+    decoder = make_decoder(args.hidden_dim, args.device)
+
+    def passthrough(x):
+        # 実行器のオーバーヘッドだけを見るため、計算せずに入力の一部を返す
+        return {"density": x[..., 0:1], "features": x[..., 1:4]}
+
+    points = torch.randn(args.num_points, 120, device=args.device)
+
+    print(f"{args.num_points} points on {args.device}")
+    print(
+        f"{'function':>11} {'chunk size':>10} {'chunk_batch':>12} {'preallocated':>13} "
+        f"{'speedup':>8} {'density only':>13} {'speedup':>8} {'peak MiB':>17}"
+    )
+    with torch.no_grad():
+        for name, func in [("decoder", decoder), ("passthrough", passthrough)]:
+            for exponent in range(10, 21, 2):
+                chunk_size = 2**exponent
+                reference = chunk_batch(func, chunk_size, points)
+                result = chunk_batch_preallocated(func, chunk_size, points)
+                for k in reference:
+                    assert torch.equal(reference[k], result[k]), k
+                del reference, result
+
+                def run_old():
+                    return chunk_batch(func, chunk_size, points)
+
+                def run_new():
+                    return chunk_batch_preallocated(func, chunk_size, points)
+
+                def run_density():
+                    return chunk_batch_preallocated(
+                        func, chunk_size, points, output_keys=["density"]
+                    )
+
+                t_old = measure(run_old, args.repeats, args.device)
+                t_new = measure(run_new, args.repeats, args.device)
+                t_density = measure(run_density, args.repeats, args.device)
+                m_old = peak_memory(run_old, args.device)
+                m_new = peak_memory(run_new, args.device)
+                print(
+                    f"{name:>11} {chunk_size:>10} {t_old:>10.2f}ms {t_new:>11.2f}ms "
+                    f"{t_old / t_new:>7.2f}x {t_density:>11.2f}ms {t_old / t_density:>7.2f}x "
+                    f"{m_old:>8.1f}/{m_new:<8.1f}"
+                )
+
+if __name__ == "__main__":
+    main()
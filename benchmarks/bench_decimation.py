@@ -0,0 +1,113 @@
+"""メッシュ削減（tsr.decimate）による面数の削減と、後段の処理時間の短縮を計測する
+
+入力メッシュ（--mesh で指定、省略時は凹凸と頂点色を付けた icosphere）を --ratio または
+--target-faces まで削減し、削減前後のメッシュで OBJ/GLB 出力と UV 展開（xatlas が
+インストールされている場合）の時間を比較する。削減後の形状誤差（元の頂点から削減後の
+表面までの距離）と頂点色の誤差もあわせて表示する。
+
+    python benchmarks/bench_decimation.py --ratio 0.1
+    python benchmarks/bench_decimation.py --mesh output/0/mesh.obj --target-faces 20000
+"""
+import argparse
+import io
+import os
+import sys
+import time
+
+import numpy as np
+import trimesh
+from scipy.spatial import cKDTree
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from tsr.decimate import decimate_mesh
+
+
+def make_test_mesh(subdivisions: int):
+    """凹凸を付け、位置に応じた頂点色を持つ icosphere を作成する"""
+    sphere = trimesh.creation.icosphere(subdivisions=subdivisions)
+    v = sphere.vertices
+    scale = 1 + 0.1 * np.sin(5 * v[:, 0]) * np.cos(3 * v[:, 1]) + 0.02 * np.sin(20 * v[:, 2])
+    colors = ((v * 0.5 + 0.5) * 255).astype(np.uint8)
+    return trimesh.Trimesh(v * scale[:, None], sphere.faces, vertex_colors=colors)
+
+
+def time_stages(mesh, texture_resolution: int):
+    """後段の各処理の時間（秒）を計測する"""
+    times = {}
+    for file_type in ["obj", "glb"]:
+        start = time.perf_counter()
+        mesh.export(io.BytesIO(), file_type=file_type)
+        times[f"export {file_type}"] = time.perf_counter() - start
+    try:
+        import xatlas  # noqa: F401
+    except ImportError:
+        return times
+    from tsr.bake_texture import make_atlas
+
+    start = time.perf_counter()
+    make_atlas(mesh, texture_resolution, round(max(2, texture_resolution / 256)))
+    times["make_atlas"] = time.perf_counter() - start
+    return times
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--mesh", default=None, type=str, help="入力メッシュ（省略時は icosphere）")
+    parser.add_argument("--subdivisions", default=7, type=int, help="icosphere の分割回数")
+    parser.add_argument("--ratio", default=0.1, type=float, help="削減後の面数の割合")
+    parser.add_argument("--target-faces", default=None, type=int, help="削減後の面数（指定時は --ratio より優先）")
+    parser.add_argument("--device", default="cpu", type=str, help="削減に使うデバイス")
+    parser.add_argument("--texture-resolution", default=2048, type=int, help="UV 展開のテクスチャ解像度")
+    args = parser.parse_args()
+
+    if args.mesh is not None:
+        mesh = trimesh.load(args.mesh, force="mesh", process=False)
+    else:
+        mesh = make_test_mesh(args.subdivisions)
+
+    start = time.perf_counter()
+    decimated = decimate_mesh(
+        mesh,
+        target_faces=args.target_faces,
+        ratio=args.ratio if args.target_faces is None else None,
+        device=args.device,
+    )
+    decimation_time = time.perf_counter() - start
+    print(
+        f"faces: {len(mesh.faces)} -> {len(decimated.faces)} "
+        f"({len(decimated.faces) / len(mesh.faces):.1%}), decimation {decimation_time:.2f}s"
+    )
+
+    # 元の頂点から削減後の表面（密にサンプリングした点）までの距離
+    extent = float(np.linalg.norm(mesh.extents))
+    samples = decimated.sample(max(200000, 4 * len(mesh.vertices)))
+    distances, _ = cKDTree(samples).query(mesh.vertices)
+    print(
+        f"surface error: mean {distances.mean() / extent:.2e}, "
+        f"max {distances.max() / extent:.2e} (relative to the bounding box diagonal)"
+    )
+    if mesh.visual.kind == "vertex" and decimated.visual.kind == "vertex":
+        _, nearest = cKDTree(mesh.vertices).query(decimated.vertices)
+        color_error = np.abs(
+            decimated.visual.vertex_colors[:, :3].astype(np.float64)
+            - mesh.visual.vertex_colors[nearest, :3]
+        )
+        print(f"vertex color error: mean {color_error.mean():.2f}, max {color_error.max():.0f} (0-255)")
+
+    original_times = time_stages(mesh, args.texture_resolution)
+    decimated_times = time_stages(decimated, args.texture_resolution)
+    print(f"{'stage':<12} {'original':>10} {'decimated':>10} {'saved':>10}")
+    for name in original_times:
+        saved = original_times[name] - decimated_times[name]
+        print(
+            f"{name:<12} {original_times[name]:>9.3f}s {decimated_times[name]:>9.3f}s {saved:>9.3f}s"
+        )
+    total_saved = sum(original_times.values()) - sum(decimated_times.values())
+    print(f"total saved {total_saved:.3f}s, net of decimation {total_saved - decimation_time:.3f}s")
+    if "make_atlas" not in original_times:
+        print("xatlas is not installed; texture atlas timing skipped")
+
+
+if __name__ == "__main__":
+    main()
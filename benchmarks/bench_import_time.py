@@ -0,0 +1,105 @@
+"""起動時のインポート時間を計測する
+
+`python -c "import tsr.system"` と `python run.py --help` をそれぞれ別プロセスで
+--repeats 回実行し、最小・中央値の実行時間を表示する。あわせて、tsr.system の
+インポートだけで読み込まれてしまった重い任意依存（rembg など）があれば表示し、
+終了コード 1 で終了する。--top を指定すると `python -X importtime` の結果から
+累積時間の大きいモジュールを表示する。
+
+    python benchmarks/bench_import_time.py --repeats 5 --top 10
+"""
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# 機能を使うときにだけ読み込むべきモジュール
+LAZY_MODULES = [
+    "rembg",
+    "onnxruntime",
+    "imageio",
+    "trimesh",
+    "huggingface_hub",
+    "transformers",
+    "xatlas",
+    "moderngl",
+    "torchmcubes",
+]
+
+COMMANDS = {
+    "import tsr.system": [sys.executable, "-c", "import tsr.system"],
+    "run.py --help": [sys.executable, os.path.join(ROOT, "run.py"), "--help"],
+}
+
+
+def measure(command, repeats: int):
+    """command を repeats 回実行し、各回の実行時間（秒）のリストを返す"""
+    times = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        subprocess.run(command, cwd=ROOT, check=True, stdout=subprocess.DEVNULL)
+        times.append(time.perf_counter() - start)
+    return times
+
+
+def top_imports(statement: str, top: int):
+    """python -X importtime の結果から、累積時間の大きいトップレベルのモジュールを返す"""
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", statement],
+        cwd=ROOT,
+        check=True,
+        capture_output=True,
+        text=True,
+    )
+    modules = []
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "|" not in line:
+            continue
+        _, cumulative, name = line.split("|")
+        # インデントが 2 文字以下のもの（直接インポートされたモジュール）のみ
+        if not cumulative.strip().isdigit() or len(name) - len(name.lstrip()) > 3:
+            continue
+        modules.append((int(cumulative) / 1e6, name.strip()))
+    return sorted(modules, reverse=True)[:top]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--repeats", type=int, default=5)
+    parser.add_argument("--top", type=int, default=0)
+    args = parser.parse_args()
+
+    for name, command in COMMANDS.items():
+        times = measure(command, args.repeats)
+        print(f"{name}: min {min(times):.2f}s, median {statistics.median(times):.2f}s")
+
+    loaded = subprocess.run(
+        [
+            sys.executable,
+            "-c",
+            "import sys, tsr.system; "
+            f"print(' '.join(m for m in {LAZY_MODULES!r} if m in sys.modules))",
+        ],
+        cwd=ROOT,
+        check=True,
+        capture_output=True,
+        text=True,
+    ).stdout.split()
+
+    if args.top > 0:
+        print("Slowest imports of tsr.system:")
+        for seconds, module in top_imports("import tsr.system", args.top):
+            print(f"  {seconds:.3f}s {module}")
+
+    if loaded:
+        print(f"Optional modules loaded by importing tsr.system: {', '.join(loaded)}")
+        sys.exit(1)
+    print("No optional heavy modules are loaded by importing tsr.system.")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,103 @@
+"""組み込みの marching cubes の速度と出力を確認する
+
+解析的な密度場（凹凸のある球と小さな球）を coarse-to-fine で評価し、組み込みの実装で
+全セルを調べる場合と、評価済みのセルだけを調べる場合の時間を各解像度で比較する。
+2つの出力が一致すること、メッシュが閉じていて外向きに張られていることを確認し、
+満たさない場合は終了コード 1 で終了する。torchmcubes がインストールされていれば
+その時間と面数も表示する。
+
+    python benchmarks/bench_marching_cubes.py --resolutions 128 256 512 --device cuda:0
+"""
+import argparse
+import os
+import sys
+import time
+
+import torch
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from tsr.models.isosurface import MarchingCubeHelper
+
+
+def level(points):
+    """内側で正になる解析的な密度場"""
+    p = points - 0.5
+    bumpy = 0.3 + 0.05 * torch.sin(20 * p[:, 0]) * torch.cos(15 * p[:, 1]) - p.norm(dim=-1)
+    small = 0.1 - (points - 0.85).norm(dim=-1)
+    return torch.maximum(bumpy, small)
+
+
+def measure(func, repeats: int, device):
+    """func を repeats 回実行し、最短の時間（秒）と最後の結果を返す"""
+    best = float("inf")
+    for _ in range(repeats):
+        if device.type == "cuda":
+            torch.cuda.synchronize()
+        start = time.perf_counter()
+        result = func()
+        if device.type == "cuda":
+            torch.cuda.synchronize()
+        best = min(best, time.perf_counter() - start)
+    return best, result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--resolutions", default=[128, 256], type=int, nargs="+", help="marching cubes の解像度")
+    parser.add_argument("--coarse-resolution", default=32, type=int, help="coarse-to-fine の最初の解像度")
+    parser.add_argument("--device", default="cpu", type=str, help="使用するデバイス")
+    parser.add_argument("--repeats", default=3, type=int, help="各計測の繰り返し回数")
+    args = parser.parse_args()
+
+    import trimesh
+
+    device = torch.device(args.device)
+    failed = False
+    for resolution in args.resolutions:
+        helper = MarchingCubeHelper(resolution)
+        values, evaluated = helper.evaluate_hierarchical(
+            lambda points: level(points.to(device)),
+            coarse_resolution=args.coarse_resolution,
+            margin=0.01,
+            device=device,
+        )
+        cells_time, cells = measure(lambda: helper.evaluated_cells(evaluated), args.repeats, device)
+        dense_time, (v_dense, f_dense) = measure(lambda: helper.marching_cubes(values), args.repeats, device)
+        sparse_time, (v_sparse, f_sparse) = measure(
+            lambda: helper.marching_cubes(values, cells), args.repeats, device
+        )
+
+        mesh = trimesh.Trimesh(v_sparse.cpu().numpy(), f_sparse.cpu().numpy(), process=False)
+        identical = torch.equal(v_dense, v_sparse) and torch.equal(f_dense, f_sparse)
+        ok = identical and mesh.is_watertight and mesh.is_winding_consistent and mesh.volume > 0
+        failed |= not ok
+        print(
+            f"resolution {resolution}: {f_sparse.shape[0]} faces, {v_sparse.shape[0]} vertices, "
+            f"{cells.shape[0]} of {(resolution - 1) ** 3} cells evaluated"
+        )
+        print(
+            f"  all cells {dense_time * 1000:.1f}ms, evaluated cells {sparse_time * 1000:.1f}ms "
+            f"(+{cells_time * 1000:.1f}ms to list them)"
+        )
+        print(
+            f"  identical {identical}, watertight {mesh.is_watertight}, "
+            f"winding consistent {mesh.is_winding_consistent}, volume {mesh.volume:.4f}"
+        )
+
+        try:
+            reference = MarchingCubeHelper(resolution, backend="torchmcubes")
+        except ImportError:
+            continue
+        reference_time, (_, f_reference) = measure(
+            lambda: reference.marching_cubes(values), args.repeats, device
+        )
+        print(f"  torchmcubes {reference_time * 1000:.1f}ms, {f_reference.shape[0]} faces")
+
+    if failed:
+        print("FAILED: the outputs differ or the mesh is not closed and outward facing")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,77 @@
+"""モデル起動時間の内訳（構築・重みの読み込み・デバイスへの転送）を計測する
+
+TSR.from_pretrained を empty_init=False（通常どおり乱数で初期化してから重みを上書き）と
+empty_init=True（meta デバイス上で構築し、チェックポイントのテンソルをそのまま割り当て）の
+両方で実行し、各段階の時間を比較する。読み込み後の出力が一致することも確認する。
+
+    python benchmarks/bench_startup.py --device cuda:0
+    python benchmarks/bench_startup.py models/triposr --weight-name model.safetensors
+"""
+import argparse
+import os
+import sys
+import time
+
+import torch
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from tsr.system import TSR
+
+
+def load(args, empty_init: bool):
+    """モデルを読み込んでデバイスへ転送し、(モデル, 各段階の時間) を返す"""
+    timings = {}
+    model = TSR.from_pretrained(
+        args.pretrained_model_name_or_path,
+        config_name="config.yaml",
+        weight_name=args.weight_name,
+        empty_init=empty_init,
+        timings=timings,
+    )
+    start = time.perf_counter()
+    model.to(args.device)
+    if args.device.startswith("cuda"):
+        torch.cuda.synchronize()
+    timings["transfer"] = time.perf_counter() - start
+    return model, timings
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument(
+        "pretrained_model_name_or_path", type=str, nargs="?", default="stabilityai/TripoSR"
+    )
+    parser.add_argument("--weight-name", type=str, default="model.ckpt")
+    parser.add_argument(
+        "--device", type=str, default="cuda:0" if torch.cuda.is_available() else "cpu"
+    )
+    args = parser.parse_args()
+
+    # ダウンロード時間を含めないよう、先に一度読み込んでキャッシュしておく
+    load(args, empty_init=True)
+
+    results = {}
+    params = {}
+    for empty_init in [False, True]:
+        model, timings = load(args, empty_init)
+        results[empty_init] = timings
+        params[empty_init] = {k: v.cpu() for k, v in model.state_dict().items()}
+        del model
+
+    for k in params[False]:
+        assert torch.equal(params[False][k], params[True][k]), k
+
+    print(f"{args.pretrained_model_name_or_path} ({args.weight_name}) on {args.device}")
+    print(f"{'':>12} {'construction':>13} {'loading':>10} {'transfer':>10} {'total':>10}")
+    for empty_init, label in [(False, "random init"), (True, "empty init")]:
+        t = results[empty_init]
+        total = sum(t.values())
+        print(
+            f"{label:>12} {t['construction']:>12.3f}s {t['loading']:>9.3f}s"
+            f" {t['transfer']:>9.3f}s {total:>9.3f}s"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,118 @@
+"""テクスチャベイキングで、アトラスに覆われたテクセルだけを問い合わせる効果を計測する
+
+画像1枚の scene code とメッシュを生成し、位置テクスチャ（xatlas と moderngl が
+使える場合は実際のアトラス、使えない場合はメッシュ表面のサンプルを --coverage の割合の
+テクセルに並べた合成テクスチャ）の色を、全テクセルを問い合わせる場合（masked=False）と
+覆われたテクセルだけを問い合わせる場合（masked=True）で計算して時間を比較する。
+2つのテクスチャが一致しない場合や、覆われたテクセルのないテクスチャが透明にならない
+場合は終了コード 1 で終了する。
+
+    python benchmarks/bench_texture_baking.py --texture-resolution 2048 --device cuda:0
+"""
+import argparse
+import os
+import sys
+import time
+
+import numpy as np
+import torch
+from PIL import Image
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from tsr.bake_texture import make_atlas, positions_to_colors, rasterize_position_atlas
+from tsr.system import TSR
+
+
+def position_texture(mesh, texture_resolution: int, coverage: float):
+    """メッシュの位置テクスチャを作成し、(テクスチャ, 実際のアトラスか) を返す"""
+    try:
+        import moderngl  # noqa: F401
+        import xatlas  # noqa: F401
+    except ImportError:
+        pass
+    else:
+        padding = round(max(2, texture_resolution / 256))
+        atlas = make_atlas(mesh, texture_resolution, padding)
+        texture = rasterize_position_atlas(
+            mesh, atlas["vmapping"], atlas["indices"], atlas["uvs"], texture_resolution, padding
+        )
+        return texture, True
+
+    num_texels = texture_resolution * texture_resolution
+    num_covered = int(num_texels * coverage)
+    texture = np.zeros((num_texels, 4), dtype=np.float32)
+    texture[:num_covered, :3] = mesh.sample(num_covered)
+    texture[:num_covered, 3] = 1.0
+    # アトラスのチャートのように、覆われたテクセルを行ごとにまとめて配置する
+    rows = np.random.default_rng(0).permutation(texture_resolution)
+    texture = texture.reshape(texture_resolution, texture_resolution, 4)[rows]
+    return texture, False
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument(
+        "pretrained_model_name_or_path", type=str, nargs="?", default="stabilityai/TripoSR"
+    )
+    parser.add_argument("--weight-name", type=str, default="model.ckpt")
+    parser.add_argument("--image", type=str, default="examples/chair.png", help="入力画像（背景除去済みとして扱う）")
+    parser.add_argument("--mc-resolution", type=int, default=256)
+    parser.add_argument("--texture-resolution", type=int, default=2048)
+    parser.add_argument("--coverage", type=float, default=0.45, help="合成テクスチャで覆われたテクセルの割合")
+    parser.add_argument("--repeats", type=int, default=3)
+    parser.add_argument(
+        "--device", type=str, default="cuda:0" if torch.cuda.is_available() else "cpu"
+    )
+    args = parser.parse_args()
+
+    model = TSR.from_pretrained(
+        args.pretrained_model_name_or_path,
+        config_name="config.yaml",
+        weight_name=args.weight_name,
+    )
+    model.to(args.device)
+    with torch.no_grad():
+        scene_codes = model([Image.open(args.image).convert("RGB")], device=args.device)
+    mesh = model.extract_mesh(scene_codes, False, resolution=args.mc_resolution)[0]
+    texture, is_atlas = position_texture(mesh, args.texture_resolution, args.coverage)
+    covered = float((texture[..., 3] != 0).mean())
+    print(
+        f"{args.texture_resolution}x{args.texture_resolution} "
+        f"{'atlas' if is_atlas else 'synthetic texture'}, {covered:.1%} of the texels covered"
+    )
+
+    times = {}
+    colors = {}
+    for masked in [False, True]:
+        best = float("inf")
+        for _ in range(args.repeats):
+            if args.device.startswith("cuda"):
+                torch.cuda.synchronize()
+            start = time.perf_counter()
+            colors[masked] = positions_to_colors(
+                model, scene_codes[0], texture, args.texture_resolution, masked=masked
+            )
+            if args.device.startswith("cuda"):
+                torch.cuda.synchronize()
+            best = min(best, time.perf_counter() - start)
+        times[masked] = best
+        print(f"masked={masked}: {best * 1000:.1f}ms")
+
+    max_error = float(np.abs(colors[True] - colors[False]).max())
+    print(f"speedup {times[False] / times[True]:.2f}x, max abs difference {max_error:.2e}")
+    if max_error > 1e-4:
+        print("FAILED: the masked texture differs from the full one")
+        sys.exit(1)
+
+    # 覆われたテクセルがない場合はデコーダを呼ばず、透明なテクスチャになること
+    empty = positions_to_colors(
+        model, scene_codes[0], np.zeros_like(texture), args.texture_resolution
+    )
+    if empty.shape != texture.shape or np.any(empty != 0):
+        print("FAILED: a texture without covered texels is not transparent")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
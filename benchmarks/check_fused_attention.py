@@ -0,0 +1,97 @@
+"""融合した QKV/KV 射影と通常の射影で Transformer1D の出力が一致することを確認する
+
+TripoSR のバックボーンと同じ形（3072 トークンの自己注意、DINO トークンへの交差注意）の
+Transformer1D をランダムな重みで作成し、AttnProcessor / AttnProcessor2_0 それぞれについて
+融合前後の出力の差と処理時間を比較する。差が --atol を超えた場合は終了コード 1 で終了する。
+
+    python benchmarks/check_fused_attention.py --device cuda:0
+"""
+import argparse
+import os
+import sys
+import time
+
+import torch
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from tsr.models.transformer.attention import (
+    Attention,
+    AttnProcessor,
+    AttnProcessor2_0,
+)
+from tsr.models.transformer.transformer_1d import Transformer1D
+
+
+def measure(func, repeats: int, device: str) -> float:
+    """func を repeats 回実行した平均時間（ミリ秒）を返す"""
+    func()
+    if device.startswith("cuda"):
+        torch.cuda.synchronize()
+    start = time.perf_counter()
+    for _ in range(repeats):
+        func()
+    if device.startswith("cuda"):
+        torch.cuda.synchronize()
+    return (time.perf_counter() - start) / repeats * 1000.0
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--num-layers", type=int, default=2)
+    parser.add_argument("--num-tokens", type=int, default=3 * 32 * 32)
+    parser.add_argument("--num-encoder-tokens", type=int, default=1025)
+    parser.add_argument("--attention-bias", action="store_true", help="Also fuse projection biases.")
+    parser.add_argument("--repeats", type=int, default=3)
+    parser.add_argument("--atol", type=float, default=1e-4)
+    parser.add_argument(
+        "--device", type=str, default="cuda:0" if torch.cuda.is_available() else "cpu"
+    )
+    args = parser.parse_args()
+
+    torch.manual_seed(0)
+    # stabilityai/TripoSR の config.yaml と同じ設定（層数のみ --num-layers）
+    backbone = Transformer1D(
+        {
+            "in_channels": 1024,
+            "num_attention_heads": 16,
+            "attention_head_dim": 64,
+            "num_layers": args.num_layers,
+            "cross_attention_dim": 768,
+            "attention_bias": args.attention_bias,
+        }
+    ).to(args.device).eval()
+    hidden_states = torch.randn(1, 1024, args.num_tokens, device=args.device)
+    encoder_hidden_states = torch.randn(1, args.num_encoder_tokens, 768, device=args.device)
+
+    def run():
+        return backbone(hidden_states, encoder_hidden_states=encoder_hidden_states)
+
+    failed = False
+    for processor_cls in [AttnProcessor2_0, AttnProcessor]:
+        for module in backbone.modules():
+            if isinstance(module, Attention):
+                module.set_processor(processor_cls())
+        with torch.no_grad():
+            backbone.fuse_qkv_projections(False)
+            reference = run()
+            t_unfused = measure(run, args.repeats, args.device)
+            backbone.fuse_qkv_projections(True)
+            fused = run()
+            t_fused = measure(run, args.repeats, args.device)
+        max_error = (fused - reference).abs().max().item()
+        ok = max_error <= args.atol
+        failed = failed or not ok
+        print(
+            f"{processor_cls.__name__}: max abs difference {max_error:.2e}"
+            f", unfused {t_unfused:.1f}ms, fused {t_fused:.1f}ms ({t_unfused / t_fused:.2f}x)"
+            + ("" if ok else " FAILED")
+        )
+    backbone.fuse_qkv_projections(False)
+
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
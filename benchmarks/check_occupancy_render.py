@@ -0,0 +1,90 @@
+"""占有グリッドを使ったレンダリングが、物体に当たらないレイのチャンクでも動くことを確認する
+
+ランダムな重みの NeRFMLP と triplane で、次の場合に render_rays を実行する。
+
+- 空の占有グリッド: すべてのレイが背景色（白）になること
+- 一角だけが占有されたグリッド: 小さなチャンクに分けたとき、占有セルを通らないチャンクが
+  含まれていても、全体を1チャンクで描画した結果と一致すること
+- すべて占有されたグリッド: 占有グリッドなしの結果と一致すること
+
+一様サンプリングと early termination（--render-early-termination-eps）の両方を確認し、
+失敗した場合は終了コード 1 で終了する。
+
+    python benchmarks/check_occupancy_render.py
+"""
+import argparse
+import os
+import sys
+
+import torch
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from tsr.models.nerf_renderer import TriplaneNeRFRenderer
+from tsr.models.network_utils import NeRFMLP
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--num-rays", type=int, default=4096)
+    parser.add_argument("--atol", type=float, default=1e-5)
+    parser.add_argument(
+        "--device", type=str, default="cuda:0" if torch.cuda.is_available() else "cpu"
+    )
+    args = parser.parse_args()
+
+    torch.manual_seed(0)
+    renderer = TriplaneNeRFRenderer(
+        {"radius": 0.87, "density_activation": "exp", "num_samples_per_ray": 32}
+    ).to(args.device)
+    decoder = NeRFMLP(
+        {"in_channels": 3 * 8, "n_neurons": 32, "n_hidden_layers": 2, "activation": "silu"}
+    ).to(args.device).eval()
+    triplane = torch.randn(3, 8, 16, 16, device=args.device)
+
+    # カメラから原点方向に向かうレイ（前半は物体の手前側の半分、後半は反対側の半分を通る）
+    rays_o = torch.tensor([0.0, 0.0, 2.0], device=args.device).expand(args.num_rays, 3)
+    target = torch.rand(args.num_rays, 3, device=args.device) * 0.8 - 0.4
+    target[: args.num_rays // 2, 0] = target[: args.num_rays // 2, 0].abs() + 0.45
+    target[args.num_rays // 2 :, 0] = -target[args.num_rays // 2 :, 0].abs() - 0.45
+    rays_d = torch.nn.functional.normalize(target - rays_o, dim=-1)
+
+    resolution = renderer.cfg.occupancy_grid_resolution
+    empty = torch.zeros((resolution,) * 3, dtype=torch.bool, device=args.device)
+    corner = empty.clone()
+    corner[: resolution // 3] = True  # x < 0 側の一部だけ
+    full = torch.ones_like(empty)
+
+    def render(occupancy_grid, max_points_per_batch, **kwargs):
+        with torch.no_grad():
+            return renderer.render_rays(
+                decoder,
+                triplane,
+                rays_o,
+                rays_d,
+                max_points_per_batch=max_points_per_batch,
+                occupancy_grid=occupancy_grid,
+                **kwargs,
+            )
+
+    small_chunks = 32 * args.num_rays // 8
+    whole = 32 * args.num_rays
+    failed = False
+    for name, kwargs in [("uniform", {}), ("early termination", {"termination_eps": 1e-3})]:
+        checks = [
+            ("empty grid", render(empty, small_chunks, **kwargs), torch.ones(args.num_rays, 3, device=args.device)),
+            ("corner grid", render(corner, small_chunks, **kwargs), render(corner, whole, **kwargs)),
+            ("full grid", render(full, small_chunks, **kwargs), render(None, whole, **kwargs)),
+        ]
+        for check, result, expected in checks:
+            max_error = (result - expected).abs().max().item()
+            ok = max_error <= args.atol
+            failed = failed or not ok
+            print(f"{name}, {check}: max abs difference {max_error:.2e}" + ("" if ok else " FAILED"))
+
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
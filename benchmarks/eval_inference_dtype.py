@@ -0,0 +1,179 @@
+"""低精度推論（bfloat16 / float16）と int8 動的量子化の精度を float32 と比較するハーネス
+
+examples/ の各画像について float32 と、指定した dtype（--dtypes）・量子化モード（--quantize）で
+scene_codes とメッシュを生成し、以下を報告する。
+
+- scene_codes の相対L2誤差・最大絶対誤差
+- メッシュ頂点間の Chamfer 距離（マーチングキューブのボクセル幅との比も表示）
+- 頂点色の誤差（各頂点に最も近い float32 メッシュの頂点色との差の平均、0〜1）
+- 推論時間と float32 に対する速度向上率、ピークメモリ（CUDA のみ）
+
+Chamfer 距離がボクセル幅 × --max-chamfer-voxels を超えた画像があれば終了コード 1 で終了する。
+
+    python benchmarks/eval_inference_dtype.py --dtypes bfloat16 float16 --device cuda:0
+    python benchmarks/eval_inference_dtype.py --dtypes --quantize backbone backbone+decoder --device cpu
+"""
+import argparse
+import copy
+import glob
+import os
+import sys
+import time
+
+import numpy as np
+import torch
+import trimesh
+from PIL import Image
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from tsr.system import TSR
+from tsr.utils import remove_background, resize_foreground
+
+
+def load_image(path: str, rembg_session, foreground_ratio: float) -> Image.Image:
+    """run.py と同じ前処理（背景除去・前景のリサイズ・灰色背景での合成）を行う"""
+    image = Image.open(path)
+    if rembg_session is None:
+        return image.convert("RGB")
+    image = remove_background(image, rembg_session)
+    image = resize_foreground(image, foreground_ratio)
+    image = np.array(image).astype(np.float32) / 255.0
+    image = image[:, :, :3] * image[:, :, 3:4] + (1 - image[:, :, 3:4]) * 0.5
+    return Image.fromarray((image * 255.0).astype(np.uint8))
+
+
+def chamfer_distance(mesh_a: trimesh.Trimesh, mesh_b: trimesh.Trimesh) -> float:
+    """頂点間の対称 Chamfer 距離（双方向の最近傍距離の平均の和の半分）
+
+    マーチングキューブの頂点は格子の辺上にあるため、同じ密度場からは同じ頂点が得られ、
+    距離は 0 になる（表面のランダムサンプリングと違い、ノイズの下限がない）。
+    """
+    if len(mesh_a.vertices) == 0 or len(mesh_b.vertices) == 0:
+        return float("inf")
+    d_ab, _ = mesh_b.kdtree.query(mesh_a.vertices)
+    d_ba, _ = mesh_a.kdtree.query(mesh_b.vertices)
+    return 0.5 * (float(d_ab.mean()) + float(d_ba.mean()))
+
+
+def vertex_color_error(mesh: trimesh.Trimesh, reference: trimesh.Trimesh) -> float:
+    """各頂点の色と、最も近い参照メッシュの頂点の色との差の平均（0〜1）"""
+    if len(mesh.vertices) == 0 or len(reference.vertices) == 0:
+        return float("inf")
+    _, idx = reference.kdtree.query(mesh.vertices)
+    colors = mesh.visual.vertex_colors[:, :3].astype(np.float32) / 255.0
+    ref_colors = reference.visual.vertex_colors[idx, :3].astype(np.float32) / 255.0
+    return float(np.abs(colors - ref_colors).mean())
+
+
+def run(model: TSR, image: Image.Image, device: str, mc_resolution: int):
+    """scene_codes とメッシュを生成し、処理時間とピークメモリを返す"""
+    if device.startswith("cuda"):
+        torch.cuda.synchronize()
+        torch.cuda.reset_peak_memory_stats()
+    start = time.perf_counter()
+    with torch.no_grad():
+        scene_codes = model([image], device=device)
+        mesh = model.extract_mesh(scene_codes, True, resolution=mc_resolution)[0]
+    peak_memory = None
+    if device.startswith("cuda"):
+        torch.cuda.synchronize()
+        peak_memory = torch.cuda.max_memory_allocated() / 1024**2
+    return scene_codes, mesh, time.perf_counter() - start, peak_memory
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("images", type=str, nargs="*", help="Input images. Default: examples/*.png")
+    parser.add_argument("--pretrained-model-name-or-path", type=str, default="stabilityai/TripoSR")
+    parser.add_argument("--dtypes", type=str, nargs="*", default=["bfloat16"], choices=["bfloat16", "float16"])
+    parser.add_argument(
+        "--quantize",
+        type=str,
+        nargs="*",
+        default=[],
+        help="Quantize modes to evaluate (CPU only), e.g. 'backbone' 'backbone+decoder'.",
+    )
+    parser.add_argument(
+        "--device", type=str, default="cuda:0" if torch.cuda.is_available() else "cpu"
+    )
+    parser.add_argument("--mc-resolution", type=int, default=256)
+    parser.add_argument("--chunk-size", type=int, default=8192)
+    parser.add_argument("--no-remove-bg", action="store_true")
+    parser.add_argument("--foreground-ratio", type=float, default=0.85)
+    parser.add_argument(
+        "--max-chamfer-voxels",
+        type=float,
+        default=0.5,
+        help="Fail if the Chamfer distance exceeds this many marching cubes voxels.",
+    )
+    args = parser.parse_args()
+
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    images = args.images or sorted(glob.glob(os.path.join(root, "examples", "*.png")))
+
+    model = TSR.from_pretrained(
+        args.pretrained_model_name_or_path,
+        config_name="config.yaml",
+        weight_name="model.ckpt",
+    )
+    model.renderer.set_chunk_size(args.chunk_size)
+    model.to(args.device)
+
+    rembg_session = None
+    if not args.no_remove_bg:
+        import rembg
+
+        rembg_session = rembg.new_session()
+
+    # 比較する設定：(名前, モデル, 推論 dtype)
+    variants = [(dtype, model, dtype) for dtype in args.dtypes]
+    for mode in args.quantize:
+        if not args.device.startswith("cpu"):
+            print(f"Skipping int8 {mode}: dynamic quantization is only supported on CPU")
+            continue
+        quantized_model = copy.deepcopy(model)
+        quantized_model.quantize(mode)
+        variants.append((f"int8 {mode}", quantized_model, None))
+
+    # マーチングキューブのボクセル幅（モデル座標）
+    voxel = 2 * model.renderer.cfg.radius / (args.mc_resolution - 1)
+    max_chamfer = args.max_chamfer_voxels * voxel
+
+    failed = []
+    for path in images:
+        name = os.path.basename(path)
+        image = load_image(path, rembg_session, args.foreground_ratio)
+
+        model.set_inference_dtype(None)
+        ref_codes, ref_mesh, ref_time, ref_memory = run(model, image, args.device, args.mc_resolution)
+        print(f"{name} float32: {ref_time:.2f}s" + (f", peak {ref_memory:.0f}MB" if ref_memory else ""))
+
+        for variant, variant_model, dtype in variants:
+            variant_model.set_inference_dtype(dtype)
+            codes, mesh, elapsed, memory = run(variant_model, image, args.device, args.mc_resolution)
+            rel_error = ((codes - ref_codes).norm() / ref_codes.norm()).item()
+            max_error = (codes - ref_codes).abs().max().item()
+            chamfer = chamfer_distance(mesh, ref_mesh)
+            color_error = vertex_color_error(mesh, ref_mesh)
+            ok = chamfer <= max_chamfer
+            if not ok:
+                failed.append(f"{name} ({variant})")
+            print(
+                f"{name} {variant}: {elapsed:.2f}s ({ref_time / elapsed:.2f}x)"
+                + (f", peak {memory:.0f}MB" if memory else "")
+                + f", scene code rel. error {rel_error:.2e} (max {max_error:.2e})"
+                + f", chamfer {chamfer:.2e} ({chamfer / voxel:.2f} voxels)"
+                + f", vertex color error {color_error:.4f}"
+                + f", faces {len(mesh.faces)} vs {len(ref_mesh.faces)}"
+                + ("" if ok else " FAILED")
+            )
+
+    if failed:
+        print(f"Chamfer distance above {args.max_chamfer_voxels} voxels: {', '.join(failed)}")
+        sys.exit(1)
+    print(f"All meshes within {args.max_chamfer_voxels} voxels (Chamfer) of float32.")
+
+
+if __name__ == "__main__":
+    main()
@@ -12,26 +12,25 @@ from functools import partial
 
 from tsr.system import TSR
 from tsr.utils import remove_background, resize_foreground, to_gradio_3d_orientation
+from tsr_pipeline.background_removal import BackgroundRemovalPool
+from tsr_pipeline.batching import BatchScheduler
+from tsr_pipeline.cli import parse_size
+from tsr_pipeline.scene_cache import SceneCodeCache
 
 import argparse
 
 
-if torch.cuda.is_available():
-    device = "cuda:0"
-else:
-    device = "cpu"
-
-model = TSR.from_pretrained(
-    "stabilityai/TripoSR",
-    config_name="config.yaml",
-    weight_name="model.ckpt",
-)
-
-# adjust the chunk size to balance between speed and memory usage
-model.renderer.set_chunk_size(8192)
-model.to(device)
-
-rembg_session = rembg.new_session()
+# set up in main(), so that the background removal worker processes, which
+# re-import this module, do not load the model or build the UI
+device = None
+model = None
+rembg_session = None
+# optional scene code cache, enabled with --cache-dir
+scene_code_cache = None
+# optional background removal worker processes, enabled with --bg-removal-workers
+bg_removal_pool = None
+# collects concurrent requests into batches, configured with --batch-size and --batch-window
+batch_scheduler = None
 
 
 def check_input_image(input_image):
@@ -48,7 +47,10 @@ def preprocess(input_image, do_remove_background, foreground_ratio):
 
     if do_remove_background:
         image = input_image.convert("RGB")
-        image = remove_background(image, rembg_session)
+        if bg_removal_pool is not None:
+            image = bg_removal_pool.remove(image)
+        else:
+            image = remove_background(image, rembg_session)
         image = resize_foreground(image, foreground_ratio)
         image = fill_background(image)
     else:
@@ -58,15 +60,36 @@ def preprocess(input_image, do_remove_background, foreground_ratio):
     return image
 
 
+def generate_batch(requests):
+    # one batched forward pass for all requests, then mesh extraction with the
+    # resolution of each request
+    images = [image for image, _, _ in requests]
+    with torch.no_grad():
+        if scene_code_cache is not None:
+            scene_codes = scene_code_cache.run_model(model, images, device)
+            scene_code_cache.log_stats()
+        else:
+            scene_codes = model(images, device=device)
+    results = []
+    for scene_code, (_, mc_resolution, formats) in zip(scene_codes, requests):
+        try:
+            mesh = model.extract_mesh(scene_code[None].to(device), True, resolution=mc_resolution)[0]
+            mesh = to_gradio_3d_orientation(mesh)
+            rv = []
+            for format in formats:
+                mesh_path = tempfile.NamedTemporaryFile(suffix=f".{format}", delete=False)
+                mesh.export(mesh_path.name)
+                rv.append(mesh_path.name)
+            results.append(rv)
+        except Exception as e:
+            logging.exception("Failed to extract the mesh")
+            results.append(e)
+    return results
+
+
 def generate(image, mc_resolution, formats=["obj", "glb"]):
-    scene_codes = model(image, device=device)
-    mesh = model.extract_mesh(scene_codes, True, resolution=mc_resolution)[0]
-    mesh = to_gradio_3d_orientation(mesh)
-    rv = []
-    for format in formats:
-        mesh_path = tempfile.NamedTemporaryFile(suffix=f".{format}", delete=False)
-        mesh.export(mesh_path.name)
-        rv.append(mesh_path.name)
+    rv = batch_scheduler.submit((image, mc_resolution, formats)).result()
+    batch_scheduler.log_stats()
     return rv
 
 
@@ -76,112 +99,164 @@ def run_example(image_pil):
     return preprocessed, mesh_name_obj, mesh_name_glb
 
 
-with gr.Blocks(title="TripoSR") as interface:
-    gr.Markdown(
-        """
-    # TripoSR Demo
-    [TripoSR](https://github.com/VAST-AI-Research/TripoSR) is a state-of-the-art open-source model for **fast** feedforward 3D reconstruction from a single image, collaboratively developed by [Tripo AI](https://www.tripo3d.ai/) and [Stability AI](https://stability.ai/).
+def build_interface():
+    with gr.Blocks(title="TripoSR") as interface:
+        gr.Markdown(
+            """
+        # TripoSR Demo
+        [TripoSR](https://github.com/VAST-AI-Research/TripoSR) is a state-of-the-art open-source model for **fast** feedforward 3D reconstruction from a single image, collaboratively developed by [Tripo AI](https://www.tripo3d.ai/) and [Stability AI](https://stability.ai/).
     
-    **Tips:**
-    1. If you find the result is unsatisfied, please try to change the foreground ratio. It might improve the results.
-    2. It's better to disable "Remove Background" for the provided examples (except fot the last one) since they have been already preprocessed.
-    3. Otherwise, please disable "Remove Background" option only if your input image is RGBA with transparent background, image contents are centered and occupy more than 70% of image width or height.
-    """
-    )
-    with gr.Row(variant="panel"):
-        with gr.Column():
-            with gr.Row():
-                input_image = gr.Image(
-                    label="Input Image",
-                    image_mode="RGBA",
-                    sources="upload",
-                    type="pil",
-                    elem_id="content_image",
-                )
-                processed_image = gr.Image(label="Processed Image", interactive=False)
-            with gr.Row():
-                with gr.Group():
-                    do_remove_background = gr.Checkbox(
-                        label="Remove Background", value=True
+        **Tips:**
+        1. If you find the result is unsatisfied, please try to change the foreground ratio. It might improve the results.
+        2. It's better to disable "Remove Background" for the provided examples (except fot the last one) since they have been already preprocessed.
+        3. Otherwise, please disable "Remove Background" option only if your input image is RGBA with transparent background, image contents are centered and occupy more than 70% of image width or height.
+        """
+        )
+        with gr.Row(variant="panel"):
+            with gr.Column():
+                with gr.Row():
+                    input_image = gr.Image(
+                        label="Input Image",
+                        image_mode="RGBA",
+                        sources="upload",
+                        type="pil",
+                        elem_id="content_image",
                     )
-                    foreground_ratio = gr.Slider(
-                        label="Foreground Ratio",
-                        minimum=0.5,
-                        maximum=1.0,
-                        value=0.85,
-                        step=0.05,
+                    processed_image = gr.Image(label="Processed Image", interactive=False)
+                with gr.Row():
+                    with gr.Group():
+                        do_remove_background = gr.Checkbox(
+                            label="Remove Background", value=True
+                        )
+                        foreground_ratio = gr.Slider(
+                            label="Foreground Ratio",
+                            minimum=0.5,
+                            maximum=1.0,
+                            value=0.85,
+                            step=0.05,
+                        )
+                        mc_resolution = gr.Slider(
+                            label="Marching Cubes Resolution",
+                            minimum=32,
+                            maximum=320,
+                            value=256,
+                            step=32
+                        )
+                with gr.Row():
+                    submit = gr.Button("Generate", elem_id="generate", variant="primary")
+            with gr.Column():
+                with gr.Tab("OBJ"):
+                    output_model_obj = gr.Model3D(
+                        label="Output Model (OBJ Format)",
+                        interactive=False,
                     )
-                    mc_resolution = gr.Slider(
-                        label="Marching Cubes Resolution",
-                        minimum=32,
-                        maximum=320,
-                        value=256,
-                        step=32
+                    gr.Markdown("Note: The model shown here is flipped. Download to get correct results.")
+                with gr.Tab("GLB"):
+                    output_model_glb = gr.Model3D(
+                        label="Output Model (GLB Format)",
+                        interactive=False,
                     )
-            with gr.Row():
-                submit = gr.Button("Generate", elem_id="generate", variant="primary")
-        with gr.Column():
-            with gr.Tab("OBJ"):
-                output_model_obj = gr.Model3D(
-                    label="Output Model (OBJ Format)",
-                    interactive=False,
-                )
-                gr.Markdown("Note: The model shown here is flipped. Download to get correct results.")
-            with gr.Tab("GLB"):
-                output_model_glb = gr.Model3D(
-                    label="Output Model (GLB Format)",
-                    interactive=False,
-                )
-                gr.Markdown("Note: The model shown here has a darker appearance. Download to get correct results.")
-    with gr.Row(variant="panel"):
-        gr.Examples(
-            examples=[
-                "examples/hamburger.png",
-                "examples/poly_fox.png",
-                "examples/robot.png",
-                "examples/teapot.png",
-                "examples/tiger_girl.png",
-                "examples/horse.png",
-                "examples/flamingo.png",
-                "examples/unicorn.png",
-                "examples/chair.png",
-                "examples/iso_house.png",
-                "examples/marble.png",
-                "examples/police_woman.png",
-                "examples/captured.jpeg",
-            ],
-            inputs=[input_image],
-            outputs=[processed_image, output_model_obj, output_model_glb],
-            cache_examples=False,
-            fn=partial(run_example),
-            label="Examples",
-            examples_per_page=20,
+                    gr.Markdown("Note: The model shown here has a darker appearance. Download to get correct results.")
+                with gr.Accordion("Batching Stats", open=False):
+                    batching_stats = gr.JSON(label="Queue depth, batch sizes and latency")
+                    refresh_stats = gr.Button("Refresh")
+        with gr.Row(variant="panel"):
+            gr.Examples(
+                examples=[
+                    "examples/hamburger.png",
+                    "examples/poly_fox.png",
+                    "examples/robot.png",
+                    "examples/teapot.png",
+                    "examples/tiger_girl.png",
+                    "examples/horse.png",
+                    "examples/flamingo.png",
+                    "examples/unicorn.png",
+                    "examples/chair.png",
+                    "examples/iso_house.png",
+                    "examples/marble.png",
+                    "examples/police_woman.png",
+                    "examples/captured.jpeg",
+                ],
+                inputs=[input_image],
+                outputs=[processed_image, output_model_obj, output_model_glb],
+                cache_examples=False,
+                fn=partial(run_example),
+                label="Examples",
+                examples_per_page=20,
+            )
+        submit.click(fn=check_input_image, inputs=[input_image]).success(
+            fn=preprocess,
+            inputs=[input_image, do_remove_background, foreground_ratio],
+            outputs=[processed_image],
+        ).success(
+            fn=generate,
+            inputs=[processed_image, mc_resolution],
+            outputs=[output_model_obj, output_model_glb],
         )
-    submit.click(fn=check_input_image, inputs=[input_image]).success(
-        fn=preprocess,
-        inputs=[input_image, do_remove_background, foreground_ratio],
-        outputs=[processed_image],
-    ).success(
-        fn=generate,
-        inputs=[processed_image, mc_resolution],
-        outputs=[output_model_obj, output_model_glb],
-    )
+        refresh_stats.click(fn=batch_scheduler.stats, outputs=[batching_stats])
+    return interface
 
 
+def main():
+    global device, model, rembg_session, scene_code_cache, bg_removal_pool, batch_scheduler
 
-if __name__ == '__main__':
     parser = argparse.ArgumentParser()
     parser.add_argument('--username', type=str, default=None, help='Username for authentication')
     parser.add_argument('--password', type=str, default=None, help='Password for authentication')
     parser.add_argument('--port', type=int, default=7860, help='Port to run the server listener on')
     parser.add_argument("--listen", action='store_true', help="launch gradio with 0.0.0.0 as server name, allowing to respond to network requests")
     parser.add_argument("--share", action='store_true', help="use share=True for gradio and make the UI accessible through their site")
-    parser.add_argument("--queuesize", type=int, default=1, help="launch gradio queue max_size")
+    parser.add_argument("--queuesize", type=int, default=16, help="launch gradio queue max_size")
+    parser.add_argument("--batch-size", type=int, default=4, help="maximum number of concurrent requests to run through the model in one batch")
+    parser.add_argument("--batch-window", type=float, default=50.0, help="milliseconds to wait after the first request for more requests to batch with it")
+    parser.add_argument("--cache-dir", type=str, default=None, help="cache scene codes of preprocessed images in this directory")
+    parser.add_argument("--cache-max-size", type=parse_size, default="2G", help="maximum total size of the scene code cache, e.g. '512M' or '2G'")
+    parser.add_argument("--bg-removal-workers", type=int, default=0, help="remove backgrounds in this many worker processes, each with its own rembg session")
+    parser.add_argument("--bg-removal-threads", type=int, default=1, help="number of onnxruntime threads per background removal worker")
     args = parser.parse_args()
-    interface.queue(max_size=args.queuesize)
+
+    if torch.cuda.is_available():
+        device = "cuda:0"
+    else:
+        device = "cpu"
+
+    model = TSR.from_pretrained(
+        "stabilityai/TripoSR",
+        config_name="config.yaml",
+        weight_name="model.ckpt",
+    )
+
+    # adjust the chunk size to balance between speed and memory usage
+    model.renderer.set_chunk_size(8192)
+    model.to(device)
+
+    if args.bg_removal_workers > 0:
+        bg_removal_pool = BackgroundRemovalPool(args.bg_removal_workers, args.bg_removal_threads)
+    else:
+        rembg_session = rembg.new_session()
+    if args.cache_dir is not None:
+        scene_code_cache = SceneCodeCache(args.cache_dir, max_bytes=args.cache_max_size)
+    batch_scheduler = BatchScheduler(
+        generate_batch,
+        max_batch_size=args.batch_size,
+        max_wait=args.batch_window / 1000.0,
+    )
+
+    interface = build_interface()
+    # let up to --batch-size generate calls wait on the scheduler at the same time
+    interface.queue(max_size=args.queuesize, default_concurrency_limit=max(1, args.batch_size))
     interface.launch(
         auth=(args.username, args.password) if (args.username and args.password) else None,
         share=args.share,
         server_name="0.0.0.0" if args.listen else None, 
         server_port=args.port
-    )
\ No newline at end of file
+    )
+    batch_scheduler.shutdown()
+    batch_scheduler.log_stats()
+    if bg_removal_pool is not None:
+        bg_removal_pool.log_stats()
+        bg_removal_pool.shutdown()
+
+
+if __name__ == '__main__':
+    main()
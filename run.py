@@ -1,189 +1,46 @@
 import logging
 import os
+from functools import partial
 
-import numpy as np
-import rembg
-import torch
-import trimesh
-import xatlas
-from PIL import Image
-
-from tsr.system import TSR
-from tsr.utils import remove_background, resize_foreground, save_video
-from tsr.bake_texture import bake_texture
+from tsr_pipeline.background_removal import BackgroundRemovalPool
 from tsr_pipeline.cli import parse_args
-from tsr_pipeline.timer import Timer
-
-
-# グローバルTimerインスタンスを作成
-timer = Timer()
+from tsr_pipeline.inference import (
+    bg_removal_and_normalize_image,
+    generate_3d_mesh_from_scene_code,
+    get_device,
+    load_model,
+    run_model_on_batch,
+)
+from tsr_pipeline.prefetch import prefetch_map
+from tsr_pipeline.scene_cache import SceneCodeCache
 
 
-def bg_removal_and_normalize_image(image_path, output_dir, image_index, no_remove_bg, foreground_ratio, rembg_session):
-    """背景除去と画像正規化処理を行う
-    
-    Args:
-        image_path: 入力画像のパス
-        output_dir: 出力ディレクトリ
-        image_index: 画像のインデックス
-        no_remove_bg: 背景除去をスキップするかどうか
-        foreground_ratio: 前景のサイズ比率
-        rembg_session: rembgのセッション（背景除去する場合）
+def generate_3d_meshes_from_images(images, image_indices, model, device, output_dir, args, scene_code_cache=None):
+    """画像のバッチから3Dメッシュを生成する
     
-    Returns:
-        前処理済みの画像（PIL.ImageまたはNumPy配列）
-    """
-    if no_remove_bg:
-        # 背景除去なし：単純に画像を読み込んでRGB変換
-        return np.array(Image.open(image_path).convert("RGB"))
-    else:
-        # 背景除去あり：背景除去、前景調整、アルファチャンネル処理
-        image = remove_background(Image.open(image_path), rembg_session)
-        image = resize_foreground(image, foreground_ratio)
-        image = np.array(image).astype(np.float32) / 255.0
-        
-        # アルファチャンネル処理（透明部分をグレーに）
-        image = image[:, :, :3] * image[:, :, 3:4] + (1 - image[:, :, 3:4]) * 0.5
-        image = Image.fromarray((image * 255.0).astype(np.uint8))
-        
-        # 出力ディレクトリの作成と前処理済み画像の保存
-        output_path = os.path.join(output_dir, str(image_index))
-        if not os.path.exists(output_path):
-            os.makedirs(output_path)
-        image.save(os.path.join(output_path, "input.png"))
-        
-        return image
-
-
-def export_glb_with_texture(out_mesh_path, out_texture_path, mesh, bake_output):
-    """GLB形式でUV座標付きメッシュとテクスチャを出力する
+    Triplane の生成はバッチ全体で1回だけ行い、その後 scene_codes を
+    1画像ずつに分けてメッシュ抽出・ベイキング・出力を行う。
     
     Args:
-        out_mesh_path: GLBファイルの出力パス
-        out_texture_path: テクスチャ画像の出力パス
-        mesh: 元のtrimeshオブジェクト
-        bake_output: bake_texture関数の出力辞書
-    """
-    # テクスチャ画像の準備と保存
-    texture_array = (bake_output["colors"] * 255.0).astype(np.uint8)
-    texture_image = Image.fromarray(texture_array).transpose(Image.FLIP_TOP_BOTTOM)
-    texture_image.save(out_texture_path)
-    
-    # マテリアルを作成（テクスチャ画像オブジェクトを使用）
-    material = trimesh.visual.material.PBRMaterial(
-        baseColorTexture=texture_image,  # Imageオブジェクトを直接渡す
-        baseColorFactor=[1.0, 1.0, 1.0, 1.0],
-        metallicFactor=0.0,
-        roughnessFactor=1.0
-    )
-    
-    # UV座標付きのビジュアルを作成
-    texture_visual = trimesh.visual.TextureVisuals(
-        uv=bake_output["uvs"],
-        material=material
-    )
-    
-    # 新しいメッシュを作成（法線を明示的に設定）
-    # 元のメッシュから法線を取得（なければ自動計算される）
-    original_normals = mesh.vertex_normals[bake_output["vmapping"]]
-    
-    textured_mesh = trimesh.Trimesh(
-        vertices=mesh.vertices[bake_output["vmapping"]],
-        faces=bake_output["indices"],
-        vertex_normals=original_normals,  # 法線を明示的に設定
-        visual=texture_visual  # visualも同時に設定
-    )
-    
-    # GLB形式で出力
-    # 注: trimeshのバグにより、TextureVisualsとvertex_normalsの両方が
-    # GLBに正しく出力されない可能性があります（trimesh issue #1296）
-    textured_mesh.export(out_mesh_path)
-
-
-def generate_3d_mesh_from_image(image, image_index, model, device, output_dir, args):
-    """画像から3Dメッシュを生成する
-    
-    処理フロー:
-    1. 画像 → Triplane（3D潜在表現）を生成
-    2. [オプション] 多視点レンダリング
-    3. Triplane → 3Dメッシュを抽出
-    4. [オプション] テクスチャベイキング
-    5. ファイル出力（OBJ/GLB）
-    
-    Args:
-        image: 前処理済み画像
-        image_index: 画像インデックス
+        images: 前処理済み画像のリスト
+        image_indices: 各画像のインデックスのリスト
         model: TSRモデル
         device: 実行デバイス
         output_dir: 出力ディレクトリ
         args: コマンドライン引数
+        scene_code_cache: SceneCodeCache（省略時はキャッシュを使わない）
     """
-    logging.info(f"Running image {image_index + 1} ...")
-    
-    # ========== Step 1: 2D画像から3D表現（Triplane）を生成 ==========
-    # Transformerモデルで画像をTriplane（3つの平面で表現された3D潜在表現）に変換
-    timer.start("Running model")
-    with torch.no_grad():
-        scene_codes = model([image], device=device)
-    timer.end("Running model")
+    # ========== 2D画像から3D表現（Triplane）をバッチで生成 ==========
+    scene_codes = run_model_on_batch(
+        images, [i + 1 for i in image_indices], model, device, scene_code_cache
+    )
     
-    # ========== Step 2: [オプション] 多視点レンダリング ==========
-    # 生成した3Dモデルを30の異なる視点から見た画像を作成
-    if args.render:
-        timer.start("Rendering")
-        render_images = model.render(scene_codes, n_views=30, return_type="pil")
-        # 各視点の画像を保存（render_000.png 〜 render_029.png）
-        for ri, render_image in enumerate(render_images[0]):
-            render_image.save(os.path.join(output_dir, str(image_index), f"render_{ri:03d}.png"))
-        # 回転アニメーション動画も生成
-        save_video(
-            render_images[0], os.path.join(output_dir, str(image_index), f"render.mp4"), fps=30
+    # ========== 画像ごとにメッシュを生成 ==========
+    for j, image_index in enumerate(image_indices):
+        logging.info(f"Exporting image {image_index + 1} ...")
+        generate_3d_mesh_from_scene_code(
+            scene_codes[j][None].to(device), image_index, model, output_dir, args
         )
-        timer.end("Rendering")
-    
-    # ========== Step 3: Triplaneから3Dメッシュを抽出 ==========
-    # マーチングキューブアルゴリズムで3D密度場から表面メッシュを生成
-    timer.start("Extracting mesh")
-    meshes = model.extract_mesh(scene_codes, not args.bake_texture, resolution=args.mc_resolution)
-    timer.end("Extracting mesh")
-    
-    # ========== Step 4 & 5: メッシュの出力（テクスチャ有無で処理分岐）==========
-    out_mesh_path = os.path.join(output_dir, str(image_index), f"mesh.{args.model_save_format}")
-    
-    if args.bake_texture:
-        # テクスチャベイキングあり：UV展開してテクスチャアトラスを生成
-        out_texture_path = os.path.join(output_dir, str(image_index), "texture.png")
-        
-        # UV展開とテクスチャ色の計算
-        timer.start("Baking texture")
-        bake_output = bake_texture(meshes[0], model, scene_codes[0], args.texture_resolution)
-        timer.end("Baking texture")
-        
-        # 出力形式による分岐
-        timer.start("Exporting mesh and texture")
-        
-        if args.model_save_format == "glb":
-            # GLB形式での出力（UV座標付きメッシュとテクスチャを別々に保存）
-            try:
-                export_glb_with_texture(out_mesh_path, out_texture_path, meshes[0], bake_output)
-            except Exception as e:
-                logging.error(f"Failed to export GLB with texture: {e}")
-                logging.info("Falling back to OBJ format...")
-                # フォールバック：OBJ形式で出力
-                out_mesh_path = out_mesh_path.replace(".glb", ".obj")
-                xatlas.export(out_mesh_path, meshes[0].vertices[bake_output["vmapping"]], bake_output["indices"], bake_output["uvs"], meshes[0].vertex_normals[bake_output["vmapping"]])
-                Image.fromarray((bake_output["colors"] * 255.0).astype(np.uint8)).transpose(Image.FLIP_TOP_BOTTOM).save(out_texture_path)
-        else:
-            # OBJ形式での出力（既存処理）
-            xatlas.export(out_mesh_path, meshes[0].vertices[bake_output["vmapping"]], bake_output["indices"], bake_output["uvs"], meshes[0].vertex_normals[bake_output["vmapping"]])
-            Image.fromarray((bake_output["colors"] * 255.0).astype(np.uint8)).transpose(Image.FLIP_TOP_BOTTOM).save(out_texture_path)
-        
-        timer.end("Exporting mesh and texture")
-    else:
-        # テクスチャベイキングなし：頂点カラー付きメッシュを直接出力
-        timer.start("Exporting mesh")
-        meshes[0].export(out_mesh_path)
-        timer.end("Exporting mesh")
 
 
 def main(args):
@@ -197,49 +54,74 @@ def main(args):
     os.makedirs(output_dir, exist_ok=True)
     
     # デバイスの設定
-    device = args.device
-    if not torch.cuda.is_available():
-        device = "cpu"
-        logging.info(f"CUDA not available, using CPU")
+    device = get_device(args.device)
     
     # モデルの初期化
-    timer.start("Initializing model")
-    model = TSR.from_pretrained(
-        args.pretrained_model_name_or_path,
-        config_name="config.yaml",
-        weight_name="model.ckpt",
+    model = load_model(args, device)
+    
+    # rembgセッション（またはプロセスプール）の初期化
+    rembg_session = None
+    bg_removal_pool = None
+    if not args.no_remove_bg:
+        if args.bg_removal_workers > 0:
+            bg_removal_pool = BackgroundRemovalPool(
+                num_workers=args.bg_removal_workers,
+                num_threads_per_worker=args.bg_removal_threads,
+            )
+        else:
+            # rembg（onnxruntime）は背景除去する場合にのみ読み込む
+            import rembg
+
+            rembg_session = rembg.new_session()
+    
+    # scene_codes キャッシュの初期化
+    scene_code_cache = None
+    if args.cache_dir is not None:
+        scene_code_cache = SceneCodeCache(args.cache_dir, max_bytes=args.cache_max_size)
+    
+    # 背景除去・正規化をワーカープールで先行実行し、推論と並行させる
+    # （保持する前処理済み画像は最大 --prefetch-depth 枚。ただし全ワーカーが
+    # 同時に働けるよう、ワーカー数より少なくはしない）
+    preprocess = partial(
+        bg_removal_and_normalize_image,
+        output_dir=output_dir,
+        no_remove_bg=args.no_remove_bg,
+        foreground_ratio=args.foreground_ratio,
+        rembg_session=rembg_session,
+        bg_removal_pool=bg_removal_pool,
+    )
+    # プロセスプールを使う場合は全ワーカーに仕事が行き渡るだけのスレッドを用意する
+    num_preprocess_workers = max(args.preprocess_workers, args.bg_removal_workers)
+    preprocessed_images = prefetch_map(
+        lambda item: (item[0], preprocess(image_path=item[1], image_index=item[0])),
+        enumerate(args.image),
+        num_workers=num_preprocess_workers,
+        queue_depth=max(args.prefetch_depth, num_preprocess_workers),
     )
-    model.renderer.set_chunk_size(args.chunk_size)
-    model.to(device)
-    timer.end("Initializing model")
-    
-    # 画像の前処理
-    timer.start("Processing images")
-    images = []
-    
-    # rembgセッションの初期化
-    if args.no_remove_bg:
-        rembg_session = None
-    else:
-        rembg_session = rembg.new_session()
-    
-    # 各画像を背景除去・正規化
-    for i, image_path in enumerate(args.image):
-        image = bg_removal_and_normalize_image(
-            image_path=image_path,
-            output_dir=output_dir,
-            image_index=i,
-            no_remove_bg=args.no_remove_bg,
-            foreground_ratio=args.foreground_ratio,
-            rembg_session=rembg_session
-        )
-        images.append(image)
-    
-    timer.end("Processing images")
     
-    # 各画像から3Dメッシュを生成
-    for i, image in enumerate(images):
-        generate_3d_mesh_from_image(image, i, model, device, output_dir, args)
+    # --batch-size 枚ずつまとめて3Dメッシュを生成
+    batch_size = max(1, args.batch_size)
+    batch_indices, batch_images = [], []
+    for i, image in preprocessed_images:
+        batch_indices.append(i)
+        batch_images.append(image)
+        if len(batch_images) == batch_size or i == len(args.image) - 1:
+            generate_3d_meshes_from_images(
+                batch_images, batch_indices, model, device, output_dir, args,
+                scene_code_cache=scene_code_cache,
+            )
+            batch_indices, batch_images = [], []
+    
+    # --chunk-size auto で決まったチャンクサイズ（実行中に縮小された場合はその値）
+    for chunk_device, chunk_size in model.renderer.auto_chunk_sizes.items():
+        logging.info(f"Auto chunk size on {chunk_device}: {chunk_size}")
+    
+    if scene_code_cache is not None:
+        scene_code_cache.log_stats()
+    
+    if bg_removal_pool is not None:
+        bg_removal_pool.log_stats()
+        bg_removal_pool.shutdown()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,81 @@
+import pytest
+import torch
+
+from tsr.models.transformer.attention import (
+    Attention,
+    AttnProcessor,
+    AttnProcessor2_0,
+    FusedAttnProcessor,
+    FusedAttnProcessor2_0,
+)
+
+PROCESSORS = [
+    (AttnProcessor, FusedAttnProcessor),
+    (AttnProcessor2_0, FusedAttnProcessor2_0),
+]
+
+
+def make_attention(cross_attention, bias, processor_cls):
+    torch.manual_seed(0)
+    return Attention(
+        query_dim=32,
+        cross_attention_dim=24 if cross_attention else None,
+        heads=4,
+        dim_head=8,
+        bias=bias,
+        processor=processor_cls(),
+    ).eval()
+
+
+def run(attn, cross_attention):
+    generator = torch.Generator().manual_seed(1)
+    hidden_states = torch.randn(2, 10, 32, generator=generator)
+    encoder_hidden_states = (
+        torch.randn(2, 7, 24, generator=generator) if cross_attention else None
+    )
+    with torch.no_grad():
+        return attn(hidden_states, encoder_hidden_states=encoder_hidden_states)
+
+
+@pytest.mark.parametrize("processor_cls, fused_processor_cls", PROCESSORS)
+@pytest.mark.parametrize("bias", [False, True])
+@pytest.mark.parametrize("cross_attention", [False, True])
+def test_fuse_projections_keeps_outputs(
+    cross_attention, bias, processor_cls, fused_processor_cls
+):
+    attn = make_attention(cross_attention, bias, processor_cls)
+    reference = run(attn, cross_attention)
+
+    attn.fuse_projections()
+    attn.set_processor(fused_processor_cls())
+    torch.testing.assert_close(run(attn, cross_attention), reference)
+
+
+@pytest.mark.parametrize("bias", [False, True])
+@pytest.mark.parametrize("cross_attention", [False, True])
+def test_fuse_projections_removes_unfused_layers(cross_attention, bias):
+    attn = make_attention(cross_attention, bias, AttnProcessor)
+    state_dict = {k: v.clone() for k, v in attn.state_dict().items()}
+
+    attn.fuse_projections()
+    assert attn.to_k is None and attn.to_v is None
+    if cross_attention:
+        # the query of cross-attention is not fused and keeps its layer
+        assert attn.to_q is not None and not hasattr(attn, "to_qkv")
+        fused_names = {"to_kv"}
+    else:
+        assert attn.to_q is None and not hasattr(attn, "to_kv")
+        fused_names = {"to_qkv"}
+    names = {k.split(".")[0] for k in attn.state_dict()}
+    assert not names & {"to_k", "to_v"} and fused_names <= names
+    # no weight is kept twice
+    assert sum(p.numel() for p in attn.parameters()) == sum(
+        v.numel() for v in state_dict.values()
+    )
+
+    # unfusing splits the fused layer back into the original projections
+    attn.fuse_projections(False)
+    assert not hasattr(attn, "to_qkv") and not hasattr(attn, "to_kv")
+    assert attn.state_dict().keys() == state_dict.keys()
+    for k, v in attn.state_dict().items():
+        assert torch.equal(v, state_dict[k]), k
@@ -1,12 +1,11 @@
 import numpy as np
 import torch
-import xatlas
-import trimesh
-import moderngl
 from PIL import Image
 
 
 def make_atlas(mesh, texture_resolution, texture_padding):
+    import xatlas
+
     atlas = xatlas.Atlas()
     atlas.add_mesh(mesh.vertices, mesh.faces)
     options = xatlas.PackOptions()
@@ -25,6 +24,8 @@ def make_atlas(mesh, texture_resolution, texture_padding):
 def rasterize_position_atlas(
     mesh, atlas_vmapping, atlas_indices, atlas_uvs, texture_resolution, texture_padding
 ):
+    import moderngl
+
     ctx = moderngl.create_context(standalone=True)
     basic_prog = ctx.program(
         vertex_shader="""
@@ -134,19 +135,32 @@ def rasterize_position_atlas(
     return fbo_np
 
 
-def positions_to_colors(model, scene_code, positions_texture, texture_resolution):
-    positions = torch.tensor(
-        positions_texture.reshape(-1, 4)[:, :-1], device=scene_code.device
-    )
+def positions_to_colors(
+    model, scene_code, positions_texture, texture_resolution, masked=True
+):
+    # Only the texels covered by the atlas (alpha > 0) get a color, so with masked
+    # only their positions are sent to the decoder. The colors are written into a
+    # preallocated texture that stays zero (transparent black) elsewhere.
+    texels = positions_texture.reshape(-1, 4)
+    covered = texels[:, -1] != 0.0
+    rgba_f = np.zeros((texels.shape[0], 4), dtype=np.float32)
+    if masked and not covered.any():
+        # nothing to query, the decoder cannot take an empty batch
+        return rgba_f.reshape(texture_resolution, texture_resolution, 4)
+    queried = texels[covered] if masked else texels
+    positions = torch.tensor(queried[:, :-1], device=scene_code.device)
     with torch.no_grad():
         queried_grid = model.renderer.query_triplane(
             model.decoder,
             positions,
             scene_code,
+            keys=["color"],
         )
     rgb_f = queried_grid["color"].cpu().numpy().reshape(-1, 3)
-    rgba_f = np.insert(rgb_f, 3, positions_texture.reshape(-1, 4)[:, -1], axis=1)
-    rgba_f[rgba_f[:, -1] == 0.0] = [0, 0, 0, 0]
+    if not masked:
+        rgb_f = rgb_f[covered]
+    rgba_f[covered, :3] = rgb_f
+    rgba_f[covered, 3] = texels[covered, 3]
     return rgba_f.reshape(texture_resolution, texture_resolution, 4)
 
 
@@ -168,5 +182,7 @@ def bake_texture(mesh, model, scene_code, texture_resolution):
         "vmapping": atlas["vmapping"],
         "indices": atlas["indices"],
         "uvs": atlas["uvs"],
+        # normals given by extract_mesh are used as is, otherwise computed by trimesh
+        "normals": mesh.vertex_normals[atlas["vmapping"]],
         "colors": colors_texture,
     }
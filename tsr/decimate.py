@@ -0,0 +1,254 @@
+import math
+from typing import Optional
+
+import numpy as np
+import torch
+
+
+def compute_vertex_quadrics(vertices, faces):
+    # area weighted sum of the plane quadrics of the faces around each vertex
+    v0, v1, v2 = vertices[faces[:, 0]], vertices[faces[:, 1]], vertices[faces[:, 2]]
+    normals = torch.linalg.cross(v1 - v0, v2 - v0)
+    double_area = normals.norm(dim=-1, keepdim=True)
+    normals = normals / double_area.clamp_min(1e-20)
+    planes = torch.cat([normals, -(normals * v0).sum(-1, keepdim=True)], dim=-1)
+    face_quadrics = planes[:, :, None] * planes[:, None, :] * (0.5 * double_area)[..., None]
+    quadrics = torch.zeros(
+        (vertices.shape[0], 4, 4), dtype=vertices.dtype, device=vertices.device
+    )
+    for k in range(3):
+        quadrics.index_add_(0, faces[:, k], face_quadrics)
+    return quadrics
+
+
+def quadric_error(quadrics, positions):
+    # errors of positions (N, K, 3) for the quadrics (N, 4, 4), as (N, K)
+    homogeneous = torch.cat([positions, torch.ones_like(positions[..., :1])], dim=-1)
+    return (torch.bmm(homogeneous, quadrics) * homogeneous).sum(-1)
+
+
+def unique_edges(faces, num_vertices):
+    # undirected edges, the number of faces sharing each edge and the sorted edge keys
+    start = faces.reshape(-1)
+    end = faces[:, [1, 2, 0]].reshape(-1)
+    keys, counts = torch.unique(
+        torch.minimum(start, end) * num_vertices + torch.maximum(start, end),
+        return_counts=True,
+    )
+    edges = torch.stack([keys // num_vertices, keys % num_vertices], dim=-1)
+    return edges, counts, keys
+
+
+def count_common_neighbors(a, b, edges, keys, num_vertices):
+    # number of vertices adjacent to both a and b, for each pair (a, b), by
+    # looking up the edge from b to every neighbor of a
+    src, order = torch.sort(torch.cat([edges[:, 0], edges[:, 1]]))
+    dst = torch.cat([edges[:, 1], edges[:, 0]])[order]
+    degree = torch.bincount(src, minlength=num_vertices)
+    start = torch.cumsum(degree, 0) - degree
+    num_neighbors = degree[a]
+    owner = torch.repeat_interleave(
+        torch.arange(a.shape[0], device=a.device), num_neighbors
+    )
+    offset = torch.arange(owner.shape[0], device=a.device) - torch.repeat_interleave(
+        torch.cumsum(num_neighbors, 0) - num_neighbors, num_neighbors
+    )
+    neighbor = dst[start[a][owner] + offset]
+    other = b[owner]
+    pair_keys = (
+        torch.minimum(neighbor, other) * num_vertices + torch.maximum(neighbor, other)
+    )
+    index = torch.searchsorted(keys, pair_keys).clamp_max(keys.shape[0] - 1)
+    found = (keys[index] == pair_keys) & (neighbor != other)
+    return torch.bincount(owner[found], minlength=a.shape[0])
+
+
+def select_collapses(
+    vertices,
+    faces,
+    quadrics,
+    locked,
+    max_collapses,
+    min_normal_cos,
+    generator,
+    pool_factor=4,
+    pool_fraction=0.25,
+    rounds=4,
+):
+    # Picks a set of cheap edges whose collapses are independent: no face
+    # touches the vertices of two selected edges, so they can be applied in
+    # parallel. Returns the selected edges, their new positions and quadrics.
+    num_vertices, device = vertices.shape[0], vertices.device
+    edges, counts, keys = unique_edges(faces, num_vertices)
+    a, b = edges[:, 0], edges[:, 1]
+    valid = (counts == 2) & ~locked[a] & ~locked[b]
+
+    # optimal position of the merged vertex, or the best of the end points and
+    # the midpoint if the quadric is singular or the optimum is far away
+    edge_quadrics = quadrics[a] + quadrics[b]
+    va, vb = vertices[a], vertices[b]
+    midpoint = 0.5 * (va + vb)
+    optimum, info = torch.linalg.solve_ex(
+        edge_quadrics[:, :3, :3], -edge_quadrics[:, :3, 3]
+    )
+    reasonable = (info == 0) & torch.isfinite(optimum).all(-1)
+    reasonable &= ((optimum - midpoint) ** 2).sum(-1) <= ((vb - va) ** 2).sum(-1)
+    optimum = torch.where(reasonable[:, None], optimum, midpoint)
+    points = torch.stack([va, vb, midpoint, optimum], dim=1)
+    cost, best = quadric_error(edge_quadrics, points).min(-1)
+    positions = points[torch.arange(edges.shape[0], device=device), best]
+
+    # Candidates are the cheapest valid edges, at most pool_factor times the
+    # number of collapses still needed and pool_fraction of all valid edges.
+    # In random order (Luby's algorithm), an edge is selected if it comes first
+    # among all candidates touching the faces around its two ends; the faces
+    # around the selected edges are then blocked and the selection is repeated
+    # on the remaining candidates.
+    num_valid = int(valid.sum())
+    num_candidates = min(
+        max(1, int(num_valid * pool_fraction)), pool_factor * max_collapses, num_valid
+    )
+    if num_candidates == 0:
+        return edges[:0], positions[:0], edge_quadrics[:0]
+    threshold = torch.kthvalue(cost[valid], num_candidates).values
+    candidates = torch.nonzero(valid & (cost <= threshold))[:, 0]
+    invalid_rank = edges.shape[0]
+    rank = torch.full_like(a, invalid_rank)
+    rank[candidates] = torch.randperm(candidates.shape[0], generator=generator).to(device)
+    selected = torch.zeros_like(valid)
+    for _ in range(rounds):
+        vertex_min = torch.full((num_vertices,), invalid_rank, device=device)
+        vertex_min.scatter_reduce_(0, a, rank, "amin")
+        vertex_min.scatter_reduce_(0, b, rank, "amin")
+        face_min = vertex_min[faces].min(-1).values
+        ring_min = torch.full((num_vertices,), invalid_rank, device=device)
+        ring_min.scatter_reduce_(
+            0, faces.reshape(-1), face_min.repeat_interleave(3), "amin"
+        )
+        picked = (rank < invalid_rank) & (ring_min[a] == rank) & (ring_min[b] == rank)
+        if not picked.any():
+            break
+        selected |= picked
+        touched = torch.zeros(num_vertices, dtype=torch.bool, device=device)
+        touched[edges[picked].reshape(-1)] = True
+        blocked = torch.zeros_like(touched)
+        blocked[faces[touched[faces].any(-1)].reshape(-1)] = True
+        rank[blocked[a] | blocked[b]] = invalid_rank
+
+    # the collapse must not change the topology: the two ends of the edge may
+    # only share the two vertices opposite to the edge (link condition)
+    index = torch.nonzero(selected)[:, 0]
+    common = count_common_neighbors(a[index], b[index], edges, keys, num_vertices)
+    selected[index[common != 2]] = False
+
+    # reject collapses that flip or degenerate a face around the edge
+    vertex_edge = torch.full((num_vertices,), -1, device=device)
+    index = torch.nonzero(selected)[:, 0]
+    vertex_edge[a[index]] = index
+    vertex_edge[b[index]] = index
+    face_edge = vertex_edge[faces]
+    moved = face_edge >= 0
+    kept = moved.sum(-1) == 1
+    old = vertices[faces]
+    new = torch.where(moved[..., None], positions[face_edge.clamp_min(0)], old)
+    old_normals = torch.linalg.cross(old[:, 1] - old[:, 0], old[:, 2] - old[:, 0])
+    new_normals = torch.linalg.cross(new[:, 1] - new[:, 0], new[:, 2] - new[:, 0])
+    cos = (old_normals * new_normals).sum(-1) / (
+        old_normals.norm(dim=-1) * new_normals.norm(dim=-1)
+    ).clamp_min(1e-30)
+    bad = kept & (cos < min_normal_cos)
+    selected[face_edge.max(-1).values[bad]] = False
+
+    index = torch.nonzero(selected)[:, 0]
+    index = index[torch.argsort(cost[index])[:max_collapses]]
+    return edges[index], positions[index], edge_quadrics[index]
+
+
+def decimate_mesh(
+    mesh,
+    target_faces: Optional[int] = None,
+    ratio: Optional[float] = None,
+    vertex_normals: Optional[np.ndarray] = None,
+    min_normal_cos: float = 0.2,
+    max_iterations: int = 200,
+    device: str = "cpu",
+):
+    # Quadric edge collapse simplification (Garland and Heckbert) down to
+    # target_faces, or ratio times the number of faces. Each iteration collapses
+    # a set of independent cheapest edges at once. Vertex colors, and the
+    # vertex_normals if given (e.g. from the density gradient), are interpolated
+    # along the collapsed edges; boundary vertices are kept.
+    import trimesh
+
+    assert (target_faces is None) != (ratio is None), "Specify either target_faces or ratio"
+    if target_faces is None:
+        target_faces = int(math.ceil(len(mesh.faces) * ratio))
+    if len(mesh.faces) <= target_faces:
+        return mesh
+
+    vertices = torch.tensor(
+        np.asarray(mesh.vertices), dtype=torch.float64, device=device
+    )
+    faces = torch.tensor(np.asarray(mesh.faces), dtype=torch.int64, device=device)
+    colors = None
+    if mesh.visual.kind == "vertex":
+        colors = torch.tensor(
+            np.asarray(mesh.visual.vertex_colors), dtype=torch.float64, device=device
+        )
+    normals = None
+    if vertex_normals is not None:
+        normals = torch.tensor(
+            np.asarray(vertex_normals), dtype=torch.float64, device=device
+        )
+    num_vertices = vertices.shape[0]
+
+    quadrics = compute_vertex_quadrics(vertices, faces)
+    generator = torch.Generator().manual_seed(0)
+    edges, counts, _ = unique_edges(faces, num_vertices)
+    locked = torch.zeros(num_vertices, dtype=torch.bool, device=device)
+    locked[edges[counts != 2].reshape(-1)] = True
+
+    for _ in range(max_iterations):
+        if faces.shape[0] <= target_faces:
+            break
+        # each collapse removes two faces
+        max_collapses = max(1, (faces.shape[0] - target_faces) // 2)
+        edges, positions, edge_quadrics = select_collapses(
+            vertices, faces, quadrics, locked, max_collapses, min_normal_cos, generator
+        )
+        if edges.shape[0] == 0:
+            break
+        a, b = edges[:, 0], edges[:, 1]
+        direction = vertices[b] - vertices[a]
+        t = (
+            ((positions - vertices[a]) * direction).sum(-1)
+            / (direction * direction).sum(-1).clamp_min(1e-30)
+        ).clamp(0, 1)[:, None]
+        if colors is not None:
+            colors[a] = (1 - t) * colors[a] + t * colors[b]
+        if normals is not None:
+            normals[a] = torch.nn.functional.normalize(
+                (1 - t) * normals[a] + t * normals[b], dim=-1
+            )
+        vertices[a] = positions
+        quadrics[a] = edge_quadrics
+        remap = torch.arange(num_vertices, device=device)
+        remap[b] = a
+        faces = remap[faces]
+        faces = faces[
+            (faces[:, 0] != faces[:, 1])
+            & (faces[:, 1] != faces[:, 2])
+            & (faces[:, 2] != faces[:, 0])
+        ]
+
+    used, faces = torch.unique(faces, return_inverse=True)
+    return trimesh.Trimesh(
+        vertices=vertices[used].cpu().numpy(),
+        faces=faces.cpu().numpy(),
+        vertex_colors=(
+            colors[used].round().clamp(0, 255).cpu().numpy().astype(np.uint8)
+            if colors is not None
+            else None
+        ),
+        vertex_normals=normals[used].cpu().numpy() if normals is not None else None,
+    )
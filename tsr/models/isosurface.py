@@ -1,9 +1,11 @@
-from typing import Callable, Optional, Tuple
+import math
+from functools import lru_cache
+from typing import Callable, List, Optional, Tuple
 
 import numpy as np
 import torch
 import torch.nn as nn
-from torchmcubes import marching_cubes
+import torch.nn.functional as F
 
 
 class IsosurfaceHelper(nn.Module):
@@ -15,10 +17,19 @@ class IsosurfaceHelper(nn.Module):
 
 
 class MarchingCubeHelper(IsosurfaceHelper):
-    def __init__(self, resolution: int) -> None:
+    def __init__(self, resolution: int, backend: str = "builtin") -> None:
         super().__init__()
         self.resolution = resolution
-        self.mc_func: Callable = marching_cubes
+        self.backend = backend
+        if backend == "builtin":
+            self.mc_func: Optional[Callable] = None
+        elif backend == "torchmcubes":
+            # imported here so that importing tsr.system does not load the extension
+            from torchmcubes import marching_cubes
+
+            self.mc_func = marching_cubes
+        else:
+            raise ValueError(f"Unknown marching cubes backend: {backend}")
         self._grid_vertices: Optional[torch.FloatTensor] = None
 
     @property
@@ -37,16 +48,323 @@ class MarchingCubeHelper(IsosurfaceHelper):
             self._grid_vertices = verts
         return self._grid_vertices
 
+    @property
+    def grid_coords(self) -> torch.FloatTensor:
+        # per-axis coordinates of grid_vertices
+        return torch.linspace(*self.points_range, self.resolution)
+
+    def grid_indices(self, stride: int) -> torch.LongTensor:
+        # indices of a sub-grid with the given stride, always including the last vertex
+        # so that every level covers the full points_range and levels are nested
+        idx = torch.arange(0, self.resolution, stride)
+        if idx[-1] != self.resolution - 1:
+            idx = torch.cat([idx, torch.as_tensor([self.resolution - 1])])
+        return idx
+
+    def grid_vertices_at(self, idx: torch.LongTensor) -> torch.FloatTensor:
+        # vertices of the sub-grid given by idx along every axis, in the same
+        # "ij" ordering as grid_vertices
+        lo, hi = self.points_range
+        coords = lo + idx.float() / (self.resolution - 1.0) * (hi - lo)
+        x, y, z = torch.meshgrid(coords, coords, coords, indexing="ij")
+        return torch.stack([x, y, z], dim=-1).reshape(-1, 3)
+
+    def evaluate_hierarchical(
+        self,
+        func: Callable[[torch.FloatTensor], torch.FloatTensor],
+        coarse_resolution: int = 64,
+        margin: float = 0.0,
+        device: Optional[torch.device] = None,
+    ) -> Tuple[torch.FloatTensor, torch.BoolTensor]:
+        """
+        Evaluate a level function on the full grid coarse-to-fine.
+
+        func maps (N, 3) vertices in points_range to (N,) values whose zero crossing
+        is the isosurface. It is evaluated on a coarse sub-grid first; at every level
+        only cells whose values straddle zero (widened by margin) and their direct
+        neighbours are subdivided and evaluated at the next, twice finer level.
+        All other vertices are filled by trilinear interpolation of the coarser level,
+        which never changes their sign.
+
+        Returns the (resolution, resolution, resolution) values and a mask of the
+        vertices that were actually evaluated.
+        """
+        stride = 1
+        if coarse_resolution > 1:
+            ratio = (self.resolution - 1) / (coarse_resolution - 1)
+            stride = 2 ** max(0, int(math.floor(math.log2(max(ratio, 1.0)))))
+
+        idx = self.grid_indices(stride)
+        n = idx.shape[0]
+        values = func(self.grid_vertices_at(idx).to(device)).view(n, n, n)
+        evaluated = torch.ones_like(values, dtype=torch.bool)
+
+        while stride > 1:
+            v = values[None, None]
+            v_max = F.max_pool3d(v, kernel_size=2, stride=1)
+            v_min = -F.max_pool3d(-v, kernel_size=2, stride=1)
+            active = (v_max > -margin) & (v_min < margin)
+            # dilate by one cell to catch surfaces that pass between coarse samples;
+            # this also covers vertices shared with the previous cell
+            active = F.max_pool3d(active.float(), kernel_size=3, stride=1, padding=1)
+            active = active[0, 0] > 0
+
+            stride //= 2
+            idx_f = self.grid_indices(stride)
+            n_f = idx_f.shape[0]
+            cell = (torch.searchsorted(idx, idx_f, right=True) - 1).clamp(0, n - 2)
+            cell = cell.to(values.device)
+            refine = active[cell][:, cell][:, :, cell]
+
+            # coarse vertices keep their values and evaluation state
+            pos = torch.searchsorted(idx_f, idx).to(values.device)
+            evaluated_f = torch.zeros(
+                (n_f, n_f, n_f), dtype=torch.bool, device=values.device
+            )
+            evaluated_f[pos[:, None, None], pos[None, :, None], pos[None, None, :]] = (
+                evaluated
+            )
+            for dim in range(3):
+                values = _interpolate_axis(values, idx, idx_f, dim)
+
+            todo = refine & ~evaluated_f
+            todo_idx = idx_f.to(values.device)[todo.nonzero()]
+            if todo_idx.shape[0] > 0:
+                lo, hi = self.points_range
+                points = lo + todo_idx.float() / (self.resolution - 1.0) * (hi - lo)
+                values[todo] = func(points).to(values.dtype)
+            evaluated = evaluated_f | todo
+            idx, n = idx_f, n_f
+
+        return values, evaluated
+
+    def vertex_normals(
+        self,
+        values: torch.FloatTensor,
+        v_pos: torch.FloatTensor,
+    ) -> torch.FloatTensor:
+        # unit normals at v_pos (in points_range) pointing out of the surface, from
+        # central differences of values (positive inside) sampled trilinearly
+        lo, hi = self.points_range
+        p = (v_pos - lo) / (hi - lo) * (self.resolution - 1.0)
+        offsets = torch.eye(3, dtype=p.dtype, device=p.device)
+        gradient = torch.stack(
+            [
+                _sample_trilinear(values, p + offset)
+                - _sample_trilinear(values, p - offset)
+                for offset in offsets
+            ],
+            dim=-1,
+        )
+        return F.normalize(-gradient, dim=-1)
+
     def forward(
         self,
         level: torch.FloatTensor,
     ) -> Tuple[torch.FloatTensor, torch.LongTensor]:
-        level = -level.view(self.resolution, self.resolution, self.resolution)
+        return self.marching_cubes(
+            -level.view(self.resolution, self.resolution, self.resolution)
+        )
+
+    def evaluated_cells(self, evaluated: torch.BoolTensor) -> torch.LongTensor:
+        # (M, 3) indices of the cells whose eight corners were all evaluated, from
+        # the mask returned by evaluate_hierarchical; every cell crossing the
+        # isosurface is among them, as interpolation never changes signs
+        n = self.resolution - 1
+        all_evaluated = evaluated[:n, :n, :n].clone()
+        for c in range(1, 8):
+            dx, dy, dz = c & 1, (c >> 1) & 1, (c >> 2) & 1
+            all_evaluated &= evaluated[dx : n + dx, dy : n + dy, dz : n + dz]
+        return all_evaluated.nonzero()
+
+    def marching_cubes(
+        self,
+        values: torch.FloatTensor,
+        cells: Optional[torch.LongTensor] = None,
+    ) -> Tuple[torch.FloatTensor, torch.LongTensor]:
+        # values: (resolution, resolution, resolution), positive inside the surface;
+        # used as is, without copying. cells: optional (M, 3) indices of the only
+        # cells that may cross the surface, e.g. from evaluated_cells
+        if self.backend == "builtin":
+            v_pos, t_pos_idx = sparse_marching_cubes(values.detach(), cells)
+            return v_pos / (self.resolution - 1.0), t_pos_idx
+        # torchmcubes always processes the full grid
         try:
-            v_pos, t_pos_idx = self.mc_func(level.detach(), 0.0)
+            v_pos, t_pos_idx = self.mc_func(values.detach(), 0.0)
         except AttributeError:
             print("torchmcubes was not compiled with CUDA support, use CPU version instead.")
-            v_pos, t_pos_idx = self.mc_func(level.detach().cpu(), 0.0)
+            v_pos, t_pos_idx = self.mc_func(values.detach().cpu(), 0.0)
         v_pos = v_pos[..., [2, 1, 0]]
         v_pos = v_pos / (self.resolution - 1.0)
-        return v_pos.to(level.device), t_pos_idx.to(level.device)
+        return v_pos.to(values.device), t_pos_idx.to(values.device)
+
+
+def _interpolate_axis(
+    values: torch.FloatTensor,
+    src_idx: torch.LongTensor,
+    dst_idx: torch.LongTensor,
+    dim: int,
+) -> torch.FloatTensor:
+    # linearly interpolate values sampled at grid indices src_idx along dim
+    # to grid indices dst_idx; dst_idx must lie within the range of src_idx
+    hi = torch.searchsorted(src_idx, dst_idx).clamp(1, src_idx.shape[0] - 1)
+    lo = hi - 1
+    w = (dst_idx - src_idx[lo]).float() / (src_idx[hi] - src_idx[lo]).float()
+    shape = [1] * values.ndim
+    shape[dim] = -1
+    w = w.view(shape).to(values)
+    lo, hi = lo.to(values.device), hi.to(values.device)
+    return values.index_select(dim, lo) * (1 - w) + values.index_select(dim, hi) * w
+
+
+def _sample_trilinear(
+    values: torch.FloatTensor, p: torch.FloatTensor
+) -> torch.FloatTensor:
+    # trilinear interpolation of values (R, R, R) at p (N, 3) in grid index
+    # units, clamped to the grid
+    r = values.shape[0]
+    p = p.clamp(0, r - 1)
+    p0 = p.floor().long().clamp(max=r - 2)
+    w = p - p0
+    base = (p0 * torch.as_tensor([r * r, r, 1], device=p.device)).sum(-1)
+    flat = values.reshape(-1)
+    result = torch.zeros_like(w[:, 0])
+    for dx, dy, dz in _corner_offsets():
+        weight = (
+            (w[:, 0] if dx else 1 - w[:, 0])
+            * (w[:, 1] if dy else 1 - w[:, 1])
+            * (w[:, 2] if dz else 1 - w[:, 2])
+        )
+        result += weight * flat[base + (dx * r + dy) * r + dz]
+    return result
+
+
+def _corner_offsets() -> List[Tuple[int, int, int]]:
+    # corner c of a cell is at offset (c & 1, (c >> 1) & 1, (c >> 2) & 1)
+    return [(c & 1, (c >> 1) & 1, (c >> 2) & 1) for c in range(8)]
+
+
+# edge e of a cell starts at corner _CELL_EDGES[e][0] and goes along axis _CELL_EDGES[e][1]
+_CELL_EDGES = [(c, a) for a in range(3) for c in range(8) if not (c >> a) & 1]
+
+
+@lru_cache(maxsize=None)
+def _triangle_table() -> Tuple[np.ndarray, np.ndarray]:
+    # Triangles of the 256 sign configurations of a cell, as (256, 5, 3) cell
+    # edge indices (-1 padded) and (256,) triangle counts. Bit c of the
+    # configuration is set if corner c is inside. On every cell face, the edges
+    # crossing the surface are paired so that inside corners are cut off, which
+    # only depends on the signs of that face, so neighbouring cells agree on
+    # ambiguous faces and the mesh is watertight. The segments on the six faces
+    # form loops around the cell that are triangulated as fans, wound
+    # counter-clockwise seen from outside the surface.
+    edge_index = {edge: e for e, edge in enumerate(_CELL_EDGES)}
+
+    def edge_between(p, q):
+        return edge_index[(min(p, q), (p ^ q).bit_length() - 1)]
+
+    # corners of every face in counter-clockwise order seen from outside the cell
+    faces = []
+    for a in range(3):
+        u, v = (a + 1) % 3, (a + 2) % 3
+        for side in range(2):
+            ring = [(side << a) | (i << u) | (j << v) for i, j in [(0, 0), (1, 0), (1, 1), (0, 1)]]
+            faces.append(ring if side == 1 else ring[::-1])
+
+    table = np.full((256, 5, 3), -1, dtype=np.int64)
+    counts = np.zeros(256, dtype=np.int64)
+    for config in range(256):
+        inside = [(config >> c) & 1 for c in range(8)]
+        next_edge = {}
+        for ring in faces:
+            for i in range(4):
+                p, q = ring[i], ring[(i + 1) % 4]
+                if inside[p] or not inside[q]:
+                    continue
+                # the surface enters the face on edge (p, q) and leaves it on the
+                # next edge going from an inside to an outside corner
+                for k in range(1, 4):
+                    r, t = ring[(i + k) % 4], ring[(i + k + 1) % 4]
+                    if inside[r] and not inside[t]:
+                        break
+                next_edge[edge_between(r, t)] = edge_between(p, q)
+        triangles = []
+        while next_edge:
+            loop = [next(iter(next_edge))]
+            edge = next_edge.pop(loop[0])
+            while edge != loop[0]:
+                loop.append(edge)
+                edge = next_edge.pop(edge)
+            triangles += [(loop[0], loop[k + 1], loop[k]) for k in range(1, len(loop) - 1)]
+        if triangles:
+            table[config, : len(triangles)] = triangles
+        counts[config] = len(triangles)
+    return table, counts
+
+
+def sparse_marching_cubes(
+    values: torch.FloatTensor,
+    cells: Optional[torch.LongTensor] = None,
+) -> Tuple[torch.FloatTensor, torch.LongTensor]:
+    """
+    Marching cubes on the cells crossing the zero level of values.
+
+    values: (R, R, R), positive inside the surface. cells: optional (M, 3) indices
+    of the candidate cells; all cells are tested if None. Only the cells whose
+    corners change sign are triangulated, with table lookups in batched tensor
+    ops on the device of values, and vertices on grid edges shared by
+    neighbouring cells are welded.
+
+    Returns the (V, 3) vertices in grid index units and the (F, 3) faces.
+    """
+    device = values.device
+    r = values.shape[0]
+    strides = torch.as_tensor([r * r, r, 1], device=device)
+    # flat offsets of the corners of a cell, and the keys of its edges relative to
+    # the key of the cell's first corner; the key of a grid edge is its start
+    # vertex index * 3 + axis, so that the vertex on an edge shared by
+    # neighbouring cells is created only once
+    corner_offsets = torch.as_tensor(_corner_offsets(), device=device) @ strides
+    edge_offsets = 3 * corner_offsets[[c for c, _ in _CELL_EDGES]] + torch.as_tensor(
+        [a for _, a in _CELL_EDGES], device=device
+    )
+    if cells is None:
+        n = r - 1
+        inside = (values > 0).to(torch.uint8)
+        config = torch.zeros((n, n, n), dtype=torch.uint8, device=device)
+        for c, (dx, dy, dz) in enumerate(_corner_offsets()):
+            config |= inside[dx : n + dx, dy : n + dy, dz : n + dz] << c
+        cells = ((config != 0) & (config != 255)).nonzero()
+        config = config[cells[:, 0], cells[:, 1], cells[:, 2]].long()
+        base = cells @ strides
+    else:
+        base = cells.to(device) @ strides
+        inside = values.view(-1)[base[:, None] + corner_offsets] > 0
+        config = (
+            inside.to(torch.uint8) << torch.arange(8, dtype=torch.uint8, device=device)
+        ).sum(-1)
+        crossing = (config != 0) & (config != 255)
+        base, config = base[crossing], config[crossing]
+
+    table, counts = _triangle_table()
+    table = torch.as_tensor(table, device=device)
+    counts = torch.as_tensor(counts, device=device)
+    num_triangles = counts[config]
+    cell_of_triangle = torch.repeat_interleave(
+        torch.arange(base.shape[0], device=device), num_triangles
+    )
+    first = torch.cumsum(num_triangles, 0) - num_triangles
+    slot = torch.arange(cell_of_triangle.shape[0], device=device) - first[cell_of_triangle]
+    cell_edges = table[config[cell_of_triangle], slot]  # (F, 3)
+    keys = (3 * base)[cell_of_triangle][:, None] + edge_offsets[cell_edges]
+    keys, faces = torch.unique(keys.view(-1), return_inverse=True)
+
+    axis = keys % 3
+    start = keys // 3
+    v0 = values.view(-1)[start]
+    v1 = values.view(-1)[start + strides[axis]]
+    v_pos = torch.stack([start // (r * r), (start // r) % r, start % r], dim=-1).to(
+        values.dtype
+    )
+    v_pos[torch.arange(v_pos.shape[0], device=device), axis] += v0 / (v0 - v1)
+    return v_pos, faces.view(-1, 3)
@@ -1,14 +1,18 @@
+import math
+import warnings
 from dataclasses import dataclass
-from typing import Dict
+from typing import Dict, List, Optional, Tuple, Union
 
 import torch
 import torch.nn.functional as F
-from einops import rearrange, reduce
+from einops import rearrange, reduce, repeat
 
 from ..utils import (
     BaseModule,
-    chunk_batch,
+    chunk_batch_preallocated,
     get_activation,
+    get_free_memory,
+    is_out_of_memory,
     rays_intersect_bbox,
     scale_tensor,
 )
@@ -26,26 +30,242 @@ class TriplaneNeRFRenderer(BaseModule):
         num_samples_per_ray: int = 128
         randomized: bool = False
 
+        occupancy_grid_resolution: int = 64
+        occupancy_threshold: float = 0.1
+        march_block_size: int = 16
+
     cfg: Config
 
     def configure(self) -> None:
         assert self.cfg.feature_reduction in ["concat", "mean"]
         self.chunk_size = 0
+        self.memory_budget = None
+        self.auto_chunk_sizes: Dict[str, int] = {}
+        self.set_compiled_query(False)
+        self.set_inference_dtype(None)
 
     def set_chunk_size(self, chunk_size: int):
         assert (
             chunk_size >= 0
         ), "chunk_size must be a non-negative integer (0 for no chunking)."
         self.chunk_size = chunk_size
+        self.memory_budget = None
+
+    def set_memory_budget(self, memory_budget: Union[int, float]):
+        # Derive the chunk size from a memory budget instead: an int is a number of
+        # bytes, a float in (0, 1] a fraction of the memory free on the query device.
+        # The chunk size is computed on first use per device and halved whenever a
+        # query runs out of memory.
+        assert memory_budget > 0, "memory_budget must be positive."
+        assert isinstance(memory_budget, int) or (
+            memory_budget <= 1.0
+        ), "a float memory_budget must be a fraction in (0, 1]."
+        self.memory_budget = memory_budget
+        self.auto_chunk_sizes = {}
+
+    def bytes_per_point(self, decoder: torch.nn.Module, triplane: torch.Tensor) -> int:
+        # Peak intermediate memory of one decoder evaluation in query_triplane:
+        # positions and plane indices, the sampled plane features, the reduced
+        # decoder input, the two widest adjacent decoder activations and the outputs.
+        n_feats = triplane.shape[-3]
+        sampled = 3 * n_feats
+        reduced = 3 * n_feats if self.cfg.feature_reduction == "concat" else n_feats
+        # also matches dynamically quantized linear layers
+        linears = [
+            m
+            for m in decoder.modules()
+            if hasattr(m, "in_features") and hasattr(m, "out_features")
+        ]
+        if len(linears) > 0:
+            widths = [linears[0].in_features] + [m.out_features for m in linears]
+            decoder_peak = max(a + b for a, b in zip(widths[:-1], widths[1:]))
+            n_out = widths[-1]
+        else:
+            decoder_peak, n_out = 2 * reduced, 4
+        n_floats = 18 + sampled + reduced + decoder_peak + 2 * n_out
+        return n_floats * triplane.element_size()
+
+    def get_chunk_size(self, decoder: torch.nn.Module, triplane: torch.Tensor) -> int:
+        if self.memory_budget is None:
+            return self.chunk_size
+        device = str(triplane.device)
+        if device not in self.auto_chunk_sizes:
+            bytes_per_point = self.bytes_per_point(decoder, triplane)
+            if isinstance(self.memory_budget, float):
+                budget = int(get_free_memory(triplane.device) * self.memory_budget)
+            else:
+                budget = self.memory_budget
+                if budget < bytes_per_point:
+                    raise ValueError(
+                        f"memory_budget of {budget} bytes is smaller than the {bytes_per_point} bytes needed per point."
+                    )
+            chunk_size = max(1, budget // bytes_per_point)
+            # round down to a power of two
+            self.auto_chunk_sizes[device] = 2 ** int(math.log2(chunk_size))
+        return self.auto_chunk_sizes[device]
+
+    def _run_chunked(self, decoder: torch.nn.Module, triplane: torch.Tensor, func):
+        # call func(chunk_size), retrying with half the chunk size on allocation
+        # failure when the chunk size is derived from a memory budget
+        chunk_size = self.get_chunk_size(decoder, triplane)
+        while True:
+            try:
+                return func(chunk_size)
+            except (RuntimeError, MemoryError) as e:
+                if (
+                    self.memory_budget is None
+                    or chunk_size <= 1
+                    or not is_out_of_memory(e)
+                ):
+                    raise
+            chunk_size = max(1, chunk_size // 2)
+            self.auto_chunk_sizes[str(triplane.device)] = chunk_size
+            if triplane.is_cuda:
+                torch.cuda.empty_cache()
+
+    def set_inference_dtype(self, dtype: Optional[torch.dtype] = None):
+        # Run the decoder under autocast with this dtype (None for float32).
+        # The activated outputs (density_act, color) are always float32.
+        self.inference_dtype = dtype
+
+    def _run_decoder(
+        self, decoder: torch.nn.Module, features: torch.Tensor
+    ) -> Dict[str, torch.Tensor]:
+        if self.inference_dtype is None:
+            return decoder(features)
+        with torch.autocast(features.device.type, dtype=self.inference_dtype):
+            return decoder(features)
+
+    def _sample_planes(self, triplane: torch.Tensor, x: torch.Tensor) -> torch.Tensor:
+        # plane features at normalized positions x (N, 3), as (Np, Cp, 1, N) for a
+        # single triplane or ((B Np), Cp, 1, N) for a batch of triplanes
+        indices2D: torch.Tensor = torch.stack(
+            (x[..., [0, 1]], x[..., [0, 2]], x[..., [1, 2]]),
+            dim=-3,
+        )
+        if triplane.ndim == 5:
+            n_scenes = triplane.shape[0]
+            return F.grid_sample(
+                rearrange(triplane, "B Np Cp Hp Wp -> (B Np) Cp Hp Wp", Np=3),
+                repeat(indices2D, "Np N Nd -> (B Np) () N Nd", B=n_scenes, Np=3),
+                align_corners=False,
+                mode="bilinear",
+            )
+        return F.grid_sample(
+            rearrange(triplane, "Np Cp Hp Wp -> Np Cp Hp Wp", Np=3),
+            rearrange(indices2D, "Np N Nd -> Np () N Nd", Np=3),
+            align_corners=False,
+            mode="bilinear",
+        )
+
+    def _decode_samples(
+        self, decoder: torch.nn.Module, out: torch.Tensor, batched: bool
+    ) -> Dict[str, torch.Tensor]:
+        # reduce the sampled plane features and decode them, points first so that
+        # chunks concatenate along dim 0 (a batch of triplanes gives (N, B, ...))
+        if batched:
+            if self.cfg.feature_reduction == "concat":
+                out = rearrange(out, "(B Np) Cp () N -> N B (Np Cp)", Np=3)
+            elif self.cfg.feature_reduction == "mean":
+                out = reduce(out, "(B Np) Cp () N -> N B Cp", Np=3, reduction="mean")
+            else:
+                raise NotImplementedError
+        else:
+            if self.cfg.feature_reduction == "concat":
+                out = rearrange(out, "Np Cp () N -> N (Np Cp)", Np=3)
+            elif self.cfg.feature_reduction == "mean":
+                out = reduce(out, "Np Cp () N -> N Cp", Np=3, reduction="mean")
+            else:
+                raise NotImplementedError
+
+        net_out: Dict[str, torch.Tensor] = self._run_decoder(decoder, out)
+        return net_out
+
+    def _decode_and_activate(
+        self,
+        decoder: torch.nn.Module,
+        out: torch.Tensor,
+        batched: bool,
+        keys: Optional[Tuple[str, ...]] = None,
+    ) -> Dict[str, torch.Tensor]:
+        return self._activate(self._decode_samples(decoder, out, batched), keys=keys)
+
+    def _activate_decoded(
+        self,
+        decoder: torch.nn.Module,
+        features: torch.Tensor,
+        keys: Optional[Tuple[str, ...]] = None,
+    ) -> Dict[str, torch.Tensor]:
+        return self._activate(self._run_decoder(decoder, features), keys=keys)
+
+    def set_compiled_query(self, enabled: bool = True, **compile_kwargs):
+        # Run feature reduction, the decoder and the activations of each
+        # query_triplane chunk, and the decoder and the activations of each
+        # query_triplane_grid chunk, as one torch.compile graph. Plane sampling
+        # stays on the native grid_sample kernel, which is faster than its
+        # decomposition. Chunks are padded to a power of two so that only a few
+        # fixed shapes get compiled. Falls back to eager execution if
+        # compilation fails.
+        self.compiled_query = enabled and hasattr(torch, "compile")
+        self.compiled_query_fns = {}
+        self.compile_kwargs = compile_kwargs
+
+    def _call_compiled(self, func, *args):
+        # call the torch.compile'd version of func, compiled on first use
+        if self.compiled_query:
+            try:
+                if func.__name__ not in self.compiled_query_fns:
+                    self.compiled_query_fns[func.__name__] = torch.compile(
+                        func, dynamic=False, **self.compile_kwargs
+                    )
+                return self.compiled_query_fns[func.__name__](*args)
+            except Exception as e:
+                if is_out_of_memory(e):
+                    raise
+                warnings.warn(
+                    f"Compiled triplane query failed, falling back to eager execution: {e}"
+                )
+                self.compiled_query = False
+        return func(*args)
+
+    @staticmethod
+    def _pad_points(x: torch.Tensor) -> torch.Tensor:
+        # pad the points (dim 0) to the next power of two
+        n_points = x.shape[0]
+        n_padded = 2 ** math.ceil(math.log2(max(1, n_points)))
+        if n_padded > n_points:
+            x = torch.cat([x, x.new_zeros(n_padded - n_points, *x.shape[1:])])
+        return x
+
+    def _query_points_compiled(
+        self,
+        decoder: torch.nn.Module,
+        triplane: torch.Tensor,
+        x: torch.Tensor,
+        keys: Optional[List[str]] = None,
+    ) -> Dict[str, torch.Tensor]:
+        keys = tuple(keys) if keys is not None else None
+        n_points = x.shape[0]
+        out = self._sample_planes(triplane, self._pad_points(x))
+        batched = triplane.ndim == 5
+        net_out = self._call_compiled(
+            self._decode_and_activate, decoder, out, batched, keys
+        )
+        return {k: v[:n_points] for k, v in net_out.items()}
 
     def query_triplane(
         self,
         decoder: torch.nn.Module,
         positions: torch.Tensor,
         triplane: torch.Tensor,
+        keys: Optional[List[str]] = None,
     ) -> Dict[str, torch.Tensor]:
+        # triplane is either a single scene (Np, Cp, Hp, Wp) or a batch of scenes
+        # (B, Np, Cp, Hp, Wp) queried at the same positions; batched outputs are (B, ...)
+        # Only the outputs in keys (default: all) are computed and returned.
         input_shape = positions.shape[:-1]
         positions = positions.view(-1, 3)
+        batched = triplane.ndim == 5
 
         # positions in (-radius, radius)
         # normalized to (-1, 1) for grid sample
@@ -53,62 +273,249 @@ class TriplaneNeRFRenderer(BaseModule):
             positions, (-self.cfg.radius, self.cfg.radius), (-1, 1)
         )
 
+        compiled = self.compiled_query
+
         def _query_chunk(x):
-            indices2D: torch.Tensor = torch.stack(
-                (x[..., [0, 1]], x[..., [0, 2]], x[..., [1, 2]]),
-                dim=-3,
+            if compiled:
+                return self._query_points_compiled(decoder, triplane, x, keys)
+            return self._decode_samples(
+                decoder, self._sample_planes(triplane, x), batched
             )
-            out: torch.Tensor = F.grid_sample(
-                rearrange(triplane, "Np Cp Hp Wp -> Np Cp Hp Wp", Np=3),
-                rearrange(indices2D, "Np N Nd -> Np () N Nd", Np=3),
-                align_corners=False,
-                mode="bilinear",
+
+        def _query(chunk_size):
+            if chunk_size <= 0:
+                return _query_chunk(positions)
+            # the chunk size bounds the number of decoder evaluations across all scenes
+            if batched:
+                chunk_size = max(1, chunk_size // triplane.shape[0])
+            return chunk_batch_preallocated(
+                _query_chunk,
+                chunk_size,
+                positions,
+                output_keys=keys if compiled else self._raw_keys(keys),
+            )
+
+        net_out = self._run_chunked(decoder, triplane, _query)
+        if not compiled:
+            net_out = self._activate(net_out, keys=keys)
+        if keys is not None:
+            net_out = {k: net_out[k] for k in keys}
+        if batched:
+            net_out = {
+                k: v.movedim(0, 1).reshape(v.shape[1], *input_shape, -1)
+                for k, v in net_out.items()
+            }
+        else:
+            net_out = {k: v.view(*input_shape, -1) for k, v in net_out.items()}
+
+        return net_out
+
+    def query_triplane_grid(
+        self,
+        decoder: torch.nn.Module,
+        xs: torch.Tensor,
+        ys: torch.Tensor,
+        zs: torch.Tensor,
+        triplane: torch.Tensor,
+        keys: Optional[List[str]] = None,
+        out: Optional[Dict[str, torch.Tensor]] = None,
+    ) -> Dict[str, torch.Tensor]:
+        # Query the axis-aligned grid spanned by xs, ys and zs (each in (-radius, radius)),
+        # equivalent to query_triplane on the "ij" meshgrid of the three axes.
+        # Each plane only sees a 2D lattice of distinct sample locations, so it is
+        # sampled once on that lattice and the features are gathered per chunk.
+        # Only the outputs in keys (default: all) are kept; each chunk is written
+        # straight into preallocated (nx * ny * nz, C) buffers, which may be given in out.
+        nx, ny, nz = xs.shape[0], ys.shape[0], zs.shape[0]
+        xs, ys, zs = [
+            scale_tensor(c, (-self.cfg.radius, self.cfg.radius), (-1, 1))
+            for c in (xs, ys, zs)
+        ]
+
+        def _sample_plane(plane, u, v):
+            # features of plane at (u_i, v_j), returned as (len(u) * len(v), Cp)
+            grid = torch.stack(torch.meshgrid(u, v, indexing="ij"), dim=-1)
+            out = F.grid_sample(
+                plane[None], grid[None], align_corners=False, mode="bilinear"
             )
+            return rearrange(out, "() Cp U V -> (U V) Cp")
+
+        feat_xy = _sample_plane(triplane[0], xs, ys)
+        feat_xz = _sample_plane(triplane[1], xs, zs)
+        feat_yz = _sample_plane(triplane[2], ys, zs)
+
+        def _query_chunk(start, end):
+            idx = torch.arange(start, end, device=triplane.device)
+            i, j, k = idx // (ny * nz), (idx // nz) % ny, idx % nz
+            feats = (feat_xy[i * ny + j], feat_xz[i * nz + k], feat_yz[j * nz + k])
             if self.cfg.feature_reduction == "concat":
-                out = rearrange(out, "Np Cp () N -> N (Np Cp)", Np=3)
+                out = torch.cat(feats, dim=-1)
             elif self.cfg.feature_reduction == "mean":
-                out = reduce(out, "Np Cp () N -> N Cp", Np=3, reduction="mean")
+                out = (feats[0] + feats[1] + feats[2]) / 3.0
             else:
                 raise NotImplementedError
 
-            net_out: Dict[str, torch.Tensor] = decoder(out)
-            return net_out
+            if self.compiled_query:
+                net_out = self._call_compiled(
+                    self._activate_decoded,
+                    decoder,
+                    self._pad_points(out),
+                    tuple(keys) if keys is not None else None,
+                )
+                return {k: v[: end - start] for k, v in net_out.items()}
+            return self._activate_decoded(decoder, out, keys)
 
-        if self.chunk_size > 0:
-            net_out = chunk_batch(_query_chunk, self.chunk_size, positions)
-        else:
-            net_out = _query_chunk(positions)
+        n_points = nx * ny * nz
+        out = dict(out) if out is not None else {}
 
-        net_out["density_act"] = get_activation(self.cfg.density_activation)(
-            net_out["density"] + self.cfg.density_bias
-        )
-        net_out["color"] = get_activation(self.cfg.color_activation)(
-            net_out["features"]
-        )
+        def _query(chunk_size):
+            chunk_size = chunk_size if chunk_size > 0 else n_points
+            for start in range(0, n_points, chunk_size):
+                end = min(start + chunk_size, n_points)
+                net_out = _query_chunk(start, end)
+                for k, v in net_out.items():
+                    if keys is not None and k not in keys:
+                        continue
+                    if k not in out:
+                        out[k] = v.new_empty(n_points, *v.shape[1:])
+                    out[k][start:end] = v
+
+        self._run_chunked(decoder, triplane, _query)
+        return {k: v.view(nx, ny, nz, -1) for k, v in out.items()}
 
-        net_out = {k: v.view(*input_shape, -1) for k, v in net_out.items()}
+    @staticmethod
+    def _raw_keys(keys: Optional[List[str]]) -> Optional[List[str]]:
+        # decoder outputs needed to compute the activated outputs in keys
+        if keys is None:
+            return None
+        raw_keys = {"density_act": "density", "color": "features"}
+        return [raw_keys.get(k, k) for k in keys]
 
+    def _activate(
+        self, net_out: Dict[str, torch.Tensor], keys: Optional[List[str]] = None
+    ) -> Dict[str, torch.Tensor]:
+        if keys is None or "density_act" in keys:
+            net_out["density_act"] = get_activation(self.cfg.density_activation)(
+                net_out["density"].float() + self.cfg.density_bias
+            )
+        if keys is None or "color" in keys:
+            net_out["color"] = get_activation(self.cfg.color_activation)(
+                net_out["features"].float()
+            )
         return net_out
 
+    def build_occupancy_grid(
+        self,
+        decoder: torch.nn.Module,
+        triplane: torch.Tensor,
+        resolution: Optional[int] = None,
+        threshold: Optional[float] = None,
+    ) -> torch.BoolTensor:
+        # (R, R, R) occupancy of the cells evenly dividing the bounding box,
+        # from a coarse density query at the cell corners. A cell is occupied if
+        # any of its corners exceeds the threshold; the result is dilated by one
+        # cell so that thin structures between the corners are not lost.
+        resolution = resolution or self.cfg.occupancy_grid_resolution
+        threshold = self.cfg.occupancy_threshold if threshold is None else threshold
+        coords = torch.linspace(
+            -self.cfg.radius, self.cfg.radius, resolution + 1, device=triplane.device
+        )
+        density = self.query_triplane_grid(decoder, coords, coords, coords, triplane)[
+            "density_act"
+        ][..., 0]
+        occupied = F.max_pool3d(density[None, None], kernel_size=2, stride=1)
+        occupied = F.max_pool3d(
+            (occupied > threshold).float(), kernel_size=3, stride=1, padding=1
+        )
+        return occupied[0, 0] > 0
+
+    def _lookup_occupancy(
+        self, occupancy_grid: torch.BoolTensor, positions: torch.Tensor
+    ) -> torch.BoolTensor:
+        resolution = occupancy_grid.shape[0]
+        idx = scale_tensor(
+            positions, (-self.cfg.radius, self.cfg.radius), (0, resolution)
+        )
+        idx = idx.long().clamp(0, resolution - 1)
+        return occupancy_grid[idx[..., 0], idx[..., 1], idx[..., 2]]
+
     def _forward(
         self,
         decoder: torch.nn.Module,
         triplane: torch.Tensor,
         rays_o: torch.Tensor,
         rays_d: torch.Tensor,
+        occupancy_grid: Optional[torch.BoolTensor] = None,
+        num_samples_per_ray: Optional[int] = None,
+        termination_eps: Optional[float] = None,
+        num_importance_samples: int = 0,
         **kwargs,
     ):
+        # a batched triplane (B, Np, Cp, Hp, Wp) renders the same rays for every scene
+        scenes_shape = triplane.shape[:-4]
         rays_shape = rays_o.shape[:-1]
         rays_o = rays_o.view(-1, 3)
         rays_d = rays_d.view(-1, 3)
         n_rays = rays_o.shape[0]
+        num_samples = num_samples_per_ray or self.cfg.num_samples_per_ray
 
         t_near, t_far, rays_valid = rays_intersect_bbox(rays_o, rays_d, self.cfg.radius)
         t_near, t_far = t_near[rays_valid], t_far[rays_valid]
 
-        t_vals = torch.linspace(
-            0, 1, self.cfg.num_samples_per_ray + 1, device=triplane.device
+        if termination_eps is not None or num_importance_samples > 0:
+            assert (
+                len(scenes_shape) == 0
+            ), "early termination and importance sampling are only supported for a single scene."
+            comp_rgb_, opacity_ = self._forward_adaptive(
+                decoder,
+                triplane,
+                rays_o[rays_valid],
+                rays_d[rays_valid],
+                t_near,
+                t_far,
+                num_samples,
+                occupancy_grid=occupancy_grid,
+                termination_eps=termination_eps,
+                num_importance_samples=num_importance_samples,
+            )
+        else:
+            comp_rgb_, opacity_ = self._forward_uniform(
+                decoder,
+                triplane,
+                rays_o[rays_valid],
+                rays_d[rays_valid],
+                t_near,
+                t_far,
+                num_samples,
+                occupancy_grid=occupancy_grid,
+            )
+
+        comp_rgb = torch.zeros(
+            *scenes_shape, n_rays, 3, dtype=comp_rgb_.dtype, device=comp_rgb_.device
         )
+        opacity = torch.zeros(
+            *scenes_shape, n_rays, dtype=opacity_.dtype, device=opacity_.device
+        )
+        comp_rgb[..., rays_valid, :] = comp_rgb_
+        opacity[..., rays_valid] = opacity_
+
+        comp_rgb += 1 - opacity[..., None]
+        comp_rgb = comp_rgb.view(*scenes_shape, *rays_shape, 3)
+
+        return comp_rgb
+
+    def _forward_uniform(
+        self,
+        decoder: torch.nn.Module,
+        triplane: torch.Tensor,
+        rays_o: torch.Tensor,
+        rays_d: torch.Tensor,
+        t_near: torch.Tensor,
+        t_far: torch.Tensor,
+        num_samples: int,
+        occupancy_grid: Optional[torch.BoolTensor] = None,
+    ):
+        t_vals = torch.linspace(0, 1, num_samples + 1, device=triplane.device)
         t_mid = (t_vals[:-1] + t_vals[1:]) / 2.0
         z_vals = t_near * (1 - t_mid[None]) + t_far * t_mid[None]  # (N_rays, N_samples)
 
@@ -116,6 +523,17 @@ class TriplaneNeRFRenderer(BaseModule):
             rays_o[:, None, :] + z_vals[..., None] * rays_d[..., None, :]
         )  # (N_rays, N_sample, 3)
 
+        # deltas = z_vals[:, 1:] - z_vals[:, :-1] # (N_rays, N_samples)
+        deltas = t_vals[1:] - t_vals[:-1]  # (N_rays, N_samples)
+
+        if occupancy_grid is not None:
+            assert (
+                triplane.ndim == 4
+            ), "occupancy_grid is only supported for a single scene."
+            return self._composite_packed(
+                decoder, triplane, xyz, deltas, occupancy_grid
+            )
+
         mlp_out = self.query_triplane(
             decoder=decoder,
             positions=xyz,
@@ -123,33 +541,242 @@ class TriplaneNeRFRenderer(BaseModule):
         )
 
         eps = 1e-10
-        # deltas = z_vals[:, 1:] - z_vals[:, :-1] # (N_rays, N_samples)
-        deltas = t_vals[1:] - t_vals[:-1]  # (N_rays, N_samples)
         alpha = 1 - torch.exp(
             -deltas * mlp_out["density_act"][..., 0]
         )  # (N_rays, N_samples)
         accum_prod = torch.cat(
             [
-                torch.ones_like(alpha[:, :1]),
-                torch.cumprod(1 - alpha[:, :-1] + eps, dim=-1),
+                torch.ones_like(alpha[..., :1]),
+                torch.cumprod(1 - alpha[..., :-1] + eps, dim=-1),
             ],
             dim=-1,
         )
         weights = alpha * accum_prod  # (N_rays, N_samples)
         comp_rgb_ = (weights[..., None] * mlp_out["color"]).sum(dim=-2)  # (N_rays, 3)
         opacity_ = weights.sum(dim=-1)  # (N_rays)
+        return comp_rgb_, opacity_
 
-        comp_rgb = torch.zeros(
-            n_rays, 3, dtype=comp_rgb_.dtype, device=comp_rgb_.device
+    def _query_samples(
+        self,
+        decoder: torch.nn.Module,
+        triplane: torch.Tensor,
+        xyz: torch.Tensor,
+        occupancy_grid: Optional[torch.BoolTensor] = None,
+    ):
+        # density and color of the samples xyz (..., 3); samples in empty cells of the
+        # occupancy grid are not queried and get zero density
+        if occupancy_grid is None:
+            mlp_out = self.query_triplane(decoder, xyz, triplane)
+            return mlp_out["density_act"][..., 0], mlp_out["color"]
+        density = xyz.new_zeros(xyz.shape[:-1])
+        color = xyz.new_zeros(*xyz.shape[:-1], 3)
+        occupied = self._lookup_occupancy(occupancy_grid, xyz)
+        if occupied.any():
+            mlp_out = self.query_triplane(decoder, xyz[occupied], triplane)
+            density[occupied] = mlp_out["density_act"][..., 0]
+            color[occupied] = mlp_out["color"]
+        return density, color
+
+    def _forward_adaptive(
+        self,
+        decoder: torch.nn.Module,
+        triplane: torch.Tensor,
+        rays_o: torch.Tensor,
+        rays_d: torch.Tensor,
+        t_near: torch.Tensor,
+        t_far: torch.Tensor,
+        num_samples: int,
+        occupancy_grid: Optional[torch.BoolTensor] = None,
+        termination_eps: Optional[float] = None,
+        num_importance_samples: int = 0,
+    ):
+        # March the uniform samples in blocks of march_block_size, retiring rays whose
+        # transmittance fell below termination_eps. With num_importance_samples > 0, the
+        # weights of this coarse pass drive a second, importance-sampled fine pass that is
+        # composited together with the coarse samples.
+        n_rays = rays_o.shape[0]
+        eps = 1e-10
+        t_vals = torch.linspace(0, 1, num_samples + 1, device=triplane.device)
+        t_mid = (t_vals[:-1] + t_vals[1:]) / 2.0
+        deltas = t_vals[1:] - t_vals[:-1]
+
+        keep_samples = num_importance_samples > 0
+        if keep_samples:
+            density = rays_o.new_zeros(n_rays, num_samples)
+            color = rays_o.new_zeros(n_rays, num_samples, 3)
+            weights = rays_o.new_zeros(n_rays, num_samples)
+
+        comp_rgb_ = rays_o.new_zeros(n_rays, 3)
+        opacity_ = rays_o.new_zeros(n_rays)
+        transmittance = rays_o.new_ones(n_rays)
+        active = torch.arange(n_rays, device=rays_o.device)
+        block_size = self.cfg.march_block_size
+        for start in range(0, num_samples, block_size):
+            if active.shape[0] == 0:
+                break
+            end = min(start + block_size, num_samples)
+            t = t_mid[start:end]
+            z_vals = t_near[active] * (1 - t[None]) + t_far[active] * t[None]
+            xyz = rays_o[active, None, :] + z_vals[..., None] * rays_d[active, None, :]
+            density_, color_ = self._query_samples(
+                decoder, triplane, xyz, occupancy_grid
+            )
+
+            alpha = 1 - torch.exp(-deltas[start:end] * density_)
+            accum_prod = transmittance[active, None] * torch.cat(
+                [
+                    torch.ones_like(alpha[:, :1]),
+                    torch.cumprod(1 - alpha[:, :-1] + eps, dim=-1),
+                ],
+                dim=-1,
+            )
+            weights_ = alpha * accum_prod
+            comp_rgb_[active] += (weights_[..., None] * color_).sum(dim=-2)
+            opacity_[active] += weights_.sum(dim=-1)
+            transmittance[active] = accum_prod[:, -1] * (1 - alpha[:, -1] + eps)
+
+            if keep_samples:
+                density[active, start:end] = density_
+                color[active, start:end] = color_
+                weights[active, start:end] = weights_
+            if termination_eps is not None:
+                active = active[transmittance[active] > termination_eps]
+
+        if not keep_samples:
+            return comp_rgb_, opacity_
+
+        # inverse transform sampling of the coarse weights over the uniform bins
+        pdf = weights + 1e-5
+        pdf = pdf / pdf.sum(dim=-1, keepdim=True)
+        cdf = torch.cat([torch.zeros_like(pdf[:, :1]), torch.cumsum(pdf, dim=-1)], dim=-1)
+        u = (
+            torch.arange(num_importance_samples, device=rays_o.device) + 0.5
+        ) / num_importance_samples
+        u = u[None].expand(n_rays, -1).contiguous()
+        hi = torch.searchsorted(cdf, u, right=True).clamp(1, num_samples)
+        lo = hi - 1
+        cdf_lo, cdf_hi = cdf.gather(1, lo), cdf.gather(1, hi)
+        frac = (u - cdf_lo) / (cdf_hi - cdf_lo).clamp_min(eps)
+        t_fine = t_vals[lo] + frac * (t_vals[hi] - t_vals[lo])
+
+        z_vals = t_near * (1 - t_fine) + t_far * t_fine
+        xyz = rays_o[:, None, :] + z_vals[..., None] * rays_d[:, None, :]
+        density_fine, color_fine = self._query_samples(
+            decoder, triplane, xyz, occupancy_grid
         )
-        opacity = torch.zeros(n_rays, dtype=opacity_.dtype, device=opacity_.device)
-        comp_rgb[rays_valid] = comp_rgb_
-        opacity[rays_valid] = opacity_
 
-        comp_rgb += 1 - opacity[..., None]
-        comp_rgb = comp_rgb.view(*rays_shape, 3)
+        # composite coarse and fine samples together, sorted along the ray; each sample
+        # covers the interval between the midpoints to its neighbours
+        t_all, order = torch.sort(
+            torch.cat([t_mid[None].expand(n_rays, -1), t_fine], dim=-1), dim=-1
+        )
+        density_all = torch.cat([density, density_fine], dim=-1).gather(1, order)
+        color_all = torch.cat([color, color_fine], dim=-2).gather(
+            1, order[..., None].expand(-1, -1, 3)
+        )
+        edges = torch.cat(
+            [
+                torch.zeros_like(t_all[:, :1]),
+                (t_all[:, 1:] + t_all[:, :-1]) / 2.0,
+                torch.ones_like(t_all[:, :1]),
+            ],
+            dim=-1,
+        )
+        alpha = 1 - torch.exp(-(edges[:, 1:] - edges[:, :-1]) * density_all)
+        accum_prod = torch.cat(
+            [
+                torch.ones_like(alpha[:, :1]),
+                torch.cumprod(1 - alpha[:, :-1] + eps, dim=-1),
+            ],
+            dim=-1,
+        )
+        weights = alpha * accum_prod
+        comp_rgb_ = (weights[..., None] * color_all).sum(dim=-2)
+        opacity_ = weights.sum(dim=-1)
+        return comp_rgb_, opacity_
 
-        return comp_rgb
+    def _composite_packed(
+        self,
+        decoder: torch.nn.Module,
+        triplane: torch.Tensor,
+        xyz: torch.Tensor,
+        deltas: torch.Tensor,
+        occupancy_grid: torch.BoolTensor,
+    ):
+        # Only samples in occupied cells are queried. Skipped samples have zero
+        # density, so they do not change the transmittance of the samples behind them.
+        n_rays = xyz.shape[0]
+        occupied = self._lookup_occupancy(occupancy_grid, xyz)  # (N_rays, N_samples)
+        ray_idx, sample_idx = occupied.nonzero(as_tuple=True)  # sorted by ray
+        if ray_idx.numel() == 0:
+            # no ray of this chunk passes through an occupied cell
+            return xyz.new_zeros(n_rays, 3), xyz.new_zeros(n_rays)
+
+        mlp_out = self.query_triplane(
+            decoder=decoder,
+            positions=xyz[ray_idx, sample_idx],
+            triplane=triplane,
+        )
+
+        # segmented exclusive cumulative sum of optical depth along each ray,
+        # accumulated in float64 since it runs over all packed samples at once
+        sigma_delta = deltas[sample_idx] * mlp_out["density_act"][..., 0]
+        cum = torch.cumsum(sigma_delta.double(), dim=0) - sigma_delta.double()
+        counts = torch.bincount(ray_idx, minlength=n_rays)
+        ray_start = torch.cumsum(counts, dim=0) - counts
+        cum = cum - cum[ray_start[ray_idx]]
+        transmittance = torch.exp(-cum).to(sigma_delta.dtype)
+
+        alpha = 1 - torch.exp(-sigma_delta)
+        weights = alpha * transmittance
+        comp_rgb_ = torch.zeros(
+            n_rays, 3, dtype=weights.dtype, device=weights.device
+        ).index_add_(0, ray_idx, weights[:, None] * mlp_out["color"])
+        opacity_ = torch.zeros(
+            n_rays, dtype=weights.dtype, device=weights.device
+        ).index_add_(0, ray_idx, weights)
+        return comp_rgb_, opacity_
+
+    def render_rays(
+        self,
+        decoder: torch.nn.Module,
+        triplane: torch.Tensor,
+        rays_o: torch.Tensor,
+        rays_d: torch.Tensor,
+        max_points_per_batch: int = 2**21,
+        occupancy_grid: Optional[torch.BoolTensor] = None,
+        **kwargs,
+    ) -> torch.Tensor:
+        # Render rays of any shape (e.g. all views at once) in batches of at most
+        # max_points_per_batch samples. A batched triplane (B, Np, Cp, Hp, Wp) renders
+        # the same rays for every scene and returns (B, *rays_shape, 3).
+        rays_shape = rays_o.shape[:-1]
+        n_scenes = triplane.shape[0] if triplane.ndim == 5 else 1
+        ray_chunk_size = max(
+            1,
+            max_points_per_batch
+            // (
+                (kwargs.get("num_samples_per_ray") or self.cfg.num_samples_per_ray)
+                * n_scenes
+            ),
+        )
+
+        def _render_chunk(rays_o_, rays_d_):
+            comp_rgb = self._forward(
+                decoder,
+                triplane,
+                rays_o_,
+                rays_d_,
+                occupancy_grid=occupancy_grid,
+                **kwargs,
+            )
+            # rays first so that chunks concatenate along dim 0
+            return comp_rgb.movedim(-2, 0)
+
+        comp_rgb = chunk_batch_preallocated(
+            _render_chunk, ray_chunk_size, rays_o.reshape(-1, 3), rays_d.reshape(-1, 3)
+        ).movedim(0, -2)
+        return comp_rgb.reshape(*comp_rgb.shape[:-2], *rays_shape, 3)
 
     def forward(
         self,
@@ -157,13 +784,26 @@ class TriplaneNeRFRenderer(BaseModule):
         triplane: torch.Tensor,
         rays_o: torch.Tensor,
         rays_d: torch.Tensor,
+        occupancy_grid: Optional[torch.BoolTensor] = None,
+        **kwargs,
     ) -> Dict[str, torch.Tensor]:
         if triplane.ndim == 4:
-            comp_rgb = self._forward(decoder, triplane, rays_o, rays_d)
+            comp_rgb = self._forward(
+                decoder, triplane, rays_o, rays_d, occupancy_grid=occupancy_grid, **kwargs
+            )
         else:
             comp_rgb = torch.stack(
                 [
-                    self._forward(decoder, triplane[i], rays_o[i], rays_d[i])
+                    self._forward(
+                        decoder,
+                        triplane[i],
+                        rays_o[i],
+                        rays_d[i],
+                        occupancy_grid=(
+                            occupancy_grid[i] if occupancy_grid is not None else None
+                        ),
+                        **kwargs,
+                    )
                     for i in range(triplane.shape[0])
                 ],
                 dim=0,
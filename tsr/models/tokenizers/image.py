@@ -1,9 +1,10 @@
 from dataclasses import dataclass
+from typing import Optional
 
 import torch
 import torch.nn as nn
 from einops import rearrange
-from huggingface_hub import hf_hub_download
+from omegaconf import OmegaConf
 from transformers.models.vit.modeling_vit import ViTModel
 
 from ...utils import BaseModule
@@ -14,30 +15,40 @@ class DINOSingleImageTokenizer(BaseModule):
     class Config(BaseModule.Config):
         pretrained_model_name_or_path: str = "facebook/dino-vitb16"
         enable_gradient_checkpointing: bool = False
+        # ViT config bundled by TSR.save_pretrained, so that it is not downloaded
+        vit_config: Optional[dict] = None
 
     cfg: Config
 
     def configure(self) -> None:
-        self.model: ViTModel = ViTModel(
-            ViTModel.config_class.from_pretrained(
+        if self.cfg.vit_config is not None:
+            vit_config = ViTModel.config_class.from_dict(
+                OmegaConf.to_container(self.cfg.vit_config)
+            )
+        else:
+            from huggingface_hub import hf_hub_download
+
+            vit_config = ViTModel.config_class.from_pretrained(
                 hf_hub_download(
                     repo_id=self.cfg.pretrained_model_name_or_path,
                     filename="config.json",
                 )
             )
-        )
+        self.model: ViTModel = ViTModel(vit_config)
 
         if self.cfg.enable_gradient_checkpointing:
             self.model.encoder.gradient_checkpointing = True
 
+        # not part of the checkpoint, so always created on the CPU (also when the
+        # model is constructed on the meta device)
         self.register_buffer(
             "image_mean",
-            torch.as_tensor([0.485, 0.456, 0.406]).reshape(1, 1, 3, 1, 1),
+            torch.as_tensor([0.485, 0.456, 0.406], device="cpu").reshape(1, 1, 3, 1, 1),
             persistent=False,
         )
         self.register_buffer(
             "image_std",
-            torch.as_tensor([0.229, 0.224, 0.225]).reshape(1, 1, 3, 1, 1),
+            torch.as_tensor([0.229, 0.224, 0.225], device="cpu").reshape(1, 1, 3, 1, 1),
             persistent=False,
         )
 
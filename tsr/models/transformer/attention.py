@@ -124,6 +124,7 @@ class Attention(nn.Module):
         self.cross_attention_dim = (
             cross_attention_dim if cross_attention_dim is not None else query_dim
         )
+        self.is_cross_attention = cross_attention_dim is not None
         self.upcast_attention = upcast_attention
         self.upcast_softmax = upcast_softmax
         self.rescale_output_factor = rescale_output_factor
@@ -448,37 +449,102 @@ class Attention(nn.Module):
 
     @torch.no_grad()
     def fuse_projections(self, fuse=True):
-        is_cross_attention = self.cross_attention_dim != self.query_dim
-        device = self.to_q.weight.data.device
-        dtype = self.to_q.weight.data.dtype
-
-        if not is_cross_attention:
-            # fetch weight matrices.
-            concatenated_weights = torch.cat(
-                [self.to_q.weight.data, self.to_k.weight.data, self.to_v.weight.data]
-            )
-            in_features = concatenated_weights.shape[1]
-            out_features = concatenated_weights.shape[0]
+        # The projections folded into the fused layer are removed, so that the
+        # weights are not kept (and saved) twice, and are split back out of it
+        # when unfusing.
+        if fuse == self.fused_projections:
+            return
+
+        if not self.is_cross_attention:
+            names = ["to_q", "to_k", "to_v"]
+            name = "to_qkv"
+        else:
+            names = ["to_k", "to_v"]
+            name = "to_kv"
+
+        if not fuse:
+            fused = getattr(self, name)
+            use_bias = fused.bias is not None
+            weights = fused.weight.data.chunk(len(names))
+            biases = fused.bias.data.chunk(len(names)) if use_bias else [None] * len(names)
+            for layer_name, weight, bias in zip(names, weights, biases):
+                layer = self.linear_cls(
+                    weight.shape[1],
+                    weight.shape[0],
+                    bias=use_bias,
+                    device=weight.device,
+                    dtype=weight.dtype,
+                )
+                layer.weight.copy_(weight)
+                if use_bias:
+                    layer.bias.copy_(bias)
+                setattr(self, layer_name, layer)
+            delattr(self, name)
+            self.fused_projections = False
+            return
+
+        # fetch weight matrices.
+        layers = [getattr(self, layer_name) for layer_name in names]
+        device = layers[0].weight.data.device
+        dtype = layers[0].weight.data.dtype
+        use_bias = layers[0].bias is not None
+
+        concatenated_weights = torch.cat([layer.weight.data for layer in layers])
+        in_features = concatenated_weights.shape[1]
+        out_features = concatenated_weights.shape[0]
+
+        # create a new single projection layer and copy over the weights.
+        fused = self.linear_cls(
+            in_features, out_features, bias=use_bias, device=device, dtype=dtype
+        )
+        fused.weight.copy_(concatenated_weights)
+        if use_bias:
+            fused.bias.copy_(torch.cat([layer.bias.data for layer in layers]))
+        setattr(self, name, fused)
+        for layer_name in names:
+            setattr(self, layer_name, None)
 
-            # create a new single projection layer and copy over the weights.
-            self.to_qkv = self.linear_cls(
-                in_features, out_features, bias=False, device=device, dtype=dtype
-            )
-            self.to_qkv.weight.copy_(concatenated_weights)
+        self.fused_projections = fuse
 
-        else:
-            concatenated_weights = torch.cat(
-                [self.to_k.weight.data, self.to_v.weight.data]
-            )
-            in_features = concatenated_weights.shape[1]
-            out_features = concatenated_weights.shape[0]
 
-            self.to_kv = self.linear_cls(
-                in_features, out_features, bias=False, device=device, dtype=dtype
+def project_qkv(
+    attn: Attention,
+    hidden_states: torch.FloatTensor,
+    encoder_hidden_states: Optional[torch.FloatTensor] = None,
+):
+    query = attn.to_q(hidden_states)
+
+    if encoder_hidden_states is None:
+        encoder_hidden_states = hidden_states
+    elif attn.norm_cross:
+        encoder_hidden_states = attn.norm_encoder_hidden_states(encoder_hidden_states)
+
+    key = attn.to_k(encoder_hidden_states)
+    value = attn.to_v(encoder_hidden_states)
+    return query, key, value
+
+
+def project_qkv_fused(
+    attn: Attention,
+    hidden_states: torch.FloatTensor,
+    encoder_hidden_states: Optional[torch.FloatTensor] = None,
+):
+    # one GEMM for query, key and value in self-attention, and one for key and
+    # value in cross-attention (see `Attention.fuse_projections`)
+    if encoder_hidden_states is None:
+        qkv = attn.to_qkv(hidden_states)
+        split_size = qkv.shape[-1] // 3
+        query, key, value = torch.split(qkv, split_size, dim=-1)
+    else:
+        if attn.norm_cross:
+            encoder_hidden_states = attn.norm_encoder_hidden_states(
+                encoder_hidden_states
             )
-            self.to_kv.weight.copy_(concatenated_weights)
-
-        self.fused_projections = fuse
+        query = attn.to_q(hidden_states)
+        kv = attn.to_kv(encoder_hidden_states)
+        split_size = kv.shape[-1] // 2
+        key, value = torch.split(kv, split_size, dim=-1)
+    return query, key, value
 
 
 class AttnProcessor:
@@ -486,6 +552,8 @@ class AttnProcessor:
     Default processor for performing attention-related computations.
     """
 
+    project_qkv = staticmethod(project_qkv)
+
     def __call__(
         self,
         attn: Attention,
@@ -517,17 +585,9 @@ class AttnProcessor:
                 1, 2
             )
 
-        query = attn.to_q(hidden_states)
-
-        if encoder_hidden_states is None:
-            encoder_hidden_states = hidden_states
-        elif attn.norm_cross:
-            encoder_hidden_states = attn.norm_encoder_hidden_states(
-                encoder_hidden_states
-            )
-
-        key = attn.to_k(encoder_hidden_states)
-        value = attn.to_v(encoder_hidden_states)
+        query, key, value = self.project_qkv(
+            attn, hidden_states, encoder_hidden_states
+        )
 
         query = attn.head_to_batch_dim(query)
         key = attn.head_to_batch_dim(key)
@@ -560,6 +620,8 @@ class AttnProcessor2_0:
     Processor for implementing scaled dot-product attention (enabled by default if you're using PyTorch 2.0).
     """
 
+    project_qkv = staticmethod(project_qkv)
+
     def __init__(self):
         if not hasattr(F, "scaled_dot_product_attention"):
             raise ImportError(
@@ -604,17 +666,9 @@ class AttnProcessor2_0:
                 1, 2
             )
 
-        query = attn.to_q(hidden_states)
-
-        if encoder_hidden_states is None:
-            encoder_hidden_states = hidden_states
-        elif attn.norm_cross:
-            encoder_hidden_states = attn.norm_encoder_hidden_states(
-                encoder_hidden_states
-            )
-
-        key = attn.to_k(encoder_hidden_states)
-        value = attn.to_v(encoder_hidden_states)
+        query, key, value = self.project_qkv(
+            attn, hidden_states, encoder_hidden_states
+        )
 
         inner_dim = key.shape[-1]
         head_dim = inner_dim // attn.heads
@@ -651,3 +705,19 @@ class AttnProcessor2_0:
         hidden_states = hidden_states / attn.rescale_output_factor
 
         return hidden_states
+
+
+class FusedAttnProcessor(AttnProcessor):
+    r"""
+    `AttnProcessor` using the fused projection layers built by `Attention.fuse_projections`.
+    """
+
+    project_qkv = staticmethod(project_qkv_fused)
+
+
+class FusedAttnProcessor2_0(AttnProcessor2_0):
+    r"""
+    `AttnProcessor2_0` using the fused projection layers built by `Attention.fuse_projections`.
+    """
+
+    project_qkv = staticmethod(project_qkv_fused)
@@ -44,6 +44,13 @@ import torch.nn.functional as F
 from torch import nn
 
 from ...utils import BaseModule
+from .attention import (
+    Attention,
+    AttnProcessor,
+    AttnProcessor2_0,
+    FusedAttnProcessor,
+    FusedAttnProcessor2_0,
+)
 from .basic_transformer_block import BasicTransformerBlock
 
 
@@ -119,6 +126,21 @@ class Transformer1D(BaseModule):
 
         self.gradient_checkpointing = self.cfg.gradient_checkpointing
 
+    def fuse_qkv_projections(self, fuse: bool = True):
+        # Compute the query, key and value projections of each self-attention layer,
+        # and the key and value projections of each cross-attention layer, with a
+        # single linear layer (see `Attention.fuse_projections`).
+        for module in self.modules():
+            if not isinstance(module, Attention):
+                continue
+            module.fuse_projections(fuse=fuse)
+            use_sdpa = isinstance(module.processor, AttnProcessor2_0)
+            if fuse:
+                processor = FusedAttnProcessor2_0() if use_sdpa else FusedAttnProcessor()
+            else:
+                processor = AttnProcessor2_0() if use_sdpa else AttnProcessor()
+            module.set_processor(processor)
+
     def forward(
         self,
         hidden_states: torch.Tensor,
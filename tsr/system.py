@@ -1,15 +1,16 @@
+import itertools
 import math
 import os
+import time
+from contextlib import nullcontext
 from dataclasses import dataclass, field
-from typing import List, Union
+from typing import Dict, List, Optional, Union
 
 import numpy as np
 import PIL.Image
 import torch
 import torch.nn.functional as F
-import trimesh
 from einops import rearrange
-from huggingface_hub import hf_hub_download
 from omegaconf import OmegaConf
 from PIL import Image
 
@@ -19,10 +20,14 @@ from .utils import (
     ImagePreprocessor,
     find_class,
     get_spherical_cameras,
+    load_safetensors_mmap,
     scale_tensor,
 )
 
 
+QUANTIZABLE_MODULES = ["image_tokenizer", "backbone", "decoder"]
+
+
 class TSR(BaseModule):
     @dataclass
     class Config(BaseModule.Config):
@@ -50,12 +55,23 @@ class TSR(BaseModule):
 
     @classmethod
     def from_pretrained(
-        cls, pretrained_model_name_or_path: str, config_name: str, weight_name: str
+        cls,
+        pretrained_model_name_or_path: str,
+        config_name: str,
+        weight_name: str,
+        empty_init: bool = True,
+        timings: Optional[Dict[str, float]] = None,
     ):
+        # With empty_init, the model is constructed on the meta device, skipping the
+        # random initialization that the checkpoint overwrites anyway, and the
+        # checkpoint tensors are assigned to it. If timings is given, the seconds
+        # spent on "construction" and "loading" are stored in it.
         if os.path.isdir(pretrained_model_name_or_path):
             config_path = os.path.join(pretrained_model_name_or_path, config_name)
             weight_path = os.path.join(pretrained_model_name_or_path, weight_name)
         else:
+            from huggingface_hub import hf_hub_download
+
             config_path = hf_hub_download(
                 repo_id=pretrained_model_name_or_path, filename=config_name
             )
@@ -63,13 +79,102 @@ class TSR(BaseModule):
                 repo_id=pretrained_model_name_or_path, filename=weight_name
             )
 
+        start = time.perf_counter()
         cfg = OmegaConf.load(config_path)
         OmegaConf.resolve(cfg)
-        model = cls(cfg)
-        ckpt = torch.load(weight_path, map_location="cpu")
-        model.load_state_dict(ckpt)
+        # weights are memory-mapped and assigned to the model without a copy
+        fuse_attention_projections, quantize_mode = False, None
+        if weight_path.endswith(".safetensors"):
+            ckpt, metadata = load_safetensors_mmap(weight_path)
+            fuse_attention_projections = (
+                metadata.get("fuse_attention_projections") == "true"
+            )
+        else:
+            ckpt = torch.load(weight_path, map_location="cpu", mmap=True)
+            if "state_dict" in ckpt:
+                # saved by save_pretrained after fuse_attention_projections or quantize
+                fuse_attention_projections = ckpt.get(
+                    "fuse_attention_projections", False
+                )
+                quantize_mode = ckpt.get("quantize_mode")
+                ckpt = ckpt["state_dict"]
+        loading_time = time.perf_counter() - start
+
+        start = time.perf_counter()
+        # quantization needs materialized float weights
+        with torch.device("meta") if empty_init and quantize_mode is None else nullcontext():
+            model = cls(cfg)
+        if fuse_attention_projections:
+            model.fuse_attention_projections()
+        if quantize_mode is not None:
+            model.quantize(quantize_mode)
+        construction_time = time.perf_counter() - start
+
+        start = time.perf_counter()
+        model.load_state_dict(ckpt, assign=True)
+        missing = [
+            name
+            for name, tensor in itertools.chain(
+                model.named_parameters(), model.named_buffers()
+            )
+            if tensor.is_meta
+        ]
+        if missing:
+            raise RuntimeError(f"Tensors not found in the checkpoint: {missing}")
+        loading_time += time.perf_counter() - start
+
+        model.checkpoint_path = weight_path
+
+        if timings is not None:
+            timings["construction"] = construction_time
+            timings["loading"] = loading_time
         return model
 
+    def save_pretrained(
+        self,
+        save_directory: str,
+        config_name: str = "config.yaml",
+        weight_name: str = "model.ckpt",
+    ):
+        # Counterpart of from_pretrained. Fused or quantized models are saved
+        # together with these settings and are fused / quantized again on loading.
+        # A weight_name ending in .safetensors saves memory-mappable weights.
+        # The ViT config of the image tokenizer is bundled into the config, so
+        # loading the saved model needs no network access.
+        from transformers import PreTrainedModel
+
+        os.makedirs(save_directory, exist_ok=True)
+        cfg = OmegaConf.create(OmegaConf.to_container(self.cfg))
+        if isinstance(getattr(self.image_tokenizer, "model", None), PreTrainedModel):
+            cfg.image_tokenizer.vit_config = self.image_tokenizer.model.config.to_diff_dict()
+        OmegaConf.save(cfg, os.path.join(save_directory, config_name))
+        weight_path = os.path.join(save_directory, weight_name)
+        ckpt = self.state_dict()
+        if weight_name.endswith(".safetensors"):
+            if self.quantize_mode is not None:
+                raise ValueError(
+                    "Quantized models cannot be saved as safetensors, use a .ckpt weight_name."
+                )
+            from safetensors.torch import save_file
+
+            save_file(
+                {k: v.contiguous() for k, v in ckpt.items()},
+                weight_path,
+                metadata={
+                    "fuse_attention_projections": str(
+                        self.fused_attention_projections
+                    ).lower()
+                },
+            )
+            return
+        if self.fused_attention_projections or self.quantize_mode is not None:
+            ckpt = {
+                "fuse_attention_projections": self.fused_attention_projections,
+                "quantize_mode": self.quantize_mode,
+                "state_dict": ckpt,
+            }
+        torch.save(ckpt, weight_path)
+
     def configure(self):
         self.image_tokenizer = find_class(self.cfg.image_tokenizer_cls)(
             self.cfg.image_tokenizer
@@ -83,6 +188,65 @@ class TSR(BaseModule):
         self.renderer = find_class(self.cfg.renderer_cls)(self.cfg.renderer)
         self.image_processor = ImagePreprocessor()
         self.isosurface_helper = None
+        self.inference_dtype = None
+        self.quantize_mode = None
+        self.fused_attention_projections = False
+        # set by from_pretrained, identifies the weights (e.g. for the scene code cache)
+        self.checkpoint_path = None
+
+    def fuse_attention_projections(self, fuse: bool = True):
+        # one GEMM for the query, key and value projections of each self-attention
+        # layer and one for the key and value projections of each cross-attention
+        # layer of the backbone; must be called before quantizing the backbone
+        if self.quantize_mode is not None and "backbone" in self.quantize_mode.split("+"):
+            raise ValueError(
+                "Attention projections must be fused before quantizing the backbone."
+            )
+        self.backbone.fuse_qkv_projections(fuse)
+        self.fused_attention_projections = fuse
+
+    def quantize(self, mode: str = "backbone"):
+        # Dynamic int8 quantization (CPU only) of the nn.Linear layers of the
+        # submodules in mode, joined by "+", e.g. "backbone" or "backbone+decoder".
+        # Weights are stored in int8 and activations are quantized on the fly.
+        modules = mode.split("+")
+        for name in modules:
+            assert (
+                name in QUANTIZABLE_MODULES
+            ), f"Unknown module to quantize: {name}, must be one of {QUANTIZABLE_MODULES}"
+        if any(p.device.type != "cpu" for p in self.parameters()):
+            raise ValueError("Dynamic quantization is only supported on CPU.")
+        for name in modules:
+            torch.ao.quantization.quantize_dynamic(
+                getattr(self, name), {torch.nn.Linear}, dtype=torch.qint8, inplace=True
+            )
+        quantized = set(modules) | set(
+            self.quantize_mode.split("+") if self.quantize_mode is not None else []
+        )
+        self.quantize_mode = "+".join(n for n in QUANTIZABLE_MODULES if n in quantized)
+
+    def set_compiled_query(self, enabled: bool = True, **compile_kwargs):
+        # opt-in torch.compile of the triplane queries (feature reduction, decoder
+        # and activations) used by rendering, vertex colors and the density grid
+        # of mesh extraction
+        self.renderer.set_compiled_query(enabled, **compile_kwargs)
+
+    def set_inference_dtype(self, dtype: Optional[Union[str, torch.dtype]] = None):
+        # Run the image tokenizer, backbone, post processor and decoder under
+        # autocast with a lower precision dtype ("bfloat16" or "float16"; None or
+        # "float32" to disable). Scene codes, densities and colors stay float32, so
+        # the density threshold and the marching cubes input are unaffected.
+        if isinstance(dtype, str):
+            dtype = getattr(torch, dtype)
+        if dtype == torch.float32:
+            dtype = None
+        assert dtype in [
+            None,
+            torch.bfloat16,
+            torch.float16,
+        ], f"Unsupported inference dtype: {dtype}"
+        self.inference_dtype = dtype
+        self.renderer.set_inference_dtype(dtype)
 
     def forward(
         self,
@@ -101,23 +265,28 @@ class TSR(BaseModule):
         )
         batch_size = rgb_cond.shape[0]
 
-        input_image_tokens: torch.Tensor = self.image_tokenizer(
-            rearrange(rgb_cond, "B Nv H W C -> B Nv C H W", Nv=1),
-        )
+        with torch.autocast(
+            rgb_cond.device.type,
+            dtype=self.inference_dtype or torch.float32,
+            enabled=self.inference_dtype is not None,
+        ):
+            input_image_tokens: torch.Tensor = self.image_tokenizer(
+                rearrange(rgb_cond, "B Nv H W C -> B Nv C H W", Nv=1),
+            )
 
-        input_image_tokens = rearrange(
-            input_image_tokens, "B Nv C Nt -> B (Nv Nt) C", Nv=1
-        )
+            input_image_tokens = rearrange(
+                input_image_tokens, "B Nv C Nt -> B (Nv Nt) C", Nv=1
+            )
 
-        tokens: torch.Tensor = self.tokenizer(batch_size)
+            tokens: torch.Tensor = self.tokenizer(batch_size)
 
-        tokens = self.backbone(
-            tokens,
-            encoder_hidden_states=input_image_tokens,
-        )
+            tokens = self.backbone(
+                tokens,
+                encoder_hidden_states=input_image_tokens,
+            )
 
-        scene_codes = self.post_processor(self.tokenizer.detokenize(tokens))
-        return scene_codes
+            scene_codes = self.post_processor(self.tokenizer.detokenize(tokens))
+        return scene_codes.float()
 
     def render(
         self,
@@ -129,12 +298,38 @@ class TSR(BaseModule):
         height: int = 256,
         width: int = 256,
         return_type: str = "pil",
+        use_occupancy_grid: bool = False,
+        batched: bool = False,
+        batch_scenes: bool = True,
+        max_points_per_batch: int = 2**21,
+        num_samples_per_ray: Optional[int] = None,
+        early_termination_eps: Optional[float] = None,
+        num_importance_samples: int = 0,
     ):
+        # num_samples_per_ray, early_termination_eps and num_importance_samples trade
+        # quality for latency, e.g. for previews
+        render_kwargs = {
+            "num_samples_per_ray": num_samples_per_ray,
+            "termination_eps": early_termination_eps,
+            "num_importance_samples": num_importance_samples,
+        }
         rays_o, rays_d = get_spherical_cameras(
             n_views, elevation_deg, camera_distance, fovy_deg, height, width
         )
         rays_o, rays_d = rays_o.to(scene_codes.device), rays_d.to(scene_codes.device)
 
+        if batched:
+            return self._render_batched(
+                scene_codes,
+                rays_o,
+                rays_d,
+                return_type,
+                use_occupancy_grid,
+                batch_scenes,
+                max_points_per_batch,
+                render_kwargs,
+            )
+
         def process_output(image: torch.FloatTensor):
             if return_type == "pt":
                 return image
@@ -149,40 +344,170 @@ class TSR(BaseModule):
 
         images = []
         for scene_code in scene_codes:
+            occupancy_grid = None
+            if use_occupancy_grid:
+                # built once per scene and shared by all views
+                with torch.no_grad():
+                    occupancy_grid = self.renderer.build_occupancy_grid(
+                        self.decoder, scene_code
+                    )
             images_ = []
             for i in range(n_views):
                 with torch.no_grad():
                     image = self.renderer(
-                        self.decoder, scene_code, rays_o[i], rays_d[i]
+                        self.decoder,
+                        scene_code,
+                        rays_o[i],
+                        rays_d[i],
+                        occupancy_grid=occupancy_grid,
+                        **render_kwargs,
                     )
                 images_.append(process_output(image))
             images.append(images_)
 
         return images
 
-    def set_marching_cubes_resolution(self, resolution: int):
+    def _render_batched(
+        self,
+        scene_codes,
+        rays_o,
+        rays_d,
+        return_type: str,
+        use_occupancy_grid: bool,
+        batch_scenes: bool,
+        max_points_per_batch: int,
+        render_kwargs: dict,
+    ):
+        # all views (and, for the uniform sampler without occupancy grids, all scenes)
+        # are rendered as one ray batch; returns a stacked (B, V, H, W, 3) tensor or
+        # array, or nested lists of PIL images for return_type == "pil"
+        adaptive = (
+            render_kwargs["termination_eps"] is not None
+            or render_kwargs["num_importance_samples"] > 0
+        )
+        with torch.no_grad():
+            if batch_scenes and not use_occupancy_grid and not adaptive:
+                images = self.renderer.render_rays(
+                    self.decoder,
+                    scene_codes,
+                    rays_o,
+                    rays_d,
+                    max_points_per_batch=max_points_per_batch,
+                    **render_kwargs,
+                )
+            else:
+                images = []
+                for scene_code in scene_codes:
+                    occupancy_grid = None
+                    if use_occupancy_grid:
+                        occupancy_grid = self.renderer.build_occupancy_grid(
+                            self.decoder, scene_code
+                        )
+                    images.append(
+                        self.renderer.render_rays(
+                            self.decoder,
+                            scene_code,
+                            rays_o,
+                            rays_d,
+                            max_points_per_batch=max_points_per_batch,
+                            occupancy_grid=occupancy_grid,
+                            **render_kwargs,
+                        )
+                    )
+                images = torch.stack(images, dim=0)
+
+        if return_type == "pt":
+            return images
+        elif return_type == "np":
+            return images.detach().cpu().numpy()
+        elif return_type == "pil":
+            images = (images.detach().cpu().numpy() * 255.0).astype(np.uint8)
+            return [[Image.fromarray(view) for view in scene] for scene in images]
+        else:
+            raise NotImplementedError
+
+    def set_marching_cubes_resolution(self, resolution: int, backend: str = "builtin"):
         if (
             self.isosurface_helper is not None
             and self.isosurface_helper.resolution == resolution
+            and self.isosurface_helper.backend == backend
         ):
             return
-        self.isosurface_helper = MarchingCubeHelper(resolution)
+        self.isosurface_helper = MarchingCubeHelper(resolution, backend=backend)
+
+    def extract_mesh(
+        self,
+        scene_codes,
+        has_vertex_color,
+        resolution: int = 256,
+        threshold: float = 25.0,
+        coarse_resolution: Optional[int] = None,
+        refine_margin: float = 5.0,
+        mc_backend: str = "builtin",
+        density_normals: bool = False,
+    ):
+        import trimesh
 
-    def extract_mesh(self, scene_codes, has_vertex_color, resolution: int = 256, threshold: float = 25.0):
-        self.set_marching_cubes_resolution(resolution)
+        self.set_marching_cubes_resolution(resolution, backend=mc_backend)
         meshes = []
         for scene_code in scene_codes:
             with torch.no_grad():
-                density = self.renderer.query_triplane(
-                    self.decoder,
-                    scale_tensor(
-                        self.isosurface_helper.grid_vertices.to(scene_codes.device),
+                cells = None
+                if coarse_resolution is None:
+                    grid_coords = scale_tensor(
+                        self.isosurface_helper.grid_coords.to(scene_codes.device),
                         self.isosurface_helper.points_range,
                         (-self.renderer.cfg.radius, self.renderer.cfg.radius),
-                    ),
-                    scene_code,
-                )["density_act"]
-            v_pos, t_pos_idx = self.isosurface_helper(-(density - threshold))
+                    )
+                    # density is streamed into a single preallocated buffer, and
+                    # shifted in place so that it can go to marching cubes as is
+                    values = torch.empty(
+                        (resolution, resolution, resolution),
+                        dtype=scene_code.dtype,
+                        device=scene_codes.device,
+                    )
+                    self.renderer.query_triplane_grid(
+                        self.decoder,
+                        grid_coords,
+                        grid_coords,
+                        grid_coords,
+                        scene_code,
+                        keys=["density_act"],
+                        out={"density_act": values.view(-1, 1)},
+                    )
+                    values.sub_(threshold)
+                else:
+                    # coarse-to-fine: only cells near the isosurface are evaluated
+                    # at the target resolution
+                    def query_level(points):
+                        return (
+                            self.renderer.query_triplane(
+                                self.decoder,
+                                scale_tensor(
+                                    points,
+                                    self.isosurface_helper.points_range,
+                                    (-self.renderer.cfg.radius, self.renderer.cfg.radius),
+                                ),
+                                scene_code,
+                                keys=["density_act"],
+                            )["density_act"][..., 0]
+                            - threshold
+                        )
+
+                    values, evaluated = self.isosurface_helper.evaluate_hierarchical(
+                        query_level,
+                        coarse_resolution=coarse_resolution,
+                        margin=refine_margin,
+                        device=scene_codes.device,
+                    )
+                    # only the evaluated cells can cross the isosurface
+                    cells = self.isosurface_helper.evaluated_cells(evaluated)
+            v_pos, t_pos_idx = self.isosurface_helper.marching_cubes(values, cells)
+            normals = None
+            if density_normals:
+                # smooth normals from the density gradient, instead of the
+                # area weighted face normals trimesh would compute
+                normals = self.isosurface_helper.vertex_normals(values, v_pos)
             v_pos = scale_tensor(
                 v_pos,
                 self.isosurface_helper.points_range,
@@ -195,11 +520,13 @@ class TSR(BaseModule):
                         self.decoder,
                         v_pos,
                         scene_code,
+                        keys=["color"],
                     )["color"]
             mesh = trimesh.Trimesh(
                 vertices=v_pos.cpu().numpy(),
                 faces=t_pos_idx.cpu().numpy(),
                 vertex_colors=color.cpu().numpy() if has_vertex_color else None,
+                vertex_normals=normals.cpu().numpy() if normals is not None else None,
             )
             meshes.append(mesh)
         return meshes
@@ -1,17 +1,15 @@
 import importlib
 import math
+import os
 from collections import defaultdict
 from dataclasses import dataclass
 from typing import Any, Callable, Dict, List, Optional, Tuple, Union
 
-import imageio
 import numpy as np
 import PIL.Image
-import rembg
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
-import trimesh
 from omegaconf import DictConfig, OmegaConf
 from PIL import Image
 
@@ -187,10 +185,9 @@ def chunk_batch(func: Callable, chunk_size: int, *args, **kwargs) -> Any:
         elif isinstance(out_chunk, dict):
             pass
         else:
-            print(
+            raise TypeError(
                 f"Return value of func must be in type [torch.Tensor, list, tuple, dict], get {type(out_chunk)}."
             )
-            exit(1)
         for k, v in out_chunk.items():
             v = v if torch.is_grad_enabled() else v.detach()
             out[k].append(v)
@@ -218,6 +215,126 @@ def chunk_batch(func: Callable, chunk_size: int, *args, **kwargs) -> Any:
         return out_merged
 
 
+def chunk_batch_preallocated(
+    func: Callable,
+    chunk_size: int,
+    *args,
+    output_keys: Optional[List[Any]] = None,
+    **kwargs,
+) -> Any:
+    """
+    Same as chunk_batch, but without per-chunk output lists and a final concatenation.
+
+    The output shapes are inferred from the first chunk, the outputs of batch size B
+    are allocated once and every chunk is copied straight into its view of them, so
+    the peak memory is one copy of the outputs instead of two. output_keys selects
+    which outputs to keep (dict keys, or indices for tuple / list outputs); the
+    others are never stored and are returned as None. The time is about the same
+    as chunk_batch unless outputs are dropped (see benchmarks/bench_chunk_batch.py).
+    """
+    B = None
+    for arg in list(args) + list(kwargs.values()):
+        if isinstance(arg, torch.Tensor):
+            B = arg.shape[0]
+            break
+    assert (
+        B is not None
+    ), "No tensor found in args or kwargs, cannot determine batch size."
+    if chunk_size <= 0:
+        chunk_size = max(1, B)
+
+    tensor_args = [isinstance(arg, torch.Tensor) for arg in args]
+    tensor_kwargs = {k: isinstance(arg, torch.Tensor) for k, arg in kwargs.items()}
+
+    out: Dict[Any, Optional[torch.Tensor]] = {}
+    # per kept output, its views for each chunk
+    out_views: Dict[Any, Tuple[torch.Tensor, ...]] = {}
+    out_type = None
+    # max(1, B) to support B == 0
+    for c, i in enumerate(range(0, max(1, B), chunk_size)):
+        out_chunk = func(
+            *[
+                arg[i : i + chunk_size] if is_tensor else arg
+                for arg, is_tensor in zip(args, tensor_args)
+            ],
+            **{
+                k: arg[i : i + chunk_size] if tensor_kwargs[k] else arg
+                for k, arg in kwargs.items()
+            },
+        )
+        if out_chunk is None:
+            continue
+        if out_type is None:
+            out_type = type(out_chunk)
+            if isinstance(out_chunk, torch.Tensor):
+                items = [(0, out_chunk)]
+            elif isinstance(out_chunk, (tuple, list)):
+                items = list(enumerate(out_chunk))
+            elif isinstance(out_chunk, dict):
+                items = list(out_chunk.items())
+            else:
+                raise TypeError(
+                    f"Return value of func must be in type [torch.Tensor, list, tuple, dict], get {type(out_chunk)}."
+                )
+            for k, v in items:
+                if v is None or (output_keys is not None and k not in output_keys):
+                    out[k] = None
+                elif isinstance(v, torch.Tensor):
+                    out[k] = v.new_empty(B, *v.shape[1:])
+                    out_views[k] = out[k].split(chunk_size)
+                else:
+                    raise TypeError(
+                        f"Unsupported type in return value of func: {type(v)}"
+                    )
+        if out_type is torch.Tensor:
+            out_chunk = (out_chunk,)
+        for k, views in out_views.items():
+            v = out_chunk[k]
+            views[c].copy_(v if torch.is_grad_enabled() else v.detach())
+
+    if out_type is None:
+        return None
+    if out_type is torch.Tensor:
+        return out[0]
+    elif out_type in [tuple, list]:
+        return out_type([out[i] for i in range(len(out))])
+    elif out_type is dict:
+        return out
+
+
+def get_free_memory(device: Union[str, torch.device]) -> int:
+    device = torch.device(device)
+    if device.type == "cuda":
+        return torch.cuda.mem_get_info(device)[0]
+    try:
+        import psutil
+
+        return psutil.virtual_memory().available
+    except ImportError:
+        return os.sysconf("SC_AVPHYS_PAGES") * os.sysconf("SC_PAGE_SIZE")
+
+
+def is_out_of_memory(e: BaseException) -> bool:
+    if isinstance(e, (MemoryError, torch.OutOfMemoryError)):
+        return True
+    message = str(e)
+    return "out of memory" in message or "can't allocate memory" in message
+
+
+def load_safetensors_mmap(path: str) -> Tuple[Dict[str, torch.Tensor], Dict[str, str]]:
+    """
+    Load a .safetensors file as tensors backed by a private (copy-on-write) memory
+    map of the file: pages are read lazily on first access and shared between
+    processes through the page cache. Returns the tensors and the file metadata.
+    """
+    from safetensors import safe_open
+
+    with safe_open(path, framework="pt", device="cpu") as f:
+        metadata = f.metadata() or {}
+        tensors = {name: f.get_tensor(name) for name in f.keys()}
+    return tensors, metadata
+
+
 ValidScale = Union[Tuple[float, float], torch.FloatTensor]
 
 
@@ -410,6 +527,9 @@ def remove_background(
         do_remove = False
     do_remove = do_remove or force
     if do_remove:
+        # imported on first use, rembg pulls in onnxruntime
+        import rembg
+
         image = rembg.remove(image, session=rembg_session, **rembg_kwargs)
     return image
 
@@ -461,6 +581,8 @@ def save_video(
     fps: int = 30,
 ):
     # use imageio to save video
+    import imageio
+
     frames = [np.array(frame) for frame in frames]
     writer = imageio.get_writer(output_path, fps=fps)
     for frame in frames:
@@ -469,6 +591,8 @@ def save_video(
 
 
 def to_gradio_3d_orientation(mesh):
+    import trimesh
+
     mesh.apply_transform(trimesh.transformations.rotation_matrix(-np.pi/2, [1, 0, 0]))
     mesh.apply_transform(trimesh.transformations.rotation_matrix(np.pi/2, [0, 1, 0]))
     return mesh
@@ -0,0 +1,151 @@
+import logging
+import multiprocessing
+import os
+import threading
+import time
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
+from typing import Dict, Optional
+
+import numpy as np
+from PIL import Image
+
+
+# ワーカープロセスごとの rembg セッション
+_worker_session = None
+
+
+def _init_worker(model_name: Optional[str], num_threads: int) -> None:
+    """ワーカープロセスの初期化：スレッド数を設定して専用の rembg セッションを作成する"""
+    global _worker_session
+    # rembg は OMP_NUM_THREADS から onnxruntime のスレッド数を設定する
+    os.environ["OMP_NUM_THREADS"] = str(num_threads)
+    import rembg
+
+    if model_name is None:
+        _worker_session = rembg.new_session()
+    else:
+        _worker_session = rembg.new_session(model_name)
+
+
+def _remove_in_worker(in_name: str, shape, out_name: str, force: bool):
+    """共有メモリ上の画像の背景を除去し、結果を出力用の共有メモリに書き込む
+
+    Returns:
+        (ワーカーのPID, 処理時間[秒])
+    """
+    # rembg だけを読み込み、ワーカーでは torch や tsr を読み込まない
+    import rembg
+
+    start = time.perf_counter()
+    # 共有メモリの解放（unlink）は親プロセスが行う
+    in_shm = shared_memory.SharedMemory(name=in_name)
+    out_shm = shared_memory.SharedMemory(name=out_name)
+    try:
+        pixels = np.ndarray(shape, dtype=np.uint8, buffer=in_shm.buf)
+        image = Image.fromarray(pixels, mode="RGBA" if shape[-1] == 4 else "RGB")
+        # tsr.utils.remove_background と同じく、透過のある RGBA 画像は force 指定時のみ処理する
+        if force or image.mode != "RGBA" or image.getextrema()[3][0] == 255:
+            image = rembg.remove(image, session=_worker_session)
+        out = np.ndarray((shape[0], shape[1], 4), dtype=np.uint8, buffer=out_shm.buf)
+        out[...] = np.asarray(image.convert("RGBA"))
+        del pixels, out
+    finally:
+        in_shm.close()
+        out_shm.close()
+    return os.getpid(), time.perf_counter() - start
+
+
+class BackgroundRemovalPool:
+    """ワーカープロセスごとに rembg セッションを持つ並列背景除去エンジン
+
+    画像は共有メモリ経由でワーカーとやり取りするため、画素データを pickle して
+    プロセス間で送ることはない（入力を共有メモリに書き込むときと、結果を
+    取り出すときに1回ずつコピーする）。
+    remove はスレッドセーフで、run.py の前処理スレッドや Gradio のハンドラから
+    同時に呼び出せる。画像ごとの処理時間とワーカーの稼働率を記録する。
+    """
+
+    def __init__(self, num_workers: int = 1, num_threads_per_worker: int = 1, model_name: Optional[str] = None):
+        """
+        Args:
+            num_workers: ワーカープロセス数
+            num_threads_per_worker: 各ワーカーの onnxruntime スレッド数
+            model_name: rembg のモデル名（省略時は rembg のデフォルト）
+        """
+        self.num_workers = max(1, num_workers)
+        self.executor = ProcessPoolExecutor(
+            max_workers=self.num_workers,
+            mp_context=multiprocessing.get_context("spawn"),
+            initializer=_init_worker,
+            initargs=(model_name, max(1, num_threads_per_worker)),
+        )
+        self.start_time = time.perf_counter()
+        self.latencies = []
+        self.busy_time: Dict[int, float] = defaultdict(float)
+        self.lock = threading.Lock()
+
+    def remove(self, image: Image.Image, force: bool = False) -> Image.Image:
+        """画像の背景を除去する（tsr.utils.remove_background と同じ挙動）
+
+        Args:
+            image: 入力画像
+            force: RGBA画像でも強制的に背景除去するかどうか
+
+        Returns:
+            背景除去済みのRGBA画像
+        """
+        if image.mode not in ("RGB", "RGBA"):
+            image = image.convert("RGB")
+        pixels = np.asarray(image)
+        height, width = pixels.shape[:2]
+
+        in_shm = shared_memory.SharedMemory(create=True, size=pixels.nbytes)
+        out_shm = shared_memory.SharedMemory(create=True, size=height * width * 4)
+        try:
+            np.ndarray(pixels.shape, dtype=np.uint8, buffer=in_shm.buf)[...] = pixels
+            pid, latency = self.executor.submit(
+                _remove_in_worker, in_shm.name, pixels.shape, out_shm.name, force
+            ).result()
+            out = np.ndarray((height, width, 4), dtype=np.uint8, buffer=out_shm.buf)
+            result = Image.fromarray(out.copy(), mode="RGBA")
+            del out
+        finally:
+            in_shm.close()
+            in_shm.unlink()
+            out_shm.close()
+            out_shm.unlink()
+
+        with self.lock:
+            self.latencies.append(latency)
+            self.busy_time[pid] += latency
+        return result
+
+    def stats(self) -> Dict[str, float]:
+        """処理枚数・画像ごとの処理時間・ワーカー稼働率を返す"""
+        with self.lock:
+            latencies = np.array(self.latencies)
+            busy = sum(self.busy_time.values())
+        elapsed = time.perf_counter() - self.start_time
+        if latencies.size == 0:
+            return {"images": 0, "latency_mean_ms": 0.0, "latency_p95_ms": 0.0, "utilization": 0.0}
+        return {
+            "images": int(latencies.size),
+            "latency_mean_ms": float(latencies.mean() * 1000.0),
+            "latency_p95_ms": float(np.percentile(latencies, 95) * 1000.0),
+            "utilization": busy / (elapsed * self.num_workers),
+        }
+
+    def log_stats(self) -> None:
+        """統計をログに出力する"""
+        stats = self.stats()
+        logging.info(
+            f"Background removal: {stats['images']} images, "
+            f"mean {stats['latency_mean_ms']:.2f}ms, p95 {stats['latency_p95_ms']:.2f}ms per image, "
+            f"worker utilization {stats['utilization'] * 100.0:.1f}%"
+        )
+
+    def shutdown(self) -> None:
+        """ワーカープロセスを終了する"""
+        self.executor.shutdown(wait=True)
@@ -0,0 +1,143 @@
+import logging
+import queue
+import threading
+import time
+from collections import Counter, deque
+from concurrent.futures import Future
+from typing import Any, Callable, Dict, List
+
+import numpy as np
+
+
+class BatchScheduler:
+    """投入されたジョブをまとめてバッチで処理するスケジューラ
+
+    専用のワーカースレッドがキューからジョブを取り出し、最初のジョブから最大 max_wait 秒の間に
+    届いたジョブを最大 max_batch_size 個までまとめて process_batch に渡す。
+    モデルを使うのはワーカースレッドだけなので、複数のスレッドから安全に投入できる。
+    待ち時間の調整用に、バッチサイズの分布とジョブのレイテンシの統計を記録する。
+    """
+
+    def __init__(
+        self,
+        process_batch: Callable[[List[Any]], List[Any]],
+        max_batch_size: int = 1,
+        max_wait: float = 0.0,
+        name: str = "batch-scheduler",
+        max_latency_samples: int = 10000,
+    ):
+        """
+        Args:
+            process_batch: ジョブのリストを受け取り、同じ順序で結果のリストを返す関数。
+                結果が Exception の場合はそのジョブだけを失敗させる
+            max_batch_size: 1バッチにまとめるジョブ数の上限
+            max_wait: 最初のジョブが届いてから後続のジョブを待つ最大時間（秒）。
+                0 の場合はその時点でキューにあるジョブだけをまとめる
+            name: ワーカースレッドの名前
+            max_latency_samples: 統計に使う直近のジョブ数
+        """
+        self.process_batch = process_batch
+        self.max_batch_size = max(1, max_batch_size)
+        self.max_wait = max(0.0, max_wait)
+        self._queue = queue.Queue()
+
+        self.lock = threading.Lock()
+        self.batch_sizes = Counter()
+        self.latencies = deque(maxlen=max_latency_samples)
+        self.queue_waits = deque(maxlen=max_latency_samples)
+        self._thread = threading.Thread(target=self._run, name=name, daemon=True)
+        self._thread.start()
+
+    @property
+    def queue_depth(self) -> int:
+        """処理待ちのジョブ数"""
+        return self._queue.qsize()
+
+    def submit(self, job: Any) -> Future:
+        """ジョブを投入し、結果を受け取る Future を返す"""
+        future = Future()
+        self._queue.put((job, future, time.perf_counter()))
+        return future
+
+    def stats(self) -> Dict[str, Any]:
+        """待ちジョブ数・バッチサイズの分布・レイテンシ（投入から完了まで）と待ち時間を返す"""
+        with self.lock:
+            batch_sizes = dict(sorted(self.batch_sizes.items()))
+            latencies = np.array(self.latencies)
+            queue_waits = np.array(self.queue_waits)
+        stats = {
+            "jobs": int(sum(size * count for size, count in batch_sizes.items())),
+            "queue_depth": self.queue_depth,
+            "batch_sizes": batch_sizes,
+        }
+        for name, values in [("latency", latencies), ("queue_wait", queue_waits)]:
+            for p in [50, 95]:
+                stats[f"{name}_p{p}_ms"] = (
+                    float(np.percentile(values, p) * 1000.0) if values.size > 0 else 0.0
+                )
+        return stats
+
+    def log_stats(self) -> None:
+        """統計をログに出力する"""
+        stats = self.stats()
+        histogram = ", ".join(f"{size}: {count}" for size, count in stats["batch_sizes"].items())
+        logging.info(
+            f"Batch scheduler: {stats['jobs']} jobs, queue depth {stats['queue_depth']}, "
+            f"batch sizes {{{histogram}}}, "
+            f"latency p50 {stats['latency_p50_ms']:.2f}ms, p95 {stats['latency_p95_ms']:.2f}ms, "
+            f"queue wait p50 {stats['queue_wait_p50_ms']:.2f}ms, p95 {stats['queue_wait_p95_ms']:.2f}ms"
+        )
+
+    def shutdown(self, wait: bool = True) -> None:
+        """投入済みのジョブを処理し終えたらワーカースレッドを終了する"""
+        self._queue.put(None)
+        if wait:
+            self._thread.join()
+
+    def _next_batch(self):
+        """次のバッチを取り出す（終了要求を受け取った場合は None）"""
+        item = self._queue.get()
+        if item is None:
+            return None
+        batch = [item]
+        deadline = time.perf_counter() + self.max_wait
+        while len(batch) < self.max_batch_size:
+            remaining = deadline - time.perf_counter()
+            try:
+                if remaining > 0:
+                    item = self._queue.get(timeout=remaining)
+                else:
+                    item = self._queue.get_nowait()
+            except queue.Empty:
+                break
+            if item is None:
+                # 終了要求はこのバッチの処理後に受け取り直す
+                self._queue.put(None)
+                break
+            batch.append(item)
+        return batch
+
+    def _run(self) -> None:
+        while True:
+            batch = self._next_batch()
+            if batch is None:
+                return
+            jobs = [job for job, _, _ in batch]
+            futures = [future for _, future, _ in batch]
+            start = time.perf_counter()
+            try:
+                results = self.process_batch(jobs)
+            except Exception as e:
+                logging.exception(f"Failed to process a batch of {len(jobs)} job(s)")
+                results = [e] * len(jobs)
+            end = time.perf_counter()
+            with self.lock:
+                self.batch_sizes[len(batch)] += 1
+                for _, _, submitted in batch:
+                    self.latencies.append(end - submitted)
+                    self.queue_waits.append(start - submitted)
+            for future, result in zip(futures, results):
+                if isinstance(result, Exception):
+                    future.set_exception(result)
+                else:
+                    future.set_result(result)
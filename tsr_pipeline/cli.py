@@ -1,19 +1,64 @@
 import argparse
+import re
 
 
-def create_parser():
-    """コマンドライン引数パーサーを作成する"""
-    parser = argparse.ArgumentParser(
-        description="TripoSR: Fast 3D Object Reconstruction from a Single Image"
-    )
+def parse_size(value):
+    """"8G" や "512M" のようなサイズ表記をバイト数に変換する"""
+    match = re.fullmatch(r"\s*([0-9]*\.?[0-9]+)\s*([KMGT]?)i?B?\s*", str(value), re.IGNORECASE)
+    if match is None:
+        raise argparse.ArgumentTypeError(f"invalid size: {value!r}")
+    number, unit = match.groups()
+    scale = 1024 ** " KMGT".index(unit.upper() or " ")
+    return int(float(number) * scale)
+
+
+def parse_chunk_size(value):
+    """チャンクサイズを整数または "auto" として解釈する"""
+    if str(value).lower() == "auto":
+        return "auto"
+    try:
+        chunk_size = int(value)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"invalid chunk size: {value!r}")
+    if chunk_size < 0:
+        raise argparse.ArgumentTypeError(f"chunk size must be non-negative: {value!r}")
+    return chunk_size
+
+
+def parse_memory_budget(value):
+    """メモリ予算をバイト数（"8G" など）または空きメモリの割合（0 より大きく 1 以下の数）として解釈する
+
+    単位のない 1 以下の数（"1" を含む）は割合として扱う。
+    """
+    try:
+        fraction = float(value)
+    except ValueError:
+        return parse_size(value)
+    if 0.0 < fraction <= 1.0:
+        return fraction
+    budget = parse_size(value)
+    if budget <= 0:
+        raise argparse.ArgumentTypeError(f"memory budget must be positive: {value!r}")
+    return budget
+
+
+def create_parser(with_images=True, description="TripoSR: Fast 3D Object Reconstruction from a Single Image"):
+    """コマンドライン引数パーサーを作成する
+    
+    Args:
+        with_images: 入力画像の位置引数を含めるか（常駐サーバーでは画像をジョブで受け取るため含めない）
+        description: パーサーの説明
+    """
+    parser = argparse.ArgumentParser(description=description)
     
     # 必須引数
-    parser.add_argument(
-        "image", 
-        type=str, 
-        nargs="+", 
-        help="Path to input image(s)."
-    )
+    if with_images:
+        parser.add_argument(
+            "image", 
+            type=str, 
+            nargs="+", 
+            help="Path to input image(s)."
+        )
     
     # デバイス設定
     parser.add_argument(
@@ -34,8 +79,49 @@ def create_parser():
     parser.add_argument(
         "--chunk-size",
         default=8192,
+        type=parse_chunk_size,
+        help="Evaluation chunk size for surface extraction and rendering. Smaller chunk size reduces VRAM usage but increases computation time. 0 for no chunking, 'auto' to derive it from --memory-budget. Default: 8192"
+    )
+    
+    parser.add_argument(
+        "--memory-budget",
+        default="0.5",
+        type=parse_memory_budget,
+        help="Memory budget for --chunk-size auto, either a size such as '8G' or a fraction of the free memory on the device such as '0.5' (numbers up to 1 without a unit are fractions). The chunk size is halved at runtime if an allocation still fails. Default: 0.5"
+    )
+    
+    parser.add_argument(
+        "--compile-query",
+        action="store_true",
+        help="If specified, compile the triplane queries of mesh extraction, vertex colors and rendering (feature reduction, decoder and activations) with torch.compile. The first query of each chunk shape is slower while compiling; falls back to eager execution if compilation fails."
+    )
+    
+    parser.add_argument(
+        "--inference-dtype",
+        default="float32",
+        type=str,
+        choices=["float32", "bfloat16", "float16"],
+        help="Compute dtype of the model and the decoder, applied with autocast. bfloat16 reduces memory and bandwidth (also on CPU); scene codes, densities and marching cubes stay float32. Default: 'float32'"
+    )
+    
+    parser.add_argument(
+        "--fuse-attention-projections",
+        action="store_true",
+        help="If specified, compute the query/key/value projections of each attention layer of the backbone with a single linear layer."
+    )
+    
+    parser.add_argument(
+        "--quantize",
+        default=None,
+        type=str,
+        help="Apply dynamic int8 quantization (CPU only) to the linear layers of these submodules, joined by '+': any of 'image_tokenizer', 'backbone' and 'decoder', e.g. 'backbone+decoder'. Default: None"
+    )
+    
+    parser.add_argument(
+        "--batch-size",
+        default=1,
         type=int,
-        help="Evaluation chunk size for surface extraction and rendering. Smaller chunk size reduces VRAM usage but increases computation time. 0 for no chunking. Default: 8192"
+        help="Number of images to run through the model in a single forward pass. Larger batches use the backbone more efficiently but require more memory. Default: 1"
     )
     
     parser.add_argument(
@@ -45,6 +131,42 @@ def create_parser():
         help="Marching cubes grid resolution. Default: 256"
     )
     
+    parser.add_argument(
+        "--mc-coarse-resolution",
+        default=None,
+        type=int,
+        help="If specified, evaluate the density coarse-to-fine starting from a grid of roughly this resolution, refining only the cells near the surface up to --mc-resolution. Greatly reduces the number of decoder queries at high resolutions. Default: None (dense evaluation)"
+    )
+    
+    parser.add_argument(
+        "--mc-backend",
+        default="builtin",
+        type=str,
+        choices=["builtin", "torchmcubes"],
+        help="Marching cubes implementation. 'builtin' triangulates only the cells crossing the surface (and, with --mc-coarse-resolution, only the evaluated cells) with batched tensor ops on the model device; 'torchmcubes' requires the torchmcubes extension. Default: 'builtin'"
+    )
+    
+    parser.add_argument(
+        "--density-normals",
+        action="store_true",
+        help="If specified, compute the vertex normals of the extracted mesh from the gradient of the density field, which are smoother than face normals at low --mc-resolution, and export them with the mesh. Default: false"
+    )
+    
+    # メッシュ削減設定
+    parser.add_argument(
+        "--target-faces",
+        default=None,
+        type=int,
+        help="If specified, simplify the extracted mesh to at most this many faces with quadric edge collapse before texture baking and export. Default: None (no simplification)"
+    )
+    
+    parser.add_argument(
+        "--decimate-ratio",
+        default=None,
+        type=float,
+        help="If specified, simplify the extracted mesh to this fraction of its faces (0-1). Ignored if --target-faces is specified. Default: None (no simplification)"
+    )
+    
     # 画像前処理設定
     parser.add_argument(
         "--no-remove-bg",
@@ -59,6 +181,34 @@ def create_parser():
         help="Ratio of the foreground size to the image size. Only used when --no-remove-bg is not specified. Default: 0.85"
     )
     
+    parser.add_argument(
+        "--preprocess-workers",
+        default=1,
+        type=int,
+        help="Number of worker threads for background removal and image normalization, which run ahead of model inference. Default: 1"
+    )
+    
+    parser.add_argument(
+        "--prefetch-depth",
+        default=4,
+        type=int,
+        help="Maximum number of preprocessed images waiting for inference. Bounds the memory used by preprocessing. Raised to the number of preprocessing workers (--preprocess-workers or --bg-removal-workers) so that all of them are kept busy. Default: 4"
+    )
+    
+    parser.add_argument(
+        "--bg-removal-workers",
+        default=0,
+        type=int,
+        help="If greater than 0, remove backgrounds in this many worker processes, each with its own rembg session. Default: 0 (remove in the preprocessing threads with a shared session)"
+    )
+    
+    parser.add_argument(
+        "--bg-removal-threads",
+        default=1,
+        type=int,
+        help="Number of onnxruntime threads per background removal worker process. Only used with --bg-removal-workers. Default: 1"
+    )
+    
     # 出力設定
     parser.add_argument(
         "--output-dir",
@@ -89,6 +239,21 @@ def create_parser():
         help="Texture atlas resolution, only useful with --bake-texture. Default: 2048"
     )
     
+    # キャッシュ設定
+    parser.add_argument(
+        "--cache-dir",
+        default=None,
+        type=str,
+        help="If specified, cache the scene codes of preprocessed input images in this directory, so that re-running the same image skips the model. Default: None (no cache)"
+    )
+    
+    parser.add_argument(
+        "--cache-max-size",
+        default="2G",
+        type=parse_size,
+        help="Maximum total size of the scene code cache, e.g. '512M' or '2G'. Least recently used entries are evicted first. Default: 2G"
+    )
+    
     # レンダリング設定
     parser.add_argument(
         "--render",
@@ -96,6 +261,33 @@ def create_parser():
         help="If specified, save a NeRF-rendered video. Default: false"
     )
     
+    parser.add_argument(
+        "--render-occupancy-grid",
+        action="store_true",
+        help="If specified, skip samples in empty space using a coarse occupancy grid when rendering with --render. Default: false"
+    )
+    
+    parser.add_argument(
+        "--render-num-samples",
+        default=None,
+        type=int,
+        help="Number of uniform samples per ray when rendering with --render. Default: None (use the model config, 128)"
+    )
+    
+    parser.add_argument(
+        "--render-early-termination-eps",
+        default=None,
+        type=float,
+        help="If specified, stop marching a ray once its transmittance falls below this value when rendering with --render. Default: None (no early termination)"
+    )
+    
+    parser.add_argument(
+        "--render-importance-samples",
+        default=0,
+        type=int,
+        help="Number of additional importance samples per ray, placed according to the weights of the uniform samples, when rendering with --render. Default: 0"
+    )
+    
     return parser
 
 
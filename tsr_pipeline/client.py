@@ -0,0 +1,150 @@
+"""常駐サーバー（tsr_pipeline.serve）にジョブを投入するクライアント
+
+run.py の代わりに使うと、モデルの読み込みを毎回行わずに済む。複数の画像は同時に
+投入されるため、サーバー側で1回の TSR.forward にまとめて処理される。
+
+    python -m tsr_pipeline.client examples/chair.png examples/robot.png --mc-resolution 256
+    python -m tsr_pipeline.client photo.png --upload --download-dir output/
+"""
+import argparse
+import base64
+import json
+import os
+import sys
+import urllib.error
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+
+# ジョブのオプションとして送る引数（指定しなかったものはサーバーの既定値を使う）
+JOB_ARGUMENTS = [
+    "no_remove_bg",
+    "foreground_ratio",
+    "mc_resolution",
+    "mc_coarse_resolution",
+    "density_normals",
+    "target_faces",
+    "decimate_ratio",
+    "model_save_format",
+    "bake_texture",
+    "texture_resolution",
+    "render",
+]
+
+
+def submit_job(server, image_path, options, upload=False, inline=False, timeout=None):
+    """1画像のジョブをサーバーに投入し、完了後のレスポンスを返す
+
+    Args:
+        server: サーバーの URL（例: "http://127.0.0.1:8765"）
+        image_path: 入力画像のパス
+        options: ジョブのオプション
+        upload: 画像のパスではなく内容を送るか（サーバーから画像が見えない場合）
+        inline: 出力ファイルの内容もレスポンスで受け取るか
+        timeout: タイムアウト（秒）
+
+    Returns:
+        サーバーのレスポンス（job_id, output_dir, outputs, [artifacts]）
+    """
+    request = {"options": options, "inline": inline}
+    if upload:
+        with open(image_path, "rb") as f:
+            request["image"] = base64.b64encode(f.read()).decode("ascii")
+    else:
+        request["image_path"] = os.path.abspath(image_path)
+    http_request = urllib.request.Request(
+        server.rstrip("/") + "/jobs",
+        data=json.dumps(request).encode("utf-8"),
+        headers={"Content-Type": "application/json"},
+    )
+    try:
+        with urllib.request.urlopen(http_request, timeout=timeout) as response:
+            return json.loads(response.read())
+    except urllib.error.HTTPError as e:
+        raise RuntimeError(json.loads(e.read()).get("error", str(e))) from e
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Submit images to a running tsr_pipeline.serve server.")
+    parser.add_argument(
+        "image",
+        type=str,
+        nargs="+",
+        help="Path to input image(s)."
+    )
+
+    parser.add_argument(
+        "--server",
+        default="http://127.0.0.1:8765",
+        type=str,
+        help="URL of the server. Default: 'http://127.0.0.1:8765'"
+    )
+
+    parser.add_argument(
+        "--upload",
+        action="store_true",
+        help="If specified, send the image contents instead of their paths, e.g. when the server runs on another file system."
+    )
+
+    parser.add_argument(
+        "--download-dir",
+        default=None,
+        type=str,
+        help="If specified, receive the output files in the response and save them to this directory (one subdirectory per image). Default: None (print the paths on the server)"
+    )
+
+    parser.add_argument(
+        "--max-in-flight",
+        default=8,
+        type=int,
+        help="Maximum number of jobs submitted at the same time. Default: 8"
+    )
+
+    # ジョブのオプション（省略時はサーバーの既定値）
+    parser.add_argument("--no-remove-bg", action="store_const", const=True, default=None, help="Do not remove the background.")
+    parser.add_argument("--foreground-ratio", default=None, type=float, help="Ratio of the foreground size to the image size.")
+    parser.add_argument("--mc-resolution", default=None, type=int, help="Marching cubes grid resolution.")
+    parser.add_argument("--mc-coarse-resolution", default=None, type=int, help="Coarse grid resolution for coarse-to-fine evaluation.")
+    parser.add_argument("--density-normals", action="store_const", const=True, default=None, help="Compute vertex normals from the density gradient.")
+    parser.add_argument("--target-faces", default=None, type=int, help="Simplify the extracted mesh to at most this many faces.")
+    parser.add_argument("--decimate-ratio", default=None, type=float, help="Simplify the extracted mesh to this fraction of its faces.")
+    parser.add_argument("--model-save-format", default=None, type=str, choices=["obj", "glb"], help="Format to save the extracted mesh.")
+    parser.add_argument("--bake-texture", action="store_const", const=True, default=None, help="Bake a texture atlas for the extracted mesh.")
+    parser.add_argument("--texture-resolution", default=None, type=int, help="Texture atlas resolution.")
+    parser.add_argument("--render", action="store_const", const=True, default=None, help="Save a NeRF-rendered video.")
+    args = parser.parse_args()
+
+    options = {
+        name: getattr(args, name) for name in JOB_ARGUMENTS if getattr(args, name) is not None
+    }
+
+    def run(item):
+        index, image_path = item
+        response = submit_job(
+            args.server, image_path, options, upload=args.upload, inline=args.download_dir is not None
+        )
+        if args.download_dir is not None:
+            output_dir = os.path.join(args.download_dir, str(index))
+            os.makedirs(output_dir, exist_ok=True)
+            for name, data in response.pop("artifacts").items():
+                with open(os.path.join(output_dir, name), "wb") as f:
+                    f.write(base64.b64decode(data))
+            response["outputs"] = [os.path.join(output_dir, name) for name in sorted(os.listdir(output_dir))]
+        return response
+
+    failed = False
+    with ThreadPoolExecutor(max_workers=max(1, args.max_in_flight)) as executor:
+        futures = [(path, executor.submit(run, (i, path))) for i, path in enumerate(args.image)]
+        for image_path, future in futures:
+            try:
+                response = future.result()
+            except Exception as e:
+                print(f"{image_path}: failed: {e}", file=sys.stderr)
+                failed = True
+                continue
+            print(f"{image_path}: {' '.join(response['outputs'])}")
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
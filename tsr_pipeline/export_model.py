@@ -0,0 +1,56 @@
+import argparse
+import logging
+
+from tsr.system import TSR
+
+
+def main():
+    """モデルを起動の速い形式（メモリマップ可能な safetensors と設定ファイル）で書き出す
+
+    書き出したディレクトリは run.py の --pretrained-model-name-or-path に
+    そのまま指定できる。ViT の設定も config.yaml に同梱されるため、読み込み時に
+    ネットワークアクセスは発生しない。
+    """
+    parser = argparse.ArgumentParser(
+        description="Export a TripoSR model as memory-mapped safetensors with a bundled config."
+    )
+    parser.add_argument(
+        "output_dir",
+        type=str,
+        help="Directory to write config.yaml and the weights to."
+    )
+    parser.add_argument(
+        "--pretrained-model-name-or-path",
+        default="stabilityai/TripoSR",
+        type=str,
+        help="Path to the pretrained model. Could be either a huggingface model id is or a local path. Default: 'stabilityai/TripoSR'"
+    )
+    parser.add_argument(
+        "--weight-name",
+        default="model.safetensors",
+        type=str,
+        help="File name of the exported weights. Names ending in .safetensors are memory-mapped on loading. Default: 'model.safetensors'"
+    )
+    parser.add_argument(
+        "--fuse-attention-projections",
+        action="store_true",
+        help="If specified, export the model with fused attention projections."
+    )
+    args = parser.parse_args()
+
+    model = TSR.from_pretrained(
+        args.pretrained_model_name_or_path,
+        config_name="config.yaml",
+        weight_name="model.ckpt",
+    )
+    if args.fuse_attention_projections:
+        model.fuse_attention_projections()
+    model.save_pretrained(args.output_dir, weight_name=args.weight_name)
+    logging.info(f"Exported model to {args.output_dir}")
+
+
+if __name__ == "__main__":
+    logging.basicConfig(
+        format="%(asctime)s - %(levelname)s - %(message)s", level=logging.INFO
+    )
+    main()
@@ -0,0 +1,313 @@
+"""run.py・常駐サーバー（tsr_pipeline.serve）で共通の、モデルの読み込みと1画像分の推論・出力処理"""
+import logging
+import os
+
+import numpy as np
+import torch
+from PIL import Image
+
+from tsr.bake_texture import bake_texture
+from tsr.decimate import decimate_mesh
+from tsr.system import TSR
+from tsr.utils import remove_background, resize_foreground, save_video
+from tsr_pipeline.timer import Timer
+
+
+# グローバルTimerインスタンスを作成
+timer = Timer()
+
+
+def bg_removal_and_normalize_image(image_path, output_dir, image_index, no_remove_bg, foreground_ratio, rembg_session, bg_removal_pool=None):
+    """背景除去と画像正規化処理を行う
+    
+    Args:
+        image_path: 入力画像のパス
+        output_dir: 出力ディレクトリ
+        image_index: 画像のインデックス
+        no_remove_bg: 背景除去をスキップするかどうか
+        foreground_ratio: 前景のサイズ比率
+        rembg_session: rembgのセッション（背景除去する場合）
+        bg_removal_pool: BackgroundRemovalPool（指定時はワーカープロセスで背景除去する）
+    
+    Returns:
+        前処理済みの画像（PIL.ImageまたはNumPy配列）
+    """
+    if no_remove_bg:
+        # 背景除去なし：単純に画像を読み込んでRGB変換
+        return np.array(Image.open(image_path).convert("RGB"))
+    else:
+        # 背景除去あり：背景除去、前景調整、アルファチャンネル処理
+        if bg_removal_pool is not None:
+            image = bg_removal_pool.remove(Image.open(image_path))
+        else:
+            image = remove_background(Image.open(image_path), rembg_session)
+        image = resize_foreground(image, foreground_ratio)
+        image = np.array(image).astype(np.float32) / 255.0
+        
+        # アルファチャンネル処理（透明部分をグレーに）
+        image = image[:, :, :3] * image[:, :, 3:4] + (1 - image[:, :, 3:4]) * 0.5
+        image = Image.fromarray((image * 255.0).astype(np.uint8))
+        
+        # 出力ディレクトリの作成と前処理済み画像の保存
+        output_path = os.path.join(output_dir, str(image_index))
+        if not os.path.exists(output_path):
+            os.makedirs(output_path)
+        image.save(os.path.join(output_path, "input.png"))
+        
+        return image
+
+
+def export_glb_with_texture(out_mesh_path, out_texture_path, mesh, bake_output):
+    """GLB形式でUV座標付きメッシュとテクスチャを出力する
+    
+    Args:
+        out_mesh_path: GLBファイルの出力パス
+        out_texture_path: テクスチャ画像の出力パス
+        mesh: 元のtrimeshオブジェクト
+        bake_output: bake_texture関数の出力辞書
+    """
+    import trimesh
+
+    # テクスチャ画像の準備と保存
+    texture_array = (bake_output["colors"] * 255.0).astype(np.uint8)
+    texture_image = Image.fromarray(texture_array).transpose(Image.FLIP_TOP_BOTTOM)
+    texture_image.save(out_texture_path)
+    
+    # マテリアルを作成（テクスチャ画像オブジェクトを使用）
+    material = trimesh.visual.material.PBRMaterial(
+        baseColorTexture=texture_image,  # Imageオブジェクトを直接渡す
+        baseColorFactor=[1.0, 1.0, 1.0, 1.0],
+        metallicFactor=0.0,
+        roughnessFactor=1.0
+    )
+    
+    # UV座標付きのビジュアルを作成
+    texture_visual = trimesh.visual.TextureVisuals(
+        uv=bake_output["uvs"],
+        material=material
+    )
+    
+    # 新しいメッシュを作成（法線を明示的に設定）
+    # 法線は bake_texture が UV 展開後の頂点順に並べたもの（--density-normals 指定時は密度場の勾配から計算済み）
+    textured_mesh = trimesh.Trimesh(
+        vertices=mesh.vertices[bake_output["vmapping"]],
+        faces=bake_output["indices"],
+        vertex_normals=bake_output["normals"],  # 法線を明示的に設定
+        visual=texture_visual  # visualも同時に設定
+    )
+    
+    # GLB形式で出力
+    # 注: trimeshのバグにより、TextureVisualsとvertex_normalsの両方が
+    # GLBに正しく出力されない可能性があります（trimesh issue #1296）
+    textured_mesh.export(out_mesh_path)
+
+
+def run_model_on_batch(images, image_names, model, device, scene_code_cache=None):
+    """前処理済み画像のバッチから Triplane（scene_codes）を生成する
+    
+    複数画像を1回の TSR.forward にまとめることで、DINO と Transformer1D の
+    行列演算が大きくなり、CPU でも効率よく計算できる。
+    
+    Args:
+        images: 前処理済み画像のリスト
+        image_names: ログに表示する各画像の名前（画像番号やジョブID）
+        model: TSRモデル
+        device: 実行デバイス
+        scene_code_cache: SceneCodeCache（省略時はキャッシュを使わない）
+    
+    Returns:
+        images と同じ順序で1画像分ずつ取り出せる scene_codes。キャッシュ使用時は
+        メモリマップのままのリストなので、使う前に1画像ずつデバイスに移す
+    """
+    logging.info(f"Running images {list(image_names)} ...")
+    
+    timer.start("Running model")
+    with torch.no_grad():
+        if scene_code_cache is not None:
+            scene_codes = scene_code_cache.run_model(model, images, device)
+        else:
+            scene_codes = model(images, device=device)
+    elapsed = timer.end("Running model")
+    
+    # バッチ単位のスループットを報告
+    if elapsed is not None and elapsed > 0:
+        logging.info(
+            f"Batch of {len(images)} image(s): {len(images) / (elapsed / 1000.0):.2f} images/sec"
+        )
+    return scene_codes
+
+
+def generate_3d_mesh_from_scene_code(scene_codes, image_index, model, output_dir, args):
+    """1画像分の scene_codes から3Dメッシュを生成して出力する
+    
+    処理フロー:
+    1. [オプション] 多視点レンダリング
+    2. Triplane → 3Dメッシュを抽出
+    3. [オプション] テクスチャベイキング
+    4. ファイル出力（OBJ/GLB）
+    
+    Args:
+        scene_codes: 1画像分の scene_codes（バッチ次元は1）
+        image_index: 画像インデックス
+        model: TSRモデル
+        output_dir: 出力ディレクトリ
+        args: コマンドライン引数
+    """
+    image_output_dir = os.path.join(output_dir, str(image_index))
+    os.makedirs(image_output_dir, exist_ok=True)
+    
+    # ========== Step 1: [オプション] 多視点レンダリング ==========
+    # 生成した3Dモデルを30の異なる視点から見た画像を作成
+    if args.render:
+        timer.start("Rendering")
+        render_images = model.render(
+            scene_codes,
+            n_views=30,
+            return_type="pil",
+            use_occupancy_grid=args.render_occupancy_grid,
+            batched=True,
+            num_samples_per_ray=args.render_num_samples,
+            early_termination_eps=args.render_early_termination_eps,
+            num_importance_samples=args.render_importance_samples,
+        )
+        # 各視点の画像を保存（render_000.png 〜 render_029.png）
+        for ri, render_image in enumerate(render_images[0]):
+            render_image.save(os.path.join(image_output_dir, f"render_{ri:03d}.png"))
+        # 回転アニメーション動画も生成
+        save_video(
+            render_images[0], os.path.join(image_output_dir, f"render.mp4"), fps=30
+        )
+        timer.end("Rendering")
+    
+    # ========== Step 2: Triplaneから3Dメッシュを抽出 ==========
+    # マーチングキューブアルゴリズムで3D密度場から表面メッシュを生成
+    timer.start("Extracting mesh")
+    meshes = model.extract_mesh(
+        scene_codes,
+        not args.bake_texture,
+        resolution=args.mc_resolution,
+        coarse_resolution=args.mc_coarse_resolution,
+        mc_backend=args.mc_backend,
+        density_normals=args.density_normals,
+    )
+    timer.end("Extracting mesh")
+    
+    # ========== [オプション] メッシュの削減 ==========
+    # UV展開・テクスチャベイキング・出力は面数に比例して重くなるため、先に面数を減らす
+    if args.target_faces is not None or args.decimate_ratio is not None:
+        timer.start("Decimating mesh")
+        num_faces = len(meshes[0].faces)
+        meshes[0] = decimate_mesh(
+            meshes[0],
+            target_faces=args.target_faces,
+            ratio=args.decimate_ratio if args.target_faces is None else None,
+            # 密度の勾配から求めた法線は削減後の頂点にも補間して引き継ぐ
+            vertex_normals=meshes[0].vertex_normals if args.density_normals else None,
+            device=scene_codes.device,
+        )
+        timer.end("Decimating mesh")
+        logging.info(f"Decimated mesh from {num_faces} to {len(meshes[0].faces)} faces")
+    
+    # ========== Step 3 & 4: メッシュの出力（テクスチャ有無で処理分岐）==========
+    out_mesh_path = os.path.join(image_output_dir, f"mesh.{args.model_save_format}")
+    
+    if args.bake_texture:
+        # テクスチャベイキングあり：UV展開してテクスチャアトラスを生成
+        out_texture_path = os.path.join(image_output_dir, "texture.png")
+        
+        # xatlas はテクスチャベイキング時にのみ読み込む
+        import xatlas
+
+        # UV展開とテクスチャ色の計算
+        timer.start("Baking texture")
+        bake_output = bake_texture(meshes[0], model, scene_codes[0], args.texture_resolution)
+        timer.end("Baking texture")
+        
+        # 出力形式による分岐
+        timer.start("Exporting mesh and texture")
+        
+        if args.model_save_format == "glb":
+            # GLB形式での出力（UV座標付きメッシュとテクスチャを別々に保存）
+            try:
+                export_glb_with_texture(out_mesh_path, out_texture_path, meshes[0], bake_output)
+            except Exception as e:
+                logging.error(f"Failed to export GLB with texture: {e}")
+                logging.info("Falling back to OBJ format...")
+                # フォールバック：OBJ形式で出力
+                out_mesh_path = out_mesh_path.replace(".glb", ".obj")
+                xatlas.export(out_mesh_path, meshes[0].vertices[bake_output["vmapping"]], bake_output["indices"], bake_output["uvs"], bake_output["normals"])
+                Image.fromarray((bake_output["colors"] * 255.0).astype(np.uint8)).transpose(Image.FLIP_TOP_BOTTOM).save(out_texture_path)
+        else:
+            # OBJ形式での出力（既存処理）
+            xatlas.export(out_mesh_path, meshes[0].vertices[bake_output["vmapping"]], bake_output["indices"], bake_output["uvs"], bake_output["normals"])
+            Image.fromarray((bake_output["colors"] * 255.0).astype(np.uint8)).transpose(Image.FLIP_TOP_BOTTOM).save(out_texture_path)
+        
+        timer.end("Exporting mesh and texture")
+    else:
+        # テクスチャベイキングなし：頂点カラー付きメッシュを直接出力
+        timer.start("Exporting mesh")
+        meshes[0].export(out_mesh_path)
+        timer.end("Exporting mesh")
+
+
+def get_device(device):
+    """使用するデバイスを返す（CUDA が使えない場合は CPU）
+    
+    Args:
+        device: 指定されたデバイス
+    
+    Returns:
+        実際に使用するデバイス
+    """
+    if not torch.cuda.is_available():
+        logging.info(f"CUDA not available, using CPU")
+        return "cpu"
+    return device
+
+
+def load_model(args, device):
+    """コマンドライン引数に従って TSR モデルを読み込み、デバイスに転送する
+    
+    Args:
+        args: コマンドライン引数
+        device: 実行デバイス
+    
+    Returns:
+        TSRモデル
+    """
+    timer.start("Initializing model")
+    # tsr_pipeline.export_model で書き出した safetensors があれば、メモリマップで読み込む
+    weight_name = "model.ckpt"
+    if os.path.isfile(os.path.join(args.pretrained_model_name_or_path, "model.safetensors")):
+        weight_name = "model.safetensors"
+    # meta デバイス上で構築し、乱数による初期化を省いてチェックポイントの重みを割り当てる
+    startup_timings = {}
+    model = TSR.from_pretrained(
+        args.pretrained_model_name_or_path,
+        config_name="config.yaml",
+        weight_name=weight_name,
+        timings=startup_timings,
+    )
+    logging.info(
+        f"Model construction {startup_timings['construction'] * 1000:.2f}ms, "
+        f"weight loading {startup_timings['loading'] * 1000:.2f}ms"
+    )
+    if args.chunk_size == "auto":
+        model.renderer.set_memory_budget(args.memory_budget)
+    else:
+        model.renderer.set_chunk_size(args.chunk_size)
+    if args.compile_query:
+        model.set_compiled_query()
+    model.set_inference_dtype(args.inference_dtype)
+    if args.fuse_attention_projections:
+        model.fuse_attention_projections()
+    if args.quantize is not None:
+        if device == "cpu":
+            model.quantize(args.quantize)
+        else:
+            logging.warning("--quantize is only supported on CPU, ignored")
+    timer.start("Moving model to device")
+    model.to(device)
+    timer.end("Moving model to device")
+    timer.end("Initializing model")
+    return model
@@ -0,0 +1,54 @@
+from collections import deque
+from concurrent.futures import Executor, ThreadPoolExecutor
+from typing import Any, Callable, Iterable, Iterator, Optional
+
+
+def prefetch_map(
+    func: Callable[[Any], Any],
+    items: Iterable[Any],
+    num_workers: int = 1,
+    queue_depth: int = 4,
+    executor: Optional[Executor] = None,
+) -> Iterator[Any]:
+    """func を items にワーカープールで先行適用し、結果を入力順に返すジェネレータ
+
+    実行中・完了済みで未消費の結果は最大 queue_depth 個に制限されるため、
+    ピークメモリは入力数ではなくキューの深さで決まる。
+    呼び出し側が結果を処理している間も、次の入力の処理が裏で進む。
+
+    Args:
+        func: 各要素に適用する関数
+        items: 入力のイテラブル
+        num_workers: ワーカースレッド数（executor を渡した場合は無視）
+        queue_depth: 先行して処理する要素数の上限
+        executor: 使用する Executor（省略時はスレッドプールを作成する）
+
+    Yields:
+        func(item) の結果（items と同じ順序）
+    """
+    queue_depth = max(1, queue_depth)
+    own_executor = executor is None
+    if own_executor:
+        executor = ThreadPoolExecutor(max_workers=max(1, num_workers))
+
+    items = iter(items)
+    pending = deque()
+
+    def submit_next() -> None:
+        for item in items:
+            pending.append(executor.submit(func, item))
+            return
+
+    try:
+        for _ in range(queue_depth):
+            submit_next()
+        while pending:
+            future = pending.popleft()
+            result = future.result()
+            submit_next()
+            yield result
+    finally:
+        for future in pending:
+            future.cancel()
+        if own_executor:
+            executor.shutdown(wait=True)
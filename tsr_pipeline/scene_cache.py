@@ -0,0 +1,205 @@
+import hashlib
+import logging
+import os
+import tempfile
+from typing import Dict, List, Optional
+
+import numpy as np
+import torch
+from omegaconf import OmegaConf
+
+
+def _update_hash_with_tensor(hasher, tensor: torch.Tensor) -> None:
+    """テンソルの形状・型・内容をハッシュに追加する"""
+    tensor = tensor.detach().cpu()
+    hasher.update(f"{tuple(tensor.shape)}:{tensor.dtype}".encode())
+    if tensor.is_quantized:
+        # 量子化テンソルは整数表現と量子化パラメータをハッシュする
+        if tensor.qscheme() in (torch.per_tensor_affine, torch.per_tensor_symmetric):
+            hasher.update(f"{tensor.q_scale()}:{tensor.q_zero_point()}".encode())
+        else:
+            _update_hash_with_tensor(hasher, tensor.q_per_channel_scales())
+            _update_hash_with_tensor(hasher, tensor.q_per_channel_zero_points())
+        tensor = tensor.int_repr()
+    hasher.update(tensor.contiguous().reshape(-1).view(torch.uint8).numpy())
+
+
+def _update_hash_with_value(hasher, value) -> None:
+    """state_dict の値（テンソル、量子化済み Linear のパラメータのタプルなど）をハッシュに追加する"""
+    if isinstance(value, torch.Tensor):
+        _update_hash_with_tensor(hasher, value)
+    elif isinstance(value, (tuple, list)):
+        for v in value:
+            _update_hash_with_value(hasher, v)
+    else:
+        hasher.update(str(value).encode())
+
+
+def model_fingerprint(model) -> str:
+    """モデルの設定とチェックポイントからフィンガープリントを計算する
+
+    TSR.from_pretrained で読み込んだモデルは、重みの内容ではなくチェックポイント
+    ファイルのパス・サイズ・更新時刻で識別するため、プロセスごとに全パラメータを
+    ハッシュする必要がない。チェックポイントから読み込んでいないモデルだけは
+    全パラメータ・バッファの内容をハッシュする。
+
+    Args:
+        model: TSRモデル
+
+    Returns:
+        設定とチェックポイント（または重み）から計算したハッシュ値
+    """
+    hasher = hashlib.sha256()
+    hasher.update(OmegaConf.to_yaml(model.cfg).encode())
+    # 低精度推論・量子化では scene_codes も変わるため、推論時の設定もキーに含める
+    hasher.update(str(getattr(model, "inference_dtype", None)).encode())
+    hasher.update(str(getattr(model, "quantize_mode", None)).encode())
+    hasher.update(str(getattr(model, "fused_attention_projections", False)).encode())
+    checkpoint_path = getattr(model, "checkpoint_path", None)
+    if checkpoint_path is not None:
+        # Hugging Face のキャッシュでは実体のファイル名が内容のハッシュになる
+        checkpoint_path = os.path.realpath(checkpoint_path)
+        stat = os.stat(checkpoint_path)
+        hasher.update(f"{checkpoint_path}:{stat.st_size}:{stat.st_mtime_ns}".encode())
+        return hasher.hexdigest()
+    for name, tensor in model.state_dict().items():
+        hasher.update(name.encode())
+        _update_hash_with_value(hasher, tensor)
+    return hasher.hexdigest()
+
+
+class SceneCodeCache:
+    """前処理済み入力画像をキーに scene_codes をディスクに保存するキャッシュ
+
+    キーは前処理済み入力テンソルと、モデルのチェックポイント・設定のハッシュから計算する。
+    各 scene_code は .npy ファイルとして保存され、ヒット時はメモリマップで
+    読み込まれるため、背景除去後の TSR.forward を丸ごとスキップできる。
+    合計サイズが max_bytes を超えると、最も長く使われていないエントリから削除する。
+    """
+
+    def __init__(self, cache_dir: str, max_bytes: int = 2 * 1024**3, model_key: Optional[str] = None):
+        """
+        Args:
+            cache_dir: キャッシュを保存するディレクトリ
+            max_bytes: キャッシュの最大合計サイズ（バイト）
+            model_key: モデルを識別する文字列。省略時は最初の使用時に
+                model_fingerprint で計算する
+        """
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.model_key = model_key
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def key(self, model, rgb_cond: torch.Tensor) -> str:
+        """1画像分の前処理済み入力テンソルからキャッシュキーを計算する
+
+        Args:
+            model: TSRモデル
+            rgb_cond: 前処理済み入力画像 (H, W, 3)
+
+        Returns:
+            キャッシュキー
+        """
+        if self.model_key is None:
+            self.model_key = model_fingerprint(model)
+        hasher = hashlib.sha256(self.model_key.encode())
+        _update_hash_with_tensor(hasher, rgb_cond)
+        return hasher.hexdigest()
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.cache_dir, f"{key}.npy")
+
+    def get(self, key: str) -> Optional[torch.Tensor]:
+        """キャッシュから scene_code を取得する（見つからなければ None）"""
+        path = self._path(key)
+        try:
+            # copy-on-write のメモリマップ：ページは必要になった時点で読み込まれる
+            scene_code = np.load(path, mmap_mode="c")
+        except (FileNotFoundError, ValueError, OSError):
+            self.misses += 1
+            return None
+        # LRU 用に最終使用時刻を更新
+        os.utime(path)
+        self.hits += 1
+        return torch.from_numpy(scene_code)
+
+    def put(self, key: str, scene_code: torch.Tensor) -> None:
+        """scene_code をキャッシュに保存する"""
+        array = scene_code.detach().float().cpu().numpy()
+        # 書き込み途中のファイルが読まれないよう、一時ファイルに書いてから置き換える
+        fd, tmp_path = tempfile.mkstemp(dir=self.cache_dir, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                np.save(f, array)
+            os.replace(tmp_path, self._path(key))
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+        self._evict()
+
+    def _evict(self) -> None:
+        """合計サイズが max_bytes 以下になるまで古いエントリを削除する"""
+        entries = []
+        for name in os.listdir(self.cache_dir):
+            if not name.endswith(".npy"):
+                continue
+            path = os.path.join(self.cache_dir, name)
+            try:
+                stat = os.stat(path)
+            except FileNotFoundError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total -= size
+            self.evictions += 1
+
+    def run_model(self, model, images: List, device: str) -> List[torch.Tensor]:
+        """キャッシュを使って画像のバッチから scene_codes を生成する
+
+        キャッシュにない画像だけをまとめて1回の TSR.forward で処理し、結果を保存する。
+        キャッシュから読み込んだ scene_code はメモリマップのまま返すため、
+        呼び出し側でデバイスに移すときに初めて読み込まれる。
+
+        Args:
+            model: TSRモデル
+            images: 前処理済み画像のリスト
+            device: 実行デバイス
+
+        Returns:
+            images と同じ順序の1画像分ずつの scene_code のリスト
+        """
+        rgb_cond = model.image_processor(images, model.cfg.cond_image_size)
+        keys = [self.key(model, rgb) for rgb in rgb_cond]
+        scene_codes: List[Optional[torch.Tensor]] = [self.get(key) for key in keys]
+
+        missing = [i for i, scene_code in enumerate(scene_codes) if scene_code is None]
+        if len(missing) > 0:
+            with torch.no_grad():
+                new_scene_codes = model(rgb_cond[missing], device=device)
+            for i, scene_code in zip(missing, new_scene_codes):
+                self.put(keys[i], scene_code)
+                scene_codes[i] = scene_code
+
+        return scene_codes
+
+    @property
+    def stats(self) -> Dict[str, int]:
+        """ヒット数・ミス数・削除数"""
+        return {"hits": self.hits, "misses": self.misses, "evictions": self.evictions}
+
+    def log_stats(self) -> None:
+        """キャッシュの統計をログに出力する"""
+        logging.info(
+            f"Scene code cache: {self.hits} hits, {self.misses} misses, {self.evictions} evictions"
+        )
@@ -0,0 +1,317 @@
+"""TSR と rembg のセッションを読み込んだまま常駐し、ローカルの HTTP API でジョブを受け付けるサーバー
+
+    python -m tsr_pipeline.serve --device cuda:0 --batch-size 4
+    python -m tsr_pipeline.client examples/chair.png --bake-texture
+
+モデルに関するオプション（--device, --chunk-size, --inference-dtype など）と、ジョブで
+指定しなかった場合の既定値（--mc-resolution, --bake-texture など）は run.py と同じ。
+最初のジョブから --batch-window ミリ秒以内に投入されたジョブは、最大 --batch-size 件まで
+1回の TSR.forward にまとめて処理する。
+
+API:
+    POST /jobs   ジョブを実行し、完了後に結果を返す
+        {"image_path": "...", "options": {"mc_resolution": 256, ...}, "inline": false}
+        画像は image_path の代わりに "image"（base64 でエンコードしたファイルの内容）でも渡せる。
+        image_path はサーバーの --input-dir の中のファイルに限る。
+        不正なオプションや画像を指定したジョブは 400 で拒否する。
+        inline が true の場合は出力ファイルの内容も base64 で返す。
+        -> {"job_id": "...", "output_dir": "...", "outputs": ["..."], "artifacts": {"mesh.obj": "..."}}
+        出力はジョブごとに一意なディレクトリ（--output-dir/<job_id>）に書き出す。
+    GET /health  サーバーの状態（待ちジョブ数・バッチサイズの分布・レイテンシの p50/p95）を返す
+"""
+import base64
+import io
+import json
+import logging
+import os
+import threading
+import uuid
+from argparse import Namespace
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from tsr_pipeline.background_removal import BackgroundRemovalPool
+from tsr_pipeline.batching import BatchScheduler
+from tsr_pipeline.cli import create_parser
+from tsr_pipeline.inference import (
+    bg_removal_and_normalize_image,
+    generate_3d_mesh_from_scene_code,
+    get_device,
+    load_model,
+    run_model_on_batch,
+)
+from tsr_pipeline.scene_cache import SceneCodeCache
+
+
+def _is_int(value):
+    return isinstance(value, int) and not isinstance(value, bool)
+
+
+def _is_number(value):
+    return isinstance(value, (int, float)) and not isinstance(value, bool)
+
+
+# ジョブごとに指定できるオプション（それ以外はサーバー起動時の値を使う）と、
+# その値の説明・検査関数。出力先はクライアントから指定できず、常にサーバーの --output-dir の下になる
+JOB_OPTIONS = {
+    "no_remove_bg": ("a boolean", lambda v: isinstance(v, bool)),
+    "foreground_ratio": ("a number in (0, 1]", lambda v: _is_number(v) and 0 < v <= 1),
+    "mc_resolution": ("an integer >= 2", lambda v: _is_int(v) and v >= 2),
+    "mc_coarse_resolution": ("null or an integer >= 2", lambda v: v is None or _is_int(v) and v >= 2),
+    "density_normals": ("a boolean", lambda v: isinstance(v, bool)),
+    "target_faces": ("null or a positive integer", lambda v: v is None or _is_int(v) and v > 0),
+    "decimate_ratio": ("null or a number in (0, 1]", lambda v: v is None or _is_number(v) and 0 < v <= 1),
+    "model_save_format": ("'obj' or 'glb'", lambda v: v in ["obj", "glb"]),
+    "bake_texture": ("a boolean", lambda v: isinstance(v, bool)),
+    "texture_resolution": ("a positive integer", lambda v: _is_int(v) and v > 0),
+    "render": ("a boolean", lambda v: isinstance(v, bool)),
+    "render_occupancy_grid": ("a boolean", lambda v: isinstance(v, bool)),
+    "render_num_samples": ("null or a positive integer", lambda v: v is None or _is_int(v) and v > 0),
+    "render_early_termination_eps": ("null or a non-negative number", lambda v: v is None or _is_number(v) and v >= 0),
+    "render_importance_samples": ("a non-negative integer", lambda v: _is_int(v) and v >= 0),
+}
+
+
+class InferenceServer:
+    """モデルと rembg のセッションを保持し、ジョブを前処理してバッチで実行する"""
+
+    def __init__(self, args):
+        """
+        Args:
+            args: コマンドライン引数（ジョブのオプションの既定値にもなる）
+        """
+        self.args = args
+        self.device = get_device(args.device)
+        self.model = load_model(args, self.device)
+
+        self.bg_removal_pool = None
+        self.rembg_session = None
+        self._rembg_lock = threading.Lock()
+        if args.bg_removal_workers > 0:
+            self.bg_removal_pool = BackgroundRemovalPool(
+                num_workers=args.bg_removal_workers,
+                num_threads_per_worker=args.bg_removal_threads,
+            )
+        elif not args.no_remove_bg:
+            self._get_rembg_session()
+
+        self.scene_code_cache = None
+        if args.cache_dir is not None:
+            self.scene_code_cache = SceneCodeCache(args.cache_dir, max_bytes=args.cache_max_size)
+
+        self.scheduler = BatchScheduler(
+            self._process_batch,
+            max_batch_size=args.batch_size,
+            max_wait=args.batch_window / 1000.0,
+        )
+
+    def _get_rembg_session(self):
+        """rembg のセッションを返す（初めて背景除去するときに作成する）"""
+        with self._rembg_lock:
+            if self.rembg_session is None:
+                import rembg
+
+                self.rembg_session = rembg.new_session()
+        return self.rembg_session
+
+    def job_args(self, options):
+        """サーバーの引数にジョブのオプションを上書きした引数を返す（不正な値は ValueError）"""
+        if not isinstance(options, dict):
+            raise ValueError("'options' must be an object")
+        unknown = sorted(set(options) - set(JOB_OPTIONS))
+        if unknown:
+            raise ValueError(f"Unknown job options: {unknown}, must be in {list(JOB_OPTIONS)}")
+        for name, value in options.items():
+            description, is_valid = JOB_OPTIONS[name]
+            if not is_valid(value):
+                raise ValueError(f"Invalid job option {name}={value!r}, must be {description}")
+        return Namespace(**{**vars(self.args), **options})
+
+    def image_path(self, path):
+        """ジョブの image_path を検査し、--input-dir の中のファイルであればその絶対パスを返す"""
+        if not isinstance(path, str):
+            raise ValueError("'image_path' must be a string")
+        # シンボリックリンクや .. で --input-dir の外のファイルを読めないよう、実体のパスで比べる
+        input_dir = os.path.realpath(self.args.input_dir)
+        path = os.path.realpath(path)
+        if os.path.commonpath([input_dir, path]) != input_dir:
+            raise ValueError(
+                f"'image_path' must be inside the server's --input-dir ({input_dir}); "
+                "send the image contents with 'image' instead"
+            )
+        if not os.path.isfile(path):
+            raise ValueError(f"Image not found: {path}")
+        return path
+
+    def run_job(self, request):
+        """ジョブを前処理してバッチに投入し、完了を待って結果を返す
+
+        前処理（背景除去）は呼び出し元のスレッドで行うため、複数のジョブの前処理は並行に進む。
+        """
+        if not isinstance(request, dict):
+            raise ValueError("A job must be a JSON object")
+        args = self.job_args(request.get("options", {}))
+        if "image" in request:
+            if not isinstance(request["image"], str):
+                raise ValueError("'image' must be a base64 encoded string")
+            image = io.BytesIO(base64.b64decode(request["image"], validate=True))
+        elif "image_path" in request:
+            image = self.image_path(request["image_path"])
+        else:
+            raise ValueError("A job needs either 'image_path' or 'image'")
+
+        # 再起動や run.py の出力と衝突せず、以前の成果物を返さないよう一意な ID を使う
+        job_id = uuid.uuid4().hex
+        image = bg_removal_and_normalize_image(
+            image,
+            args.output_dir,
+            job_id,
+            args.no_remove_bg,
+            args.foreground_ratio,
+            None if args.no_remove_bg or self.bg_removal_pool is not None else self._get_rembg_session(),
+            bg_removal_pool=self.bg_removal_pool,
+        )
+        self.scheduler.submit((job_id, image, args)).result()
+
+        output_dir = os.path.abspath(os.path.join(args.output_dir, str(job_id)))
+        outputs = sorted(os.path.join(output_dir, name) for name in os.listdir(output_dir))
+        response = {"job_id": job_id, "output_dir": output_dir, "outputs": outputs}
+        if request.get("inline", False):
+            artifacts = {}
+            for path in outputs:
+                with open(path, "rb") as f:
+                    artifacts[os.path.basename(path)] = base64.b64encode(f.read()).decode("ascii")
+            response["artifacts"] = artifacts
+        return response
+
+    def _process_batch(self, jobs):
+        """スケジューラのワーカースレッドで、ジョブのバッチを1回の TSR.forward で処理する"""
+        job_ids = [job_id for job_id, _, _ in jobs]
+        scene_codes = run_model_on_batch(
+            [image for _, image, _ in jobs],
+            job_ids,
+            self.model,
+            self.device,
+            self.scene_code_cache,
+        )
+        results = []
+        for j, (job_id, _, args) in enumerate(jobs):
+            try:
+                os.makedirs(args.output_dir, exist_ok=True)
+                generate_3d_mesh_from_scene_code(
+                    scene_codes[j][None].to(self.device),
+                    job_id,
+                    self.model,
+                    args.output_dir,
+                    args,
+                )
+                results.append(None)
+            except Exception as e:
+                logging.exception(f"Job {job_id} failed")
+                results.append(e)
+        return results
+
+    def health(self):
+        """サーバーの状態を返す"""
+        return {"status": "ok", "device": self.device, **self.scheduler.stats()}
+
+    def shutdown(self):
+        """処理中のジョブを終えてからワーカーを終了する"""
+        self.scheduler.shutdown()
+        self.scheduler.log_stats()
+        if self.scene_code_cache is not None:
+            self.scene_code_cache.log_stats()
+        if self.bg_removal_pool is not None:
+            self.bg_removal_pool.log_stats()
+            self.bg_removal_pool.shutdown()
+
+
+def make_handler(server: InferenceServer):
+    """InferenceServer にリクエストを渡す HTTP リクエストハンドラを作成する"""
+
+    class Handler(BaseHTTPRequestHandler):
+        def _send_json(self, status, body):
+            data = json.dumps(body).encode("utf-8")
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def do_GET(self):
+            if self.path == "/health":
+                self._send_json(200, server.health())
+            else:
+                self._send_json(404, {"error": f"Not found: {self.path}"})
+
+        def do_POST(self):
+            if self.path != "/jobs":
+                self._send_json(404, {"error": f"Not found: {self.path}"})
+                return
+            try:
+                length = int(self.headers.get("Content-Length", 0))
+                request = json.loads(self.rfile.read(length))
+                response = server.run_job(request)
+            except (ValueError, KeyError, OSError) as e:
+                self._send_json(400, {"error": str(e)})
+            except Exception as e:
+                self._send_json(500, {"error": str(e)})
+            else:
+                self._send_json(200, response)
+
+        def log_message(self, format, *args):
+            logging.debug(format % args)
+
+    return Handler
+
+
+def main():
+    parser = create_parser(
+        with_images=False,
+        description="Serve TripoSR over a local HTTP job API, keeping the model loaded.",
+    )
+    parser.add_argument(
+        "--host",
+        default="127.0.0.1",
+        type=str,
+        help="Address to listen on. Default: '127.0.0.1' (local connections only)"
+    )
+
+    parser.add_argument(
+        "--port",
+        default=8765,
+        type=int,
+        help="Port to listen on. Default: 8765"
+    )
+
+    parser.add_argument(
+        "--input-dir",
+        default=".",
+        type=str,
+        help="Directory that the image_path of jobs must be inside; other images must be sent with the job ('--upload' in the client). Default: '.' (the working directory of the server)"
+    )
+
+    parser.add_argument(
+        "--batch-window",
+        default=50.0,
+        type=float,
+        help="Milliseconds to wait after the first queued job for more jobs to batch with it, up to --batch-size. Jobs are preprocessed before they are queued, so a window of 0 rarely batches jobs from different requests. Default: 50"
+    )
+    args = parser.parse_args()
+
+    server = InferenceServer(args)
+    httpd = ThreadingHTTPServer((args.host, args.port), make_handler(server))
+    logging.info(f"Serving on http://{args.host}:{args.port}")
+    try:
+        httpd.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        httpd.server_close()
+        server.shutdown()
+
+
+if __name__ == "__main__":
+    logging.basicConfig(
+        format="%(asctime)s - %(levelname)s - %(message)s", level=logging.INFO
+    )
+    main()